@@ -4,7 +4,8 @@ from aiogram.types import CallbackQuery
 from api import SuperEnglishDictionary
 from core import BotControl, Routers
 from core.markups import Info
-from models.english import EditEnglish, WordTickCallbackData, EditWordCallbackData, ResetWordCallbackData
+from core.markups.pagination import ListSource, SortedSetSource
+from models.english import EditEnglish, WordTickCallbackData, EditWordCallbackData, ResetWordCallbackData, WordsIndex
 from models.word import Word, TranslateTickCallbackData
 from tools import Emoji
 
@@ -19,7 +20,7 @@ async def get_english(callback: CallbackQuery, bot_control: BotControl):
         await bot_control.append(Info(f"No offers so far {Emoji.WEB}"))
         return
 
-    await bot_control.append(EditEnglish("add", offer))
+    await bot_control.append(EditEnglish("add", ListSource(sorted(offer))))
 
 
 @admin_english_router.callback_query(F.data == "edit_words")
@@ -30,25 +31,44 @@ async def edit_english_run(callback: CallbackQuery, bot_control: BotControl):
         await bot_control.append(Info(f"No words so far {Emoji.WEB}"))
         return
 
-    await bot_control.append(EditEnglish("edit", words))
+    index = WordsIndex(bot_control.bot_storage)
+    await index.ensure(words)
+    await bot_control.append(EditEnglish("edit", SortedSetSource(index.words_key)))
 
 
 @admin_english_router.callback_query(WordTickCallbackData.filter())
 async def marking_words(callback: CallbackQuery, callback_data: WordTickCallbackData, bot_control: BotControl):
     edit_english: EditEnglish = await bot_control.get_current()
-    edit_english.marking_words(callback_data.index)
+    edit_english.marking_words(callback_data.index, callback_data.window)
     await bot_control.set_current(edit_english)
 
 
+@admin_english_router.callback_query(F.data.startswith("word_tick:"))
+async def marking_words_legacy(callback: CallbackQuery, bot_control: BotControl):
+    """
+    Ticks of keyboards sent before WordTickCallbackData carried word indexes, the window is shown anew
+    """
+    await bot_control.set_current(await bot_control.get_current())
+
+
 @admin_english_router.callback_query(EditWordCallbackData.filter())
 async def edit_word(callback: CallbackQuery, callback_data: EditWordCallbackData, bot_control: BotControl):
-    await bot_control.append(Word(callback_data.word, await SuperEnglishDictionary.extract_data(callback_data.word)))
+    edit_english: EditEnglish = await bot_control.get_current()
+    word = edit_english.resolve(callback_data.token, callback_data.window)
+    if word is None:
+        await bot_control.set_current(edit_english)
+        return
+    await bot_control.append(Word(word, await SuperEnglishDictionary.extract_data(word)))
 
 
 @admin_english_router.callback_query(ResetWordCallbackData.filter())
 async def reset_word(callback: CallbackQuery, callback_data: ResetWordCallbackData, bot_control: BotControl):
     edit_english: EditEnglish = await bot_control.get_current()
-    await edit_english.reset_word(callback_data.word)
+    word = edit_english.resolve(callback_data.token, callback_data.window)
+    if word is None:
+        await bot_control.set_current(edit_english)
+        return
+    await edit_english.reset_word(bot_control, word)
     await bot_control.append(Info(f"Reset completed {Emoji.MAGIC_SPHERE}"))
 
 
@@ -31,12 +31,17 @@ async def edit_shop(callback: CallbackQuery, bot_control: BotControl):
 
 @admin_shop_router.callback_query(EditContentCallbackData.filter())
 async def edit_content(callback: CallbackQuery, callback_data: EditContentCallbackData, bot_control: BotControl):
-    item = (await bot_control.bot_storage.get_value_by_key("shop"))[callback_data.name]
+    shop: Shop = await bot_control.get_current()
+    name = shop.resolve(callback_data.token, callback_data.window)
+    item = (await bot_control.bot_storage.get_value_by_key("shop")).get(name)
+    if item is None:
+        await bot_control.set_current(shop)
+        return
     await bot_control.append(Content(
         action_type="edit",
         content_type=item["type"],
         content=item["content"],
-        temp_name=callback_data.name,
+        temp_name=name,
         temp_dna_cost=item["cost"][Emoji.DNA],
         temp_cube_cost=item["cost"][Emoji.CUBE],
         temp_star_cost=item["cost"][Emoji.STAR]
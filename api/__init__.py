@@ -1,17 +1,23 @@
 import string
 from asyncio import gather, create_task, to_thread
+from collections import OrderedDict
 from copy import deepcopy
 from logging import getLogger
 from os import getenv
-from random import choice, shuffle
+from random import randrange, shuffle
 from re import fullmatch, I
-from typing import Dict, List
+from time import monotonic
+from typing import Dict, List, Tuple
 
 from aiohttp import ClientSession
-from tools import DictStorage, Emoji
+from tools import NamespaceStorage, Emoji
+from config import WORD_DATA_CACHE_SIZE, WORD_DATA_CACHE_TTL
 
 logger = getLogger()
 
+# (word, card type, example index), the index is -1 for cards without an example
+CardRef = Tuple[str, str, int]
+
 class WordCard:
     def __init__(
             self,
@@ -36,6 +42,16 @@ class WordCard:
     def knowledge_scheme(self):
         return deepcopy(self._knowledge_scheme)
 
+    @property
+    def ref(self) -> CardRef:
+        if not self.type.startswith("example"):
+            return self.word, self.type, -1
+        original = self.question if self.type == "example:en-ru" else self.answer
+        examples = SuperEnglishDictionary.get_examples(self.data)
+        return self.word, self.type, next(
+            (i for i, example in enumerate(examples) if example["original"] == original), 0
+        )
+
 
 class SuperEnglishDictionary:
     _audio_and_examples_host = "https://api.dictionaryapi.dev"
@@ -47,96 +63,102 @@ class SuperEnglishDictionary:
         "Content-Type": "application/json"
     }
 
-    _translations_cache = DictStorage("deep-translate1.p.rapidapi.com")
-    _audio_and_examples_cache = DictStorage("api.dictionaryapi.dev")
-    _yandex_cache = DictStorage("dictionary.yandex.net")
+    # Yandex data never expires: admins edit translations right in it
+    _translations_cache = NamespaceStorage(
+        "deep-translate1.p.rapidapi.com", ttl=90 * 24 * 60 * 60, sliding=True, max_size=50000
+    )
+    _audio_and_examples_cache = NamespaceStorage(
+        "api.dictionaryapi.dev", ttl=30 * 24 * 60 * 60, sliding=True, max_size=20000
+    )
+    _yandex_cache = NamespaceStorage("dictionary.yandex.net")
+    # Admin edits done by another bot process show up once the entry expires
+    _data_cache: OrderedDict[str, Tuple[float, Dict]] = OrderedDict()
+
+    @classmethod
+    async def migrate_caches(cls):
+        """
+        Moves caches stored as one pickled dict per API to a key per entry. Does nothing once moved.
+        """
+        for cache in (cls._translations_cache, cls._audio_and_examples_cache, cls._yandex_cache):
+            await cache.migrate_from(cache._namespace)
 
     @classmethod
-    async def extract_cards(cls, word: str, _cache=True) -> List[WordCard] | None:
+    async def extract_card_refs(cls, word: str, _cache=True) -> List[CardRef] | None:
         if not fullmatch(r"[a-z-]+", word, flags=I):
             logger.error(f"Incorrect word {word} for extract data")
             return
 
         data = await cls.extract_data(word, _cache)
         try:
-            return await cls._build_cards(data, word)
+            return cls._card_refs(data, word)
         except (KeyError, Exception) as e_:
             if not _cache:
                 logger.critical(f"Impossible extract cards for word {word} after refresh data", exc_info=True)
                 e_.add_note(f"Impossible extract cards for word {word} after refresh data")
                 raise e_
             logger.error(f"Impossible extract cards for word {word}. Trying refresh data", exc_info=True)
-            return await cls.extract_cards(word, _cache=False)
+            return await cls.extract_card_refs(word, _cache=False)
 
     @staticmethod
     def get_translates(data: Dict):
         return [tr for pos_value in data["pos"].values() for tr in pos_value.get("tr", [])]
 
-    @classmethod
-    async def _build_cards(cls, data: Dict, word: str) -> List[WordCard]:
-        cards = []
-        translates = cls.get_translates(data)
-        examples = []
-        for pos_value in data["pos"].values():
-            exs = pos_value.get("examples")
-            if exs:
-                examples.extend(exs)
-
-        knowledge_schema = cls.build_knowledge_schema(data)
+    @staticmethod
+    def get_examples(data: Dict):
+        return [example for pos_value in data["pos"].values() for example in pos_value.get("examples") or ()]
 
-        if translates:
-            cards.append(WordCard(
-                word,
-                data,
-                word,
-                translates,
-                "default:en-ru",
-                f"Give all possible translations, spaces-separated, of the word",
-                knowledge_schema
-            ))
-            shuffle(translates)
-            cards.append(WordCard(
-                word,
-                data,
-                translates,
-                word,
-                "default:ru-en",
-                f"What English word can describe each of these words?",
-                knowledge_schema
-            ))
+    @classmethod
+    def _card_refs(cls, data: Dict, word: str) -> List[CardRef]:
+        refs = []
+        if cls.get_translates(data):
+            refs.append((word, "default:en-ru", -1))
+            refs.append((word, "default:ru-en", -1))
 
+        examples = cls.get_examples(data)
         if examples:
-            example = choice(examples)
-            cards.append(WordCard(
-                word,
-                data,
-                example["original"],
-                example["translate"],
-                "example:en-ru",
-                "Translate",
-                knowledge_schema
-            ))
-            cards.append(WordCard(
-                word,
-                data,
-                example["translate"],
-                example["original"],
-                "example:ru-en",
-                "Translate",
-                knowledge_schema
-            ))
-        if not cards:
+            example = randrange(len(examples))
+            refs.append((word, "example:en-ru", example))
+            refs.append((word, "example:ru-en", example))
+        if not refs:
             logger.warning(f"{Emoji.WARNING} No cards for word {word}")
-        return cards
+        return refs
+
+    @classmethod
+    async def draw_card(cls, ref: CardRef) -> WordCard | None:
+        """
+        :return: card built from the current word data, None if the data has no such card anymore
+        """
+        word, type_, _ = ref
+        data = await cls.extract_data(word)
+        try:
+            return cls._build_card(data, ref)
+        except (KeyError, IndexError, TypeError):
+            logger.warning(f"No card {type_} for word {word} anymore")
+
+    @classmethod
+    def _build_card(cls, data: Dict, ref: CardRef) -> WordCard:
+        word, type_, example_index = ref
+        if type_ == "default:en-ru":
+            question, answer = word, cls.get_translates(data)
+            question_text = f"Give all possible translations, spaces-separated, of the word"
+        elif type_ == "default:ru-en":
+            question, answer = cls.get_translates(data), word
+            shuffle(question)
+            question_text = f"What English word can describe each of these words?"
+        else:
+            example = cls.get_examples(data)[example_index]
+            question, answer = example["original"], example["translate"]
+            if type_ == "example:ru-en":
+                question, answer = answer, question
+            question_text = "Translate"
+        if not question or not answer:
+            raise IndexError(f"Empty card {ref}")
+        return WordCard(word, data, question, answer, type_, question_text, cls.build_knowledge_schema(data))
 
     @classmethod
     def build_knowledge_schema(cls, data: Dict):
-        translates = [tr for pos_value in data["pos"].values() for tr in pos_value.get("tr", [])]
-        examples = []
-        for pos_value in data["pos"].values():
-            exs = pos_value.get("examples")
-            if exs:
-                examples.extend(exs)
+        translates = cls.get_translates(data)
+        examples = cls.get_examples(data)
         knowledge_schema = {}
         if examples:
             knowledge_schema["example:en-ru"] = {
@@ -164,6 +186,15 @@ class SuperEnglishDictionary:
 
     @classmethod
     async def extract_data(cls, word: str, cache=True):
+        """
+        Parsed data is kept for WORD_DATA_CACHE_TTL seconds in a LRU shared by all chats, callers must not change it.
+        """
+        if cache and word in cls._data_cache:
+            expires_at, data = cls._data_cache[word]
+            if expires_at > monotonic():
+                cls._data_cache.move_to_end(word)
+                return data
+
         data, audio_and_examples = await gather(cls._yandex(word, cache), cls._audio_and_examples(word, cache))
 
         logger.debug(f"Word: {word}\n"
@@ -180,6 +211,11 @@ class SuperEnglishDictionary:
             data["audio"] = audio_and_examples.get("audio")
 
         logger.debug(f"Resume: {data}")
+        if data is not None:
+            cls._data_cache[word] = monotonic() + WORD_DATA_CACHE_TTL, data
+            cls._data_cache.move_to_end(word)
+            if len(cls._data_cache) > WORD_DATA_CACHE_SIZE:
+                cls._data_cache.popitem(last=False)
         return data
 
     @classmethod
@@ -300,6 +336,7 @@ class SuperEnglishDictionary:
     @classmethod
     async def set_yandex_data(cls, word, data):
         await cls._yandex_cache.set_value_by_key(word, data)
+        cls._data_cache.pop(word, None)
 
     @classmethod
     def _yandex_parsing(cls, data: Dict):
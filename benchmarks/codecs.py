@@ -0,0 +1,154 @@
+"""
+Encode/decode time and payload size of tools.codecs codecs for value shapes the bot stores.
+
+    python -m benchmarks.codecs
+"""
+import asyncio
+from random import choice, randint
+from string import ascii_lowercase
+from timeit import timeit
+
+from core.markups import WindowBuilder, Info, ButtonWidget, TextWidget, DataTextWidget
+from tools import Emoji
+from tools.codecs import Serializer, msgpack, orjson, lz4, zstandard
+
+NUMBER = 200
+
+
+def _word():
+    return "".join(choice(ascii_lowercase) for _ in range(randint(3, 10)))
+
+
+def context_stack():
+    title = WindowBuilder(
+        type_="photo",
+        auto_back=False,
+        photo="AgACAgIAAx0Cf42o9wACA1lmg-KSXwhGC6Z6E3R00sYQ3cIKowACqt8xG3rTIEgLAn-plPmK1QEAAwIAA3MAAzUE",
+        frozen_buttons_map=[[ButtonWidget(text=f"Button {i}", callback_data=f"button_{i}")] for i in range(4)],
+    )
+    inspect = WindowBuilder(
+        paginated_buttons=[
+            ButtonWidget(text=f"{_word()} {Emoji.STAR * 2}", mark=Emoji.OK, callback_data=f"ban_word:{i}")
+            for i in range(300)
+        ]
+    )
+    inspect.add_texts_rows(TextWidget(text=f"{Emoji.STAR} 120/1200"), DataTextWidget(text="Stage", data="12"))
+    stack = [title, inspect, Info("Reset completed")]
+    for window in stack:
+        window.init()
+    return stack
+
+
+def knowledge(words: int = 2000):
+    return {
+        _word(): {
+            card_type: {"p": randint(0, 9), "g": randint(0, 9), "b": randint(0, 9)}
+            for card_type in ("default:en-ru", "default:ru-en", "example:en-ru", "example:ru-en")
+        }
+        for _ in range(words)
+    }
+
+
+def dictionary_api_response():
+    return [
+        {
+            "word": "span",
+            "phonetics": [{"text": "/spæn/", "audio": "https://api.dictionaryapi.dev/media/pronunciations/en/span.mp3"}],
+            "meanings": [
+                {
+                    "partOfSpeech": pos,
+                    "definitions": [
+                        {
+                            "definition": " ".join(_word() for _ in range(12)),
+                            "example": " ".join(_word() for _ in range(8)) + " span",
+                            "synonyms": [],
+                            "antonyms": [],
+                        }
+                        for _ in range(8)
+                    ],
+                }
+                for pos in ("noun", "verb")
+            ],
+        }
+    ]
+
+
+def yandex_data():
+    return {
+        "ts": "spæn",
+        "pos": {
+            pos: {"tr": {_word() for _ in range(6)}, "syn": {_word() for _ in range(6)}}
+            for pos in ("noun", "verb", "adjective")
+        },
+    }
+
+
+SHAPES = {
+    "message id": lambda: 123456,
+    "context stack": context_stack,
+    "knowledge": knowledge,
+    "api response": dictionary_api_response,
+    "yandex data": yandex_data,
+}
+
+
+def serializers():
+    names = ["pickle"]
+    if msgpack is not None:
+        names.append("msgpack")
+    if orjson is not None:
+        names.append("orjson")
+    return {name: Serializer.by_name(name) for name in names}
+
+
+def compressions():
+    names = [None, "zlib"]
+    if lz4 is not None:
+        names.append("lz4")
+    if zstandard is not None:
+        names.append("zstd")
+    return names
+
+
+def run():
+    print(f"{'shape':<15}{'codec':<10}{'used':<10}{'bytes':>10}{'encode us':>12}{'decode us':>12}")
+    for shape_name, shape in SHAPES.items():
+        value = shape()
+        for name, serializer in serializers().items():
+            encoded = serializer.encode(value)
+            used = Serializer._codecs[encoded[0]].name
+            encode = timeit(lambda: serializer.encode(value), number=NUMBER) / NUMBER * 1e6
+            decode = timeit(lambda: serializer.decode_sync(encoded), number=NUMBER) / NUMBER * 1e6
+            print(f"{shape_name:<15}{name:<10}{used:<10}{len(encoded):>10}{encode:>12.1f}{decode:>12.1f}")
+
+    print(f"\n{'shape':<15}{'compression':<13}{'bytes':>10}{'ratio':>8}{'encode us':>12}{'decode us':>12}")
+    for shape_name, shape in SHAPES.items():
+        value = shape()
+        for compression in compressions():
+            serializer = Serializer.by_name("pickle", compression=compression)
+            encoded = serializer.encode(value)
+            ratio = len(encoded) / len(Serializer.by_name("pickle").encode(value))
+            encode = timeit(lambda: serializer.encode(value), number=NUMBER) / NUMBER * 1e6
+            decode = timeit(lambda: serializer.decode_sync(encoded), number=NUMBER) / NUMBER * 1e6
+            print(
+                f"{shape_name:<15}{compression or 'none':<13}{len(encoded):>10}{ratio:>8.2f}{encode:>12.1f}{decode:>12.1f}"
+            )
+
+    serializer = Serializer.by_name(None)
+    encoded = serializer.encode(123456)
+
+    async def inline():
+        for _ in range(NUMBER):
+            await serializer.decode(encoded)
+
+    async def thread():
+        for _ in range(NUMBER):
+            await asyncio.to_thread(serializer.decode_sync, encoded)
+
+    for name, coroutine in (("inline", inline), ("to_thread", thread)):
+        seconds = timeit(lambda: asyncio.run(coroutine()), number=1)
+        print(f"small value decode {name}: {seconds / NUMBER * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    run()
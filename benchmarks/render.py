@@ -0,0 +1,67 @@
+"""
+Renders per second of windows the bot sends, with and without the widget render cache.
+
+    python -m benchmarks.render
+
+uncached: aiogram Text trees and an InlineKeyboardBuilder per row on every render, as before the cache.
+cached: widgets render once, a render only joins them. One changed button shows the cost of a dirty widget.
+"""
+from copy import deepcopy
+from timeit import timeit
+
+from aiogram.utils.formatting import as_list
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from benchmarks.codecs import context_stack
+from core.markups import WindowBuilder
+from tools import Emoji
+
+NUMBER = 300
+
+
+def uncached_html(window: WindowBuilder):
+    try:
+        return as_list(*(text.formatted_text for text in window.text_map)).as_html()
+    except IndexError:
+        return "No Data"
+
+
+def uncached_keyboard(window: WindowBuilder):
+    markup = InlineKeyboardBuilder()
+    for buttons_row in window.keyboard_map:
+        row = InlineKeyboardBuilder()
+        for button in buttons_row:
+            row.button(text=button.formatted_text, callback_data=button.callback_data)
+        markup.attach(row)
+    return markup.as_markup()
+
+
+def cached(window: WindowBuilder):
+    return window.as_html, window.keyboard
+
+
+def dirty(window: WindowBuilder):
+    button = window.keyboard_map[-1][-1]
+    button.mark = Emoji.DENIAL if button.mark == Emoji.OK else Emoji.OK
+    return window.as_html, window.keyboard
+
+
+def run():
+    title, inspect, info = context_stack()
+    assert all(uncached_html(window) == window.as_html for window in (title, inspect, info))
+    assert all(uncached_keyboard(window) == window.keyboard for window in (title, inspect, info))
+
+    print(f"{'window':<10}{'uncached/s':>12}{'cached/s':>12}{'one dirty/s':>13}")
+    for name, window in (("title", title), ("inspect", inspect), ("info", info)):
+        uncached = NUMBER / timeit(lambda: (uncached_html(window), uncached_keyboard(window)), number=NUMBER)
+        cached_ = NUMBER / timeit(lambda: cached(window), number=NUMBER)
+        dirty_ = NUMBER / timeit(lambda: dirty(window), number=NUMBER)
+        print(f"{name:<10}{uncached:>12.0f}{cached_:>12.0f}{dirty_:>13.0f}")
+
+    copies = NUMBER / timeit(lambda: deepcopy(title), number=NUMBER)
+    clones = NUMBER / timeit(lambda: title.clone(), number=NUMBER)
+    print(f"title screen copies/s: deepcopy {copies:.0f}, clone {clones:.0f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,95 @@
+"""
+Storage traffic of the hot update paths on each storage backend: requests per second of one chat.
+
+    python -m benchmarks.storage [memory sqlite redis]
+
+process_answer: statistic and knowledge read and written back, two counters incremented, one unit of work.
+set_current: FSM state set, message ids read, the window written over the top of the context stack.
+Redis is measured only if REDIS_HOST is reachable.
+"""
+import asyncio
+import sys
+from os import path, getenv
+from tempfile import mkdtemp
+from time import perf_counter
+
+from aiogram.fsm.storage.base import StorageKey
+from redis.exceptions import ConnectionError
+
+from benchmarks.codecs import context_stack, knowledge
+from core.fsm import ClientStorage
+from tools import Storage, HashStorage, NativeListStorage, UnitOfWork, SqliteClient, create_client
+
+NUMBER = 300
+
+
+async def process_answer(user_id: int):
+    unit = UnitOfWork()
+    user_storage = HashStorage(f"{user_id}:user_storage", unit)
+    statistic = await user_storage.get_value_by_key("english:en-ru_statistic", {})
+    statistic["word"] = statistic.get("word", 0) + 1
+    await user_storage.set_value_by_key("english:en-ru_statistic", statistic)
+    user_knowledge = await user_storage.get_value_by_key("english:knowledge", {})
+    await user_storage.set_value_by_key("english:knowledge", user_knowledge)
+    await user_storage.increment("english:total_dna", 3)
+    await user_storage.increment("english:keys", 1)
+    await unit.flush()
+
+
+async def set_current(chat_id: int, window, fsm: ClientStorage):
+    unit = UnitOfWork()
+    messages_ids = NativeListStorage(f"{chat_id}:1:messages_ids", unit)
+    context = NativeListStorage(f"{chat_id}:1:context_stack", unit)
+    await fsm.set_state(StorageKey(bot_id=1, chat_id=chat_id, user_id=chat_id), "English:input_text")
+    await messages_ids.get_all_except_last()
+    await messages_ids.get_last()
+    await context.set_last(window)
+    await unit.flush()
+
+
+def client(backend: str):
+    if backend == "sqlite":
+        return SqliteClient(path.join(mkdtemp(), "benchmark.sqlite3"))
+    return create_client(backend)
+
+
+async def measure(backend: str):
+    Storage.CLIENT = client(backend)
+    await Storage.CLIENT.initialize()
+    stack = context_stack()
+    await HashStorage("1:user_storage").set({"english:knowledge": knowledge(), "english:total_dna": 0})
+    await NativeListStorage("1:1:context_stack").set(stack)
+    await NativeListStorage("1:1:messages_ids").set([1, 2])
+    fsm = ClientStorage()
+
+    results = {}
+    for name, update in (
+            ("process_answer", lambda: process_answer(1)),
+            ("set_current", lambda: set_current(1, stack[1], fsm)),
+    ):
+        start = perf_counter()
+        for _ in range(NUMBER):
+            await update()
+        results[name] = NUMBER / (perf_counter() - start)
+
+    await Storage.CLIENT.delete("1:user_storage", "1:1:context_stack", "1:1:messages_ids")
+    await Storage.CLIENT.aclose()
+    return results
+
+
+async def run(backends: list[str]):
+    print(f"{'backend':<10}{'process_answer/s':>18}{'set_current/s':>16}")
+    for backend in backends:
+        if backend == "redis" and getenv("REDIS_HOST") is None:
+            print(f"{backend:<10}skipped: REDIS_HOST is not set")
+            continue
+        try:
+            results = await measure(backend)
+        except (ConnectionError, OSError) as e:
+            print(f"{backend:<10}skipped: {e}")
+            continue
+        print(f"{backend:<10}{results['process_answer']:>18.0f}{results['set_current']:>16.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(run(sys.argv[1:] or ["memory", "sqlite", "redis"]))
@@ -1 +1,4 @@
 DECK_SIZE = 3
+OFFER_SIZE = 200
+WORD_DATA_CACHE_SIZE = 5000
+WORD_DATA_CACHE_TTL = 600
@@ -1,8 +1,5 @@
 import asyncio
-from asyncio import sleep
-from copy import deepcopy
 from logging import getLogger
-from os import getenv
 from datetime import datetime, timedelta
 
 from aiogram.filters import Command
@@ -10,12 +7,20 @@ from aiogram.types import BotCommand
 from aiogram import Bot, Router
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.methods import (
+    SendMessage, SendPhoto, SendVoice, EditMessageText, EditMessageMedia, EditMessageCaption
+)
 from aiogram.types import InputMediaPhoto, InputMediaAudio, Message, CallbackQuery
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.jobstores.redis import RedisJobStore
 
 from core.markups import WindowBuilder
-from tools import Emoji, ListStorage, DictStorage
+from core.outbound import Outbound, Priority
+from tools import (
+    Emoji, NativeListStorage, DictStorage, UnitOfWork, HashStorage,
+    MESSAGES_IDS_POLICY, CONTEXT_POLICY, FINGERPRINTS_POLICY
+)
+from tools.metrics import scoped
 
 logger = getLogger()
 
@@ -72,14 +77,18 @@ class Routers:
         return router
 
 
+# Jobs are bound methods of BotControl, which holds Bot and FSMContext and can't be pickled to a redis job store
 SCHEDULER = AsyncIOScheduler()
 SCHEDULER.configure(
-        jobstore={"default": RedisJobStore(host=getenv("REDIS_HOST"), port=int(getenv("REDIS_PORT")))},
         job_defaults={"coalesce": False, "misfire_grace_time": None}
     )
 
 
 class BotControl:
+    MESSAGES_IDS_POLICY = MESSAGES_IDS_POLICY
+    CONTEXT_POLICY = CONTEXT_POLICY
+    FINGERPRINTS_POLICY = FINGERPRINTS_POLICY
+
     def __init__(
             self,
             *,
@@ -93,6 +102,9 @@ class BotControl:
             user_storage: DictStorage,
             name: str | None = None,
             message_life_span: int = 60,
+            unit: UnitOfWork | None = None,
+            raw_state: str | None = None,
+            outbound: Outbound | None = None,
     ):
         self.chat_id = chat_id
         self.name = name
@@ -101,22 +113,25 @@ class BotControl:
         self._greetings = greetings
         self._private_title_screen = private_title_screen
         self._group_title_screen = group_title_screen
-        self._messages_ids = ListStorage(f"{chat_id}:{bot.id}:messages_ids")
-        self._context = ListStorage(f"{chat_id}:{bot.id}:context_stack")
+        self._messages_ids = NativeListStorage(
+            f"{chat_id}:{bot.id}:messages_ids", unit, **self.MESSAGES_IDS_POLICY
+        )
+        self._context = NativeListStorage(f"{chat_id}:{bot.id}:context_stack", unit, **self.CONTEXT_POLICY)
+        # Fingerprint of the window shown by every message, see WindowBuilder.fingerprint
+        self._fingerprints = HashStorage(f"{chat_id}:{bot.id}:fingerprints", unit, **self.FINGERPRINTS_POLICY)
         self._state = state
+        self._raw_state = raw_state
         self._bot = bot
-        self._update_message = {
-            "text": self._update_text_message,
-            "photo": self._update_photo_message,
-            "voice": self._update_voice_message,
-            "audio": self._update_voice_message
-        }
+        # Shared by the BotControls of a bot, so its limits hold for all chats
+        self._outbound = Outbound(bot) if outbound is None else outbound
         self._message_life_span = message_life_span
         self._temp_current_markup_name = None
 
+    @scoped("BotControl")
     async def greetings(self):
         await self.append(self._greetings)
 
+    @scoped("BotControl")
     async def append(self, markup: WindowBuilder):
         if self._temp_current_markup_name != markup.__class__.__name__:
             try:
@@ -127,6 +142,7 @@ class BotControl:
         if markup.initializing and await self._update_chat(markup):
             await self._context.append(markup)
 
+    @scoped("BotControl")
     async def back(self, update=False):
         await self.pop_last()
         markup = await self._context.get_last()
@@ -144,22 +160,23 @@ class BotControl:
 
         await self.set_current(markup, update=False)
 
+    @scoped("BotControl")
     async def pop_last(self):
         return await self._context.pop_last()
 
+    @scoped("BotControl")
     async def refresh(self):
         await self._update_chat(await self._context.get_last())
 
+    @scoped("BotControl")
     async def reset(self):
         await self._context.destroy()
-        for message_id in await self._messages_ids.get():
-            await self._delete_message(message_id)
-        await self._messages_ids.destroy()
+        await self.clear_chat(force=True)
 
         if self.chat_id.startswith("-"):
-            markup = deepcopy(self._group_title_screen)
+            markup = self._group_title_screen.clone()
         else:
-            markup = deepcopy(self._private_title_screen)
+            markup = self._private_title_screen.clone()
 
         try:
             await markup(self)
@@ -168,6 +185,7 @@ class BotControl:
 
         await self._update_chat(markup)
 
+    @scoped("BotControl")
     async def get_current(self):
         """
         :return: last appended window builder without text_map and keyboard_map
@@ -179,6 +197,7 @@ class BotControl:
         self._temp_current_markup_name = markup.__class__.__name__
         return markup
 
+    @scoped("BotControl")
     async def set_current(self, markup: WindowBuilder, update=True):
         if update:
             try:
@@ -189,127 +208,140 @@ class BotControl:
         if markup.initializing and await self._update_chat(markup):
             await self._context.set_last(markup)
 
-    async def _create_text_message(self, markup: WindowBuilder):
-        message = await self._bot.send_message(
-            chat_id=self.chat_id,
-            text=markup.as_html,
-            reply_markup=markup.keyboard,
-        )
-        await self._delete_task_message(message_id=message.message_id)
-        await self._messages_ids.append(message.message_id)
-
-    async def _update_text_message(self, markup: WindowBuilder):
-        last_message_id = (await self._messages_ids.get_last())
-        if last_message_id is None:
-            await self._create_text_message(markup)
-            return True
-
-        await self._bot.edit_message_text(
-            chat_id=self.chat_id,
-            message_id=last_message_id,
-            text=markup.as_html,
-            reply_markup=markup.keyboard,
-        )
-        return True
-
-    async def _create_photo_message(self, markup: WindowBuilder):
-        message = await self._bot.send_photo(
-            chat_id=self.chat_id,
-            photo=markup.photo,
-            caption="" if markup.as_html == "No Data" else markup.as_html,
-            reply_markup=markup.keyboard,
-        )
+    @staticmethod
+    def _caption(markup: WindowBuilder):
+        return "" if markup.as_html == "No Data" else markup.as_html
+
+    async def _create_message(self, markup: WindowBuilder):
+        if markup.type == "text":
+            method = SendMessage(chat_id=self.chat_id, text=markup.as_html, reply_markup=markup.keyboard)
+        elif markup.type == "photo":
+            method = SendPhoto(
+                chat_id=self.chat_id, photo=markup.photo, caption=self._caption(markup), reply_markup=markup.keyboard
+            )
+        else:
+            method = SendVoice(
+                chat_id=self.chat_id, voice=markup.voice, caption=self._caption(markup), reply_markup=markup.keyboard
+            )
+        message = await self._outbound(method, Priority.SEND)
         await self._delete_task_message(message_id=message.message_id)
         await self._messages_ids.append(message.message_id)
+        await self._fingerprints.set_value_by_key(str(message.message_id), self._shown(markup))
 
-    async def _update_photo_message(self, markup: WindowBuilder):
-        last_message_id = (await self._messages_ids.get_last())
-        if last_message_id is None:
-            await self._create_photo_message(markup)
-            return True
-
-        await self._bot.edit_message_media(
-            chat_id=self.chat_id,
-            message_id=last_message_id,
-            media=InputMediaPhoto(media=markup.photo),
-        )
-        await self._bot.edit_message_caption(
-            chat_id=self.chat_id,
-            message_id=last_message_id,
-            caption="" if markup.as_html == "No Data" else markup.as_html,
-            reply_markup=markup.keyboard
-        )
-        return True
-
-    async def _create_voice_message(self, markup: WindowBuilder):
-        message = await self._bot.send_voice(
-            chat_id=self.chat_id,
-            voice=markup.voice,
-            caption="" if markup.as_html == "No Data" else markup.as_html,
-            reply_markup=markup.keyboard
-        )
-        await self._delete_task_message(message_id=message.message_id)
-        await self._messages_ids.append(message.message_id)
+    @staticmethod
+    def _shown(markup: WindowBuilder):
+        """
+        :return: what the fingerprints hash keeps about the message showing markup
+        """
+        return markup.type, markup.media, markup.fingerprint
 
-    async def _update_voice_message(self, markup: WindowBuilder):
+    async def _update_message(self, markup: WindowBuilder) -> bool:
+        """
+        Takes the cheapest request which turns the last message into markup, judging by what it shows now:
+        nothing if it shows markup already, a caption edit if the media stays, a media edit with the caption
+        and keyboard inside for a new photo. Text and media messages can't be edited into each other
+        and voice messages can't get new media, so these are replaced by a new message.
+        A message sent before its fingerprint was kept is edited as the window type says
+        :return: False if the message already shows markup
+        """
         last_message_id = await self._messages_ids.get_last()
         if last_message_id is None:
-            await self._create_voice_message(markup)
+            await self._create_message(markup)
+            return True
+        shown = await self._fingerprints.get_value_by_key(str(last_message_id))
+        shown_type, shown_media, fingerprint = shown if isinstance(shown, tuple) else (markup.type, None, None)
+        if fingerprint == markup.fingerprint:
+            return False
+
+        if (shown_type == "text") != (markup.type == "text") or (
+                shown_type in ("audio", "voice") and shown_media not in (None, markup.media)
+        ):
+            await self._create_message(markup)
+            await self._delete_message(last_message_id)
             return True
 
-        await self._bot.edit_message_media(
-            chat_id=self.chat_id,
-            message_id=last_message_id,
-            media=InputMediaAudio(media=markup.voice),
-        )
-        await self._bot.edit_message_caption(
-            chat_id=self.chat_id,
-            message_id=last_message_id,
-            caption="" if markup.as_html == "No Data" else markup.as_html,
-            reply_markup=markup.keyboard
-        )
+        if markup.type == "text":
+            method = EditMessageText(
+                chat_id=self.chat_id, message_id=last_message_id, text=markup.as_html, reply_markup=markup.keyboard
+            )
+        elif shown_type == markup.type and shown_media == markup.media:
+            method = EditMessageCaption(
+                chat_id=self.chat_id,
+                message_id=last_message_id,
+                caption=self._caption(markup),
+                reply_markup=markup.keyboard,
+            )
+        elif markup.type == "photo":
+            method = EditMessageMedia(
+                chat_id=self.chat_id,
+                message_id=last_message_id,
+                media=InputMediaPhoto(media=markup.photo, caption=self._caption(markup)),
+                reply_markup=markup.keyboard,
+            )
+        else:
+            method = EditMessageMedia(
+                chat_id=self.chat_id,
+                message_id=last_message_id,
+                media=InputMediaAudio(media=markup.voice, caption=self._caption(markup)),
+                reply_markup=markup.keyboard,
+            )
+        await self._outbound(method, Priority.EDIT)
+        await self._fingerprints.set_value_by_key(str(last_message_id), self._shown(markup))
         return True
 
-    async def _update_chat(self, markup: WindowBuilder | None, force=False, attempt=1) -> bool:
+    async def _update_chat(self, markup: WindowBuilder | None, force=False) -> bool:
+        """
+        Flood control and network errors are waited out and retried by Outbound,
+        a last message deleted by the user is replaced by a new one once
+        """
         await self.clear_chat(force)
+        if markup is None:
+            await self.reset()
+            return False
+
+        await markup.load_page(self)
+        markup.init()
+        await self._set_state(markup.state)
         try:
-            if markup is None:
-                await self.reset()
-            else:
-                markup.init()
-                await self._state.set_state(markup.state)
-                return await self._update_message[markup.type](markup)
-        except (IndexError, AttributeError, Exception) as e:
-            if "there is no" in e.message:
-                await self._delete_message(await self._messages_ids.get_last())
-                return await self._update_chat(markup, force)
-            if "Flood control" in e.message:
-                await sleep(1)
-                return await self._update_chat(markup, force)
-            elif "not modified" in e.message:
+            return await self._update_message(markup)
+        except TelegramBadRequest as e:
+            if "not modified" in e.message:
                 return False
-            elif "Impossible create" in e.message or attempt <= 0:
+            if not any(error in e.message for error in ("there is no", "message to edit not found", "can't be edited")):
                 raise e
-            else:
-                logger.error(f"Impossible build markup", exc_info=True)
-                await sleep(1)
-                return await self._update_chat(markup, force, attempt - 1)
+        await self._delete_message(await self._messages_ids.get_last())
+        return await self._update_message(markup)
+
+    async def _set_state(self, state: str | State | None):
+        if isinstance(state, State):
+            state = state.state
+        if state != self._raw_state:
+            await self._state.set_state(state)
+            self._raw_state = state
 
     async def clear_chat(self, force: bool = False):
-        if force:
-            messages_ids = await self._messages_ids.get()
+        """
+        Old messages stop being tracked in one write and are deleted by Outbound in the background,
+        so the next window doesn't wait for them
+        :param force: the last message too
+        """
+        messages_ids = await self._messages_ids.get()
+        if force and messages_ids:
+            await self._messages_ids.destroy()
+            await self._fingerprints.destroy()
+        elif len(messages_ids) > 1:
+            last_message_id = messages_ids.pop()
+            await self._messages_ids.keep_last()
+            fingerprint = await self._fingerprints.get_value_by_key(str(last_message_id))
+            await self._fingerprints.set({} if fingerprint is None else {str(last_message_id): fingerprint})
         else:
-            messages_ids = await self._messages_ids.get_all_except_last()
-
-        for chat_message_id in messages_ids:
-            await self._delete_message(chat_message_id)
+            return
+        self._outbound.delete(self.chat_id, messages_ids)
 
     async def _delete_message(self, message_id: int):
-        try:
-            await self._bot.delete_message(self.chat_id, message_id)
-        except TelegramBadRequest:
-            pass
         await self._messages_ids.remove(message_id)
+        await self._fingerprints.destroy_key(str(message_id))
+        self._outbound.delete(self.chat_id, (message_id,))
 
     async def _delete_task_message(self, message_id: int):
         SCHEDULER.add_job(
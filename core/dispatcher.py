@@ -1,23 +1,33 @@
-import os
+from asyncio import create_task, Event
+from logging import getLogger
+from os import getenv
 from typing import List, Type
 
 from aiogram import Dispatcher, Bot
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.storage.redis import RedisStorage, Redis
-from aiogram.types import BotCommand
+from aiogram.types import BotCommand, Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 from core import WindowBuilder, SCHEDULER, _BotCommands, BotControl
+from core.fsm import ClientStorage
 from core.handlers.abyss import abyss_router
 from core.handlers.commands import default_commands_router, group_commands
-from core.middleware import BuildBotControl
-from tools import DictStorage
+from core.fleet import UpdateStreams, StreamWorker
+from core.middleware import BuildBotControl, ConcurrencyLimit, Enqueue
+from core.outbound import Outbound
+from tools import CachedStorage, RedisPool, Storage, STORAGE_BACKEND
+from tools.metrics import METRICS
+
+logger = getLogger()
 
 
 class BuildBot:
     dispatcher = Dispatcher(
         storage=RedisStorage(
-            Redis(host=os.getenv("REDIS_HOST"), port=int(os.getenv("REDIS_PORT")))
-        )
+            Redis(connection_pool=RedisPool.get())
+        ) if STORAGE_BACKEND == "redis" else ClientStorage()
     )
 
     def __init__(
@@ -30,14 +40,88 @@ class BuildBot:
             bot_control_schema: Type[BotControl] = BotControl
     ):
         self.bot = Bot(token, default=DefaultBotProperties(parse_mode='HTML'))
-        self.bot_storage = DictStorage(f"{self.bot.id}:bot_storage")
+        self.outbound = Outbound(self.bot)
+        self.bot_storage = CachedStorage(f"{self.bot.id}:bot_storage")
         self.greetings = greetings
         self.private_title_screen = private_title_screen
         self.group_title_screen = group_title_screen
         self.routers = routers
         self.bot_control_schema = bot_control_schema
+        self._background_tasks = []
 
     async def start_polling(self, custom_commands: List[BotCommand]):
+        await self._prepare(custom_commands)
+        # getUpdates doesn't work while a webhook left by the webhook mode is set
+        await self.bot.delete_webhook()
+        await self.dispatcher.start_polling(self.bot)
+
+    async def start_webhook(
+            self,
+            custom_commands: List[BotCommand],
+            *,
+            url: str | None = None,
+            host: str = "0.0.0.0",
+            port: int = 8080,
+            path: str = "/webhook",
+            secret_token: str | None = None,
+            concurrency: int = 64,
+    ):
+        """
+        Updates come as POST requests to an aiohttp server, so several instances can run behind a load balancer.
+        Every request is answered at once and handled in the background, at most concurrency updates at a time.
+        :param url: public base url the webhook is registered at. Without it the webhook isn't registered
+        and updates can be posted to http://{host}:{port}{path} locally, in the format of telegram
+        :param secret_token: requests without it in the X-Telegram-Bot-Api-Secret-Token header get 401
+        """
+        self.dispatcher.update.outer_middleware(ConcurrencyLimit(concurrency))
+        await self._prepare(custom_commands)
+
+        app = web.Application()
+        SimpleRequestHandler(self.dispatcher, self.bot, secret_token=secret_token).register(app, path=path)
+        setup_application(app, self.dispatcher, bot=self.bot)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        try:
+            if url:
+                await self.bot.set_webhook(
+                    url.rstrip("/") + path,
+                    secret_token=secret_token,
+                    max_connections=min(concurrency, 100),
+                    allowed_updates=self.dispatcher.resolve_used_update_types(),
+                )
+            else:
+                logger.info(f"Webhook is not registered, post updates to http://{host}:{port}{path}")
+            await Event().wait()
+        finally:
+            await runner.cleanup()
+
+    def enqueue_to(self, streams: UpdateStreams):
+        """
+        Makes this process the ingress of a worker fleet: updates received by start_polling or start_webhook
+        are pushed to streams and handled by start_worker processes
+        """
+        self.dispatcher.update.outer_middleware(Enqueue(streams))
+
+    async def start_worker(self, streams: UpdateStreams, **options):
+        """
+        Handles updates pushed to streams by the ingress along with other workers, see core.fleet
+        :param options: of StreamWorker
+        """
+        await self._prepare()
+        worker = StreamWorker(streams, self._feed_update, **options)
+        try:
+            await worker.run()
+        finally:
+            await self.dispatcher.emit_shutdown(bot=self.bot)
+
+    async def _feed_update(self, update: bytes):
+        await self.dispatcher.feed_update(self.bot, Update.model_validate_json(update, context={"bot": self.bot}))
+
+    async def _prepare(self, custom_commands: List[BotCommand] | None = None):
+        """
+        :param custom_commands: set as the menu of the bot along with the default ones, workers leave the menu alone
+        """
         self.dispatcher.update.middleware(BuildBotControl(
             self.bot,
             self.bot_storage,
@@ -45,13 +129,24 @@ class BuildBot:
             self.private_title_screen,
             self.group_title_screen,
             self.bot_control_schema,
+            self.outbound,
         ))
         self.dispatcher.include_routers(default_commands_router, group_commands, *self.routers, abyss_router)
+        self.dispatcher.shutdown.register(self._shutdown)
 
         SCHEDULER.start()
+        self._background_tasks.append(create_task(self.bot_storage.listen()))
+        self._background_tasks.append(create_task(METRICS.report(float(getenv("STORAGE_METRICS_INTERVAL", 300)))))
 
-        commands = _BotCommands.commands()
-        commands.extend(custom_commands)
-        await self.bot.set_my_commands(commands)
+        if custom_commands is not None:
+            commands = _BotCommands.commands()
+            commands.extend(custom_commands)
+            await self.bot.set_my_commands(commands)
 
-        await self.dispatcher.start_polling(self.bot)
+    async def _shutdown(self):
+        for task in self._background_tasks:
+            task.cancel()
+        SCHEDULER.shutdown(wait=False)
+        logger.info(f"Redis compression: {Storage.CLIENT.serializer.stats}")
+        await Storage.CLIENT.aclose()
+        await RedisPool.close()
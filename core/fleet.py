@@ -0,0 +1,236 @@
+"""
+Updates handled by a fleet of worker processes instead of one bot process.
+
+An ingress process (BOT_MODE=ingress, polling or webhook) only pushes every update to the redis stream
+of its chat partition. Worker processes (BOT_MODE=worker) share the partitions through leases and handle
+the updates of a partition one by one, so the updates of a chat are handled in order
+and two workers never touch the same chat at once.
+"""
+from asyncio import create_task, sleep, Task, CancelledError, gather
+from logging import getLogger
+from math import ceil
+from os import getpid
+from socket import gethostname
+from time import time, monotonic
+from typing import Awaitable, Callable
+from uuid import uuid4
+from zlib import crc32
+
+from redis.exceptions import ResponseError
+
+from tools import Storage, STORAGE_BACKEND
+
+logger = getLogger()
+
+
+class UpdateStreams:
+    """
+    Updates partitioned by chat into redis streams {prefix}:{partition}, read through the consumer group.
+    A stream keeps about max_length last updates, handled or not
+    """
+
+    def __init__(self, partitions: int = 32, prefix: str = "updates", group: str = "workers", max_length: int = 10000):
+        if STORAGE_BACKEND != "redis":
+            raise ValueError(f"Worker fleet needs redis streams, STORAGE_BACKEND is {STORAGE_BACKEND}")
+        self.partitions = partitions
+        self.prefix = prefix
+        self.group = group
+        self._max_length = max_length
+
+    def key(self, partition: int) -> str:
+        return f"{self.prefix}:{partition}"
+
+    def partition(self, chat_id: int | str) -> int:
+        return crc32(str(chat_id).encode()) % self.partitions
+
+    async def push(self, chat_id: int | str, update: str):
+        """
+        :param update: update json as telegram sent it
+        """
+        await Storage.CLIENT.xadd(
+            self.key(self.partition(chat_id)), {"update": update}, maxlen=self._max_length, approximate=True
+        )
+
+    async def create_groups(self):
+        for partition in range(self.partitions):
+            try:
+                await Storage.CLIENT.xgroup_create(self.key(partition), self.group, id="0", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise e
+
+
+class StreamWorker:
+    """
+    Handles the updates of the partitions it holds leases of, one partition task each.
+    Workers announce themselves in {prefix}:workers and hold about an equal share of the partitions:
+    every lease_ttl / 3 seconds a worker renews its leases, gives away partitions over its share
+    and takes free ones up to it, so partitions of a dead worker move to the living within lease_ttl.
+
+    A partition task is cancelled as soon as the renewal of its lease fails, and stops by itself
+    when lease_ttl passed since the last renewal, so a worker doesn't handle updates of a partition another one took.
+
+    An update is acked after it is handled, even if handling failed, so a broken update doesn't stop its chat.
+    Updates a worker read but didn't ack before it died are pending in the group, the next holder of the partition
+    claims them once they are idle for lease_ttl and handles them before new ones, so the order of a chat holds.
+    """
+    # Scripts rather than SET, CustomRedis.set pickles values
+    _acquire = """
+    return redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2])
+    """
+    _renew = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    _release = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(
+            self,
+            streams: UpdateStreams,
+            handle: Callable[[bytes], Awaitable],
+            *,
+            name: str | None = None,
+            lease_ttl: float = 30,
+            block: float = 2,
+            batch_size: int = 10,
+    ):
+        """
+        :param handle: handles update json pushed by UpdateStreams.push
+        :param block: seconds a read waits for new updates
+        """
+        self._streams = streams
+        self._handle = handle
+        self.name = name or f"{gethostname()}:{getpid()}:{uuid4().hex[:8]}"
+        self._lease_ttl = lease_ttl
+        self._block = block
+        self._batch_size = batch_size
+        self._workers_key = f"{streams.prefix}:workers"
+        self._tasks: dict[int, Task] = {}
+        self._held: set[int] = set()
+        # Monotonic time the lease of a partition may expire at, counted from before the last acquire or renewal
+        self._deadlines: dict[int, float] = {}
+
+    def _lease_key(self, partition: int) -> str:
+        return f"{self._streams.key(partition)}:lease"
+
+    async def run(self):
+        await self._streams.create_groups()
+        logger.info(f"Worker {self.name} started")
+        try:
+            while True:
+                await self._balance()
+                await sleep(self._lease_ttl / 3)
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        """
+        Updates read but not handled yet stay pending for the next holders of the partitions
+        """
+        self._held.clear()
+        for task in self._tasks.values():
+            task.cancel()
+        await gather(*self._tasks.values(), return_exceptions=True)
+        client = Storage.CLIENT
+        for partition in self._tasks:
+            await client.eval(self._release, 1, self._lease_key(partition), self.name)
+        self._tasks.clear()
+        await client.zrem(self._workers_key, self.name)
+
+    async def _balance(self):
+        client = Storage.CLIENT
+        now = time()
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.zadd(self._workers_key, {self.name: now})
+            pipe.zremrangebyscore(self._workers_key, "-inf", now - self._lease_ttl)
+            pipe.zcard(self._workers_key)
+            *_, workers = await pipe.execute()
+        share = ceil(self._streams.partitions / max(workers, 1))
+        ttl = int(self._lease_ttl * 1000)
+
+        for partition in list(self._held):
+            started = monotonic()
+            if await client.eval(self._renew, 1, self._lease_key(partition), self.name, ttl):
+                self._deadlines[partition] = started + self._lease_ttl
+                continue
+            logger.warning(f"Worker {self.name} lost the lease of partition {partition}")
+            self._held.discard(partition)
+            task = self._tasks.pop(partition, None)
+            if task is not None:
+                # Another worker may hold the partition already, the update at hand stays pending for it
+                task.cancel()
+                await gather(task, return_exceptions=True)
+        for partition in sorted(self._held)[share:]:
+            # The task stops after the batch at hand, the lease is released then
+            self._held.discard(partition)
+
+        for partition, task in list(self._tasks.items()):
+            if task.done():
+                del self._tasks[partition]
+                if partition not in self._held:
+                    await client.eval(self._release, 1, self._lease_key(partition), self.name)
+
+        # Workers start looking for free partitions at different places, so they don't all race for the same ones
+        start = crc32(self.name.encode()) % self._streams.partitions
+        for offset in range(self._streams.partitions):
+            if len(self._held) >= share:
+                break
+            partition = (start + offset) % self._streams.partitions
+            if partition in self._held or partition in self._tasks:
+                continue
+            started = monotonic()
+            if await client.eval(self._acquire, 1, self._lease_key(partition), self.name, ttl):
+                self._deadlines[partition] = started + self._lease_ttl
+                self._held.add(partition)
+                self._tasks[partition] = create_task(self._consume(partition))
+
+    async def _consume(self, partition: int):
+        client = Storage.CLIENT
+        key, group = self._streams.key(partition), self._streams.group
+        # An update of another consumer idle for less than the lease may still be handled by it
+        min_idle = int(self._lease_ttl * 1000)
+        try:
+            # Left pending by the previous holders, waited for until they can be claimed
+            while partition in self._held:
+                cursor = "0-0"
+                while True:
+                    cursor, *_ = await client.xautoclaim(key, group, self.name, min_idle, cursor, count=100)
+                    if cursor in (b"0-0", "0-0"):
+                        break
+                pending = await client.xpending(key, group)
+                if all(consumer["name"] in (self.name, self.name.encode()) for consumer in pending["consumers"]):
+                    break
+                await sleep(self._lease_ttl / 3)
+
+            # Pending ones first, in stream order, then new ones
+            read_from = "0"
+            while partition in self._held:
+                response = await client.xreadgroup(
+                    group, self.name, {key: read_from}, count=self._batch_size,
+                    block=None if read_from == "0" else int(self._block * 1000),
+                )
+                entries = response[0][1] if response else []
+                if read_from == "0" and not entries:
+                    read_from = ">"
+                for entry_id, fields in entries:
+                    if monotonic() >= self._deadlines[partition]:
+                        logger.warning(f"Worker {self.name} stopped partition {partition}, its lease wasn't renewed")
+                        self._held.discard(partition)
+                        return
+                    try:
+                        await self._handle(fields[b"update"])
+                    except Exception:
+                        logger.error(f"Update {entry_id} of partition {partition} failed", exc_info=True)
+                    await client.xack(key, group, entry_id)
+        except CancelledError:
+            raise
+        except Exception:
+            logger.error(f"Worker {self.name} stopped consuming partition {partition}", exc_info=True)
+            self._held.discard(partition)
@@ -0,0 +1,39 @@
+from typing import Any, Dict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder, KeyBuilder
+
+from tools import Storage
+
+
+class ClientStorage(BaseStorage):
+    """
+    aiogram FSM storage kept by Storage.CLIENT, so state lives in the same backend as the rest of the bot
+    when it is not redis
+    """
+
+    def __init__(self, key_builder: KeyBuilder | None = None):
+        self._key_builder = key_builder or DefaultKeyBuilder()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name = self._key_builder.build(key, "state")
+        if state is None:
+            await Storage.CLIENT.delete(name)
+        else:
+            await Storage.CLIENT.set(name, state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return await Storage.CLIENT.get(self._key_builder.build(key, "state"))
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        name = self._key_builder.build(key, "data")
+        if not data:
+            await Storage.CLIENT.delete(name)
+        else:
+            await Storage.CLIENT.set(name, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return await Storage.CLIENT.get(self._key_builder.build(key, "data")) or {}
+
+    async def close(self) -> None:
+        pass
@@ -1,19 +1,65 @@
 from typing import List, Literal, Any, Iterable, TypeVar, Tuple
 
-from aiogram.types import FSInputFile
-from aiogram.utils.formatting import as_list, Text, Bold, Italic
-from aiogram.utils.keyboard import InlineKeyboardBuilder
+from copy import copy
+from hashlib import blake2b
+
+from aiogram.types import FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.formatting import Text, Bold, Italic
 
 from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.state import State
 
 from tools import Emoji
+from core.markups.pagination import PageSource, ListSource
+from core.markups.callbacks import CallbackRegistry
 
 
 T = TypeVar("T")
 
 
-class TextWidget:
+class Widget:
+    """
+    Widgets are pickled as a tuple of their slots values in __slots__ order.
+    New slots go to the end, older snapshots get their defaults from __init__.
+    """
+    __slots__ = ("_cache",)
+
+    @property
+    def rendered(self):
+        """
+        Rendered again only after some value of the widget changed. The cache is not pickled
+        """
+        state = self.__getstate__()
+        try:
+            cached_state, rendered = self._cache
+            if cached_state == state:
+                return rendered
+        except AttributeError:
+            pass
+        rendered = self._render()
+        self._cache = state, rendered
+        return rendered
+
+    def _render(self):
+        raise NotImplementedError
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state: tuple | dict):
+        if isinstance(state, dict):
+            # Widgets pickled before they had slots
+            self.__init__()
+            state = tuple(state.get(name, getattr(self, name)) for name in self.__slots__)
+        elif len(state) < len(self.__slots__):
+            self.__init__()
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class TextWidget(Widget):
+    __slots__ = "mark", "text", "mark_left", "sep"
+
     def __init__(
         self,
         *,
@@ -33,8 +79,13 @@ class TextWidget:
             return Text(self.mark) + Text(self.sep) + Bold(self.text)
         return Bold(self.text) + Text(self.sep) + Text(self.mark)
 
+    def _render(self) -> str:
+        return self.formatted_text.as_html()
+
+
+class DataTextWidget(Widget):
+    __slots__ = "mark", "mark_sep", "text", "data", "sep", "end"
 
-class DataTextWidget:
     def __init__(
         self,
         *,
@@ -56,8 +107,13 @@ class DataTextWidget:
     def formatted_text(self):
         return Text(self.mark) + Text(self.mark_sep) + Bold(self.text) + Text(self.sep) + Italic(self.data) + Italic(self.end)
 
+    def _render(self) -> str:
+        return self.formatted_text.as_html()
+
+
+class ButtonWidget(Widget):
+    __slots__ = "mark", "text", "mark_left", "sep", "callback_data"
 
-class ButtonWidget:
     def __init__(
         self,
         *,
@@ -79,6 +135,12 @@ class ButtonWidget:
             return self.mark + self.sep + self.text
         return self.text + self.sep + self.mark
 
+    def _render(self) -> InlineKeyboardButton:
+        callback_data = self.callback_data
+        if isinstance(callback_data, CallbackData):
+            callback_data = callback_data.pack()
+        return InlineKeyboardButton(text=self.formatted_text, callback_data=callback_data)
+
 
 class TextMarkupConstructor:
     def __init__(self, map_: List[DataTextWidget | TextWidget] | None = None):
@@ -99,10 +161,9 @@ class TextMarkupConstructor:
 
     @property
     def as_html(self):
-        try:
-            return (as_list(*(text.formatted_text for text in self._text_map))).as_html()
-        except IndexError:
+        if not self._text_map:
             return "No Data"
+        return "\n".join(text.rendered for text in self._text_map)
 
 
 class KeyboardMarkupConstructor:
@@ -164,24 +225,46 @@ class KeyboardMarkupConstructor:
     def keyboard(self):
         if self._keyboard_map == [[]]:
             return
-
-        markup = InlineKeyboardBuilder()
-        for buttons_row in self._keyboard_map:
-            row = InlineKeyboardBuilder()
-            for button in buttons_row:
-                row.button(text=button.formatted_text, callback_data=button.callback_data)
-            markup.attach(row)
-        return markup.as_markup()
+        return InlineKeyboardMarkup(
+            inline_keyboard=[[button.rendered for button in row] for row in self._keyboard_map if row]
+        )
 
 
 class WindowBuilder(
     TextMarkupConstructor,
     KeyboardMarkupConstructor
 ):
+    """
+    Windows are pickled as a snapshot of the attributes needed to rebuild them:
+    rows rendered by init() with their flags and the attributes named in _transient are left out,
+    the state is kept as its string. Subclasses extend _transient with attributes
+    that only live while the window is handled.
+    An attribute added later needs a class level default, so snapshots written before it still load.
+    """
     _available_types = "text", "photo", "audio"
     _no_photo = "AgACAgIAAx0Cf42o9wACA1pmg-PfOMzziFicxV7itfg34ZbwawACsN8xG3rTIEj3ZE18dVVwmQEAAwIAA20AAzUE"
     _no_audio = 'CQACAgIAAx0Cf42o9wACA11mg-WsuShax7eXPExHO9EEbPg1EgACrFIAAnrTIEiM_mvZKw3k1TUE'
 
+    _transient = ()
+    _init_flags = (
+        "_frozen_text_map_inited",
+        "_paginated_buttons_inited",
+        "_frozen_buttons_map_inited",
+        "_pagination_inited",
+        "_back_inited",
+    )
+    # Set by snapshots of older windows, derived from the class now
+    _obsolete = ("_init_map",)
+
+    _rendered = ()
+    page_source: PageSource | None = None
+    _callbacks: CallbackRegistry | None = None
+    _frozen_text_map_inited = False
+    _paginated_buttons_inited = False
+    _frozen_buttons_map_inited = False
+    _pagination_inited = False
+    _back_inited = False
+
     def __init__(
             self,
             *,
@@ -200,6 +283,7 @@ class WindowBuilder(
             temp_keyboard_map: list[list[ButtonWidget]] | None = None,
             frozen_buttons_map: list[list[ButtonWidget]] | None = None,
             paginated_buttons: list[ButtonWidget] | None = None,
+            page_source: PageSource | None = None,
             frozen_text_map: list[TextWidget | DataTextWidget] | None = None,
             auto_back: bool = True,
             back_callback_data: Literal["back", "update"] | str = "back",
@@ -214,13 +298,6 @@ class WindowBuilder(
     ):
         TextMarkupConstructor.__init__(self, temp_text_map)
         KeyboardMarkupConstructor.__init__(self, temp_keyboard_map)
-        self._init_map = {
-            "frozen_text": self._init_frozen_text_map,
-            "paginated_buttons": self._init_paginated_buttons,
-            "frozen_buttons": self._init_frozen_buttons_map,
-            "pagination": self._init_pagination,
-            "back": self._init_back,
-        }
         self.init_schema = init_schema
         self.frozen_text = TextMarkupConstructor(frozen_text_map)
         self.frozen_buttons = KeyboardMarkupConstructor(frozen_buttons_map)
@@ -232,6 +309,8 @@ class WindowBuilder(
         self._back_inited = False
 
         self.paginated_buttons = [] if paginated_buttons is None else paginated_buttons
+        # Replaces paginated_buttons for long lists, see PageSource
+        self.page_source = page_source
         # If initializing is False, a markup can correct install another markup with undoing the installation of itself
         self.initializing = True
         self._buttons_height = buttons_height
@@ -252,14 +331,97 @@ class WindowBuilder(
     def _square_window(self):
         return self._buttons_height * self.buttons_width
 
+    @property
+    def _source(self) -> PageSource:
+        if self.page_source is None:
+            return ListSource(self.paginated_buttons)
+        return self.page_source
+
     @property
     def partitioned_data(self) -> List[Any]:
-        partitioned_data = self.split(self._square_window, self.paginated_buttons)
-        return partitioned_data[self.page % len(partitioned_data)]
+        return self._source.page(self.page, self._square_window)
+
+    async def load_page(self, bot_control):
+        await self._source.load(bot_control, self.page, self._square_window)
+
+    @property
+    def _registry(self) -> CallbackRegistry:
+        if self._callbacks is None:
+            self._callbacks = CallbackRegistry()
+        return self._callbacks
+
+    @property
+    def window_id(self) -> str:
+        """
+        Id callback data carries next to the tokens of this window, see CallbackRegistry
+        """
+        return self._registry.id
+
+    def token(self, payload) -> int:
+        """
+        :return: short token of payload for callback data, see CallbackRegistry
+        """
+        return self._registry.token(payload)
+
+    def resolve(self, token: int, window: str):
+        """
+        :param window: window_id the callback data carries
+        :return: payload of token or None if this window did not give it out
+        """
+        if self._callbacks is not None:
+            return self._callbacks.resolve(token, window)
+
+    @property
+    def _init_map(self):
+        return {
+            "frozen_text": self._init_frozen_text_map,
+            "paginated_buttons": self._init_paginated_buttons,
+            "frozen_buttons": self._init_frozen_buttons_map,
+            "pagination": self._init_pagination,
+            "back": self._init_back,
+        }
 
     def init(self):
+        text_start, keyboard_start = len(self._text_map), len(self._keyboard_map)
         for display_name in self.init_schema:
             self._init_map[display_name]()
+        if len(self._text_map) > text_start or len(self._keyboard_map) > keyboard_start:
+            self._rendered = (
+                *self._rendered,
+                (text_start, len(self._text_map), keyboard_start, len(self._keyboard_map))
+            )
+
+    def __getstate__(self):
+        transient = ("_rendered", *self._init_flags, *self._transient)
+        if not self._rendered and any(getattr(self, name) for name in self._init_flags):
+            # Restored from an older snapshot, which keeps rendered rows without telling them apart
+            transient = self._transient
+        state = {name: value for name, value in self.__dict__.items() if name not in transient}
+        text_map, keyboard_map = self._text_map, self._keyboard_map
+        for text_start, text_end, keyboard_start, keyboard_end in reversed(self._rendered):
+            text_map = text_map[:text_start] + text_map[text_end:]
+            keyboard_map = keyboard_map[:keyboard_start] + keyboard_map[keyboard_end:]
+        state["_text_map"] = text_map
+        state["_keyboard_map"] = keyboard_map
+        state["frozen_text"] = self.frozen_text.text_map
+        state["frozen_buttons"] = self.frozen_buttons.keyboard_map
+        if isinstance(self.state, State):
+            state["state"] = self.state.state
+        return state
+
+    def __setstate__(self, state: dict):
+        for name in self._obsolete:
+            state.pop(name, None)
+        if isinstance(state["frozen_text"], list):
+            state["frozen_text"] = TextMarkupConstructor(state["frozen_text"])
+            state["frozen_buttons"] = KeyboardMarkupConstructor(state["frozen_buttons"])
+        self.__dict__.update(state)
+        for button in self.paginated_buttons:
+            # Buttons pickled when callback data carried names, then tokens without the window id
+            data = button.callback_data
+            if isinstance(data, CallbackData) and "window" in data.model_fields and "window" not in data.__dict__:
+                token = data.__dict__["token"] if "token" in data.__dict__ else self.token(data.__dict__["name"])
+                button.callback_data = type(data)(token=token, window=self.window_id)
 
     def __call__(self, *args, **kwargs):
         ...
@@ -282,7 +444,7 @@ class WindowBuilder(
             self._frozen_buttons_map_inited = True
 
     def _init_pagination(self):
-        if not self._pagination_inited and len(self.split(self._square_window, self.paginated_buttons)) > 1:
+        if not self._pagination_inited and self._source.count() > self._square_window:
             self.add_buttons_as_new_row(self.left, self.right)
             self._pagination_inited = True
 
@@ -294,12 +456,52 @@ class WindowBuilder(
     def reset(self):
         self.text_map = []
         self.keyboard_map = [[]]
+        self._rendered = ()
         self._frozen_text_map_inited = False
         self._paginated_buttons_inited = False
         self._frozen_buttons_map_inited = False
         self._pagination_inited = False
         self._back_inited = False
 
+    def clone(self):
+        """
+        Copy sharing the widgets of the rows and the frozen maps, so they are not rendered again.
+        Changing a widget of the rows in place changes it in both windows
+        """
+        window = self.__class__.__new__(self.__class__)
+        window.__dict__.update(self.__dict__)
+        window._text_map = list(self._text_map)
+        window._keyboard_map = [list(row) for row in self._keyboard_map]
+        window.paginated_buttons = list(self.paginated_buttons)
+        window.left, window.right, window.back = copy(self.left), copy(self.right), copy(self.back)
+        if self._callbacks is not None:
+            window._callbacks = copy(self._callbacks)
+        return window
+
+    @property
+    def media(self) -> str | None:
+        """
+        File id or path of the photo or voice the window shows, None for text
+        """
+        if self.type == "text":
+            return
+        media = self.photo if self.type == "photo" else self.voice
+        return str(getattr(media, "path", media))
+
+    @property
+    def fingerprint(self) -> bytes:
+        """
+        Digest of what the message of the window shows: media, text and keyboard.
+        Equal fingerprints mean editing the message would change nothing
+        """
+        digest = blake2b(f"{self.type}\0{self.media}\0{self.as_html}".encode(), digest_size=16)
+        for row in filter(None, self._keyboard_map):
+            digest.update(b"\1")
+            for widget in row:
+                button = widget.rendered
+                digest.update(f"\0{button.text}\0{button.callback_data}\0{button.url}".encode())
+        return digest.digest()
+
     @property
     def voice(self):
         if self._voice is None:
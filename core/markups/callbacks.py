@@ -0,0 +1,57 @@
+from secrets import token_hex
+from typing import Any, List, Hashable
+
+
+class CallbackRegistry:
+    """
+    Payloads of the buttons of a window behind short numeric tokens: callback data carries the token
+    and the id of the registry only, so it stays far below the 64 bytes allowed by telegram however long a name is,
+    and a handler resolves the token with one list lookup in the current window.
+    Tokens are given out in order and live as long as the window, the same payload always gets the same token.
+    The id is random per window, so a button of an older message doesn't resolve to a payload of another window
+    """
+    __slots__ = ("id", "payloads", "_tokens", "_inherited")
+
+    def __init__(self):
+        self.id = token_hex(3)
+        self.payloads: List[Hashable] = []
+        self._tokens: dict[Hashable, int] = {}
+        # Ids of the registries this one was copied from and how many payloads they had then
+        self._inherited: dict[str, int] = {}
+
+    def token(self, payload: Hashable) -> int:
+        try:
+            return self._tokens[payload]
+        except KeyError:
+            token = self._tokens[payload] = len(self.payloads)
+            self.payloads.append(payload)
+            return token
+
+    def resolve(self, token: int, id_: str) -> Any | None:
+        """
+        :param id_: of the registry which gave out token
+        :return: None for a token given out by another window
+        """
+        count = len(self.payloads) if id_ == self.id else self._inherited.get(id_, 0)
+        if 0 <= token < count:
+            return self.payloads[token]
+
+    def __copy__(self):
+        """
+        The copy gives out tokens under its own id, tokens given out before stay valid in both
+        """
+        registry = CallbackRegistry()
+        registry.payloads = list(self.payloads)
+        registry._tokens = dict(self._tokens)
+        registry._inherited = {**self._inherited, self.id: len(self.payloads)}
+        return registry
+
+    def __getstate__(self):
+        return self.id, self.payloads, self._inherited
+
+    def __setstate__(self, state: tuple[str, List[Hashable], dict[str, int]] | List[Hashable]):
+        if isinstance(state, list):
+            # Registries pickled before they had ids, their buttons carry no id and are refreshed
+            state = token_hex(3), state, {}
+        self.id, self.payloads, self._inherited = state
+        self._tokens = {payload: token for token, payload in enumerate(self.payloads)}
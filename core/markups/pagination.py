@@ -0,0 +1,97 @@
+from math import ceil
+from typing import List, Any, TYPE_CHECKING
+
+from tools import Storage
+
+if TYPE_CHECKING:
+    from core import BotControl
+    from core.markups import ButtonWidget
+
+
+class PageSource:
+    """
+    Paginated buttons of a window computed a page at a time: the window asks for page number of size buttons
+    and for the count of all buttons, so a render costs the same for 30 buttons and for tens of thousands.
+    Page numbers wrap around, so flipping left from the first page shows the last one.
+    """
+
+    async def load(self, bot_control: "BotControl", number: int, size: int):
+        """
+        Fetches what count() and page() need, awaited before every render. Sources kept in the window need nothing
+        :param bot_control: of the update, storages read through it share its unit of work
+        """
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def page(self, number: int, size: int) -> List["ButtonWidget"]:
+        raise NotImplementedError
+
+    def pages(self, size: int) -> int:
+        return max(ceil(self.count() / size), 1)
+
+
+class ListSource(PageSource):
+    """
+    Items kept in the window, button() builds the buttons of the shown page only
+    """
+
+    def __init__(self, items: List[Any]):
+        self.items = items
+
+    def count(self) -> int:
+        return len(self.items)
+
+    def page(self, number: int, size: int) -> List["ButtonWidget"]:
+        start = number % self.pages(size) * size
+        return [self.button(index, self.items[index]) for index in range(start, min(start + size, len(self.items)))]
+
+    def button(self, index: int, item: Any) -> "ButtonWidget":
+        """
+        :param index: index of item in items
+        """
+        return item
+
+
+class SortedSetSource(PageSource):
+    """
+    Members of a redis sorted set in score order, members of equal scores in the order of sorted().
+    A render reads one page with ZRANGE and the count with ZCARD, the window keeps only that page.
+    button() builds the buttons of the page
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._count = 0
+        self._start = 0
+        self._members: List[bytes] = []
+
+    async def load(self, bot_control: "BotControl", number: int, size: int):
+        start = max(number, 0) * size
+        async with Storage.CLIENT.pipeline(transaction=False) as pipe:
+            pipe.zcard(self.key)
+            pipe.zrange(self.key, start, start + size - 1)
+            self._count, self._members = await pipe.execute()
+        if start != number % self.pages(size) * size:
+            start = number % self.pages(size) * size
+            self._members = await Storage.CLIENT.zrange(self.key, start, start + size - 1)
+        self._start = start
+
+    def count(self) -> int:
+        return self._count
+
+    def page(self, number: int, size: int) -> List["ButtonWidget"]:
+        return [self.button(self._start + i, member.decode()) for i, member in enumerate(self._members)]
+
+    def button(self, index: int, member: str) -> "ButtonWidget":
+        """
+        :param index: rank of member in the sorted set
+        """
+        return member
+
+    def loaded(self, index: int) -> str | None:
+        """
+        :return: member of rank index if it is on the page loaded last
+        """
+        if 0 <= index - self._start < len(self._members):
+            return self._members[index - self._start].decode()
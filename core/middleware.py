@@ -1,3 +1,4 @@
+from asyncio import Semaphore
 from logging import getLogger
 from typing import Any, Dict, Callable, Awaitable, Type
 
@@ -6,11 +7,50 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import Update
 
 from core import BotControl
+from core.fleet import UpdateStreams
+from core.outbound import Outbound
 from core.markups import Info, WindowBuilder
-from tools import Emoji, DictStorage
+from tools import Emoji, DictStorage, HashStorage, UnitOfWork
 
 logger = getLogger()
 
+
+class ConcurrencyLimit(BaseMiddleware):
+    """
+    Outer update middleware, at most limit updates are handled at once and the rest wait their turn
+    """
+
+    def __init__(self, limit: int):
+        self._semaphore = Semaphore(limit)
+
+    async def __call__(
+            self,
+            handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any],
+    ) -> Any:
+        async with self._semaphore:
+            return await handler(event, data)
+
+
+class Enqueue(BaseMiddleware):
+    """
+    Outer update middleware of the ingress process, pushes updates to the worker fleet instead of handling them
+    """
+
+    def __init__(self, streams: UpdateStreams):
+        self._streams = streams
+
+    async def __call__(
+            self,
+            handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any],
+    ) -> Any:
+        chat = data.get("event_chat")
+        await self._streams.push(0 if chat is None else chat.id, event.model_dump_json(exclude_unset=True, by_alias=True))
+
+
 class BuildBotControl(BaseMiddleware):
     def __init__(
             self,
@@ -19,7 +59,8 @@ class BuildBotControl(BaseMiddleware):
             greetings: WindowBuilder,
             private_title_screen: WindowBuilder,
             group_title_screen: WindowBuilder,
-            bot_control_schema: Type[BotControl]
+            bot_control_schema: Type[BotControl],
+            outbound: Outbound,
     ):
         self._bot = bot
         self._bot_storage = bot_storage
@@ -27,6 +68,7 @@ class BuildBotControl(BaseMiddleware):
         self._private_title_screen = private_title_screen
         self._group_title_screen = group_title_screen
         self._bot_control_schema = bot_control_schema
+        self._outbound = outbound
 
     async def __call__(
             self,
@@ -34,7 +76,8 @@ class BuildBotControl(BaseMiddleware):
             event: Update,
             data: Dict[str, Any],
     ) -> Any:
-        bot_control = await self._build_bot_control(event, data["state"])
+        unit = UnitOfWork()
+        bot_control = await self._build_bot_control(event, data["state"], unit, data.get("raw_state"))
         data["bot_control"] = bot_control
         try:
             return await handler(event, data)
@@ -45,8 +88,13 @@ class BuildBotControl(BaseMiddleware):
             except (ValueError, BaseException) as e:
                 logger.critical("Something went wrong", exc_info=True)
                 raise e
+        finally:
+            await unit.flush()
 
-    async def _build_bot_control(self, event, state: FSMContext):
+    async def _build_bot_control(self, event, state: FSMContext, unit: UnitOfWork, raw_state: str | None):
+        """
+        user_storage and chat lists of bot_control are bound to unit, bot_storage is shared between chats and is not
+        """
         bot_control = self._bot_control_schema(
             bot=self._bot,
             chat_id=str(await self._extract_chat_id(event)),
@@ -55,7 +103,10 @@ class BuildBotControl(BaseMiddleware):
             private_title_screen=self._private_title_screen,
             group_title_screen=self._group_title_screen,
             bot_storage=self._bot_storage,
-            user_storage=DictStorage(f"{await self._extract_user_id(event)}:user_storage"),
+            user_storage=HashStorage(f"{await self._extract_user_id(event)}:user_storage", unit),
+            unit=unit,
+            raw_state=raw_state,
+            outbound=self._outbound,
         )
         return bot_control
 
@@ -0,0 +1,187 @@
+from asyncio import Future, Task, create_task, get_running_loop, sleep
+from enum import IntEnum
+from heapq import heappop, heappush
+from itertools import count
+from logging import getLogger
+from random import uniform
+from time import monotonic
+from typing import Any, Iterable
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramEntityTooLarge, TelegramBadRequest,
+    TelegramAPIError
+)
+from aiogram.methods import TelegramMethod, DeleteMessages
+
+logger = getLogger()
+
+
+class Priority(IntEnum):
+    """
+    Lower goes first: edits answer a user who is looking at the chat, new messages may wait a bit,
+    deletions and broadcasts nobody waits for
+    """
+    EDIT = 0
+    SEND = 1
+    BACKGROUND = 2
+
+
+class TokenBucket:
+    """
+    :param rate: tokens added per second
+    :param capacity: tokens a burst can take at once
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        """
+        :return: seconds until a token is available, 0 if it is now
+        """
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self._rate)
+
+    def take(self):
+        self._refill()
+        self._tokens -= 1
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self._tokens >= self._capacity
+
+
+class PriorityGate:
+    """
+    Lets requests through as the bucket allows, the waiting request of the lowest priority first,
+    requests of one priority in arrival order. pause() holds everybody, for telegram's retry_after
+    """
+
+    def __init__(self, bucket: TokenBucket):
+        self._bucket = bucket
+        self._waiters: list[tuple[int, int, Future]] = []
+        self._order = count()
+        self._paused_until = 0.0
+        self._drainer: Task | None = None
+
+    def _delay(self) -> float:
+        return max(self._bucket.delay(), self._paused_until - monotonic())
+
+    async def acquire(self, priority: int):
+        if not self._waiters and self._delay() <= 0:
+            self._bucket.take()
+            return
+        future = get_running_loop().create_future()
+        heappush(self._waiters, (priority, next(self._order), future))
+        if self._drainer is None or self._drainer.done():
+            self._drainer = create_task(self._drain())
+        await future
+
+    async def _drain(self):
+        while self._waiters:
+            if (delay := self._delay()) > 0:
+                await sleep(delay)
+                continue
+            *_, future = heappop(self._waiters)
+            # A cancelled waiter gives its turn to the next one
+            if not future.done():
+                self._bucket.take()
+                future.set_result(None)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        return not self._waiters and self._paused_until <= monotonic() and self._bucket.full
+
+
+class Outbound:
+    """
+    Every request of BotControl to telegram goes through here.
+    A request waits for a token of its chat and then of the whole bot, so the bot stays under telegram limits
+    instead of running into flood control, and a burst waits in line by priority.
+    retry_after of flood control pauses the chat for that long, network and server errors are retried
+    after a jittered exponential backoff, at most attempts times in all, then the error is raised
+    """
+    # Telegram allows about 30 messages per second in all, a message per second in a chat and 20 per minute in a group
+    GLOBAL_RATE = 30
+    PRIVATE_RATE = 1
+    GROUP_RATE = 20 / 60
+    CHAT_BURST = 5
+    MAX_IDLE_CHATS = 1000
+    DELETE_BATCH_SIZE = 100
+
+    def __init__(self, bot: Bot, attempts: int = 4, backoff: float = 0.5, max_backoff: float = 10):
+        self._bot = bot
+        self._attempts = attempts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._global = PriorityGate(TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE))
+        self._chats: dict[str, PriorityGate] = {}
+        self._deletions: dict[str, list[int]] = {}
+        self._deleters: dict[str, Task] = {}
+
+    def _chat(self, chat_id: int | str) -> PriorityGate:
+        chat_id = str(chat_id)
+        try:
+            return self._chats[chat_id]
+        except KeyError:
+            pass
+        if len(self._chats) >= self.MAX_IDLE_CHATS:
+            self._chats = {id_: gate for id_, gate in self._chats.items() if not gate.idle}
+        rate = self.GROUP_RATE if chat_id.startswith("-") else self.PRIVATE_RATE
+        gate = self._chats[chat_id] = PriorityGate(TokenBucket(rate, self.CHAT_BURST))
+        return gate
+
+    async def __call__(self, method: TelegramMethod, priority: Priority = Priority.SEND) -> Any:
+        chat = self._chat(method.chat_id)
+        for attempt in range(1, self._attempts + 1):
+            await chat.acquire(priority)
+            await self._global.acquire(priority)
+            try:
+                return await self._bot(method)
+            except TelegramRetryAfter as e:
+                if attempt == self._attempts:
+                    raise e
+                logger.warning(f"Flood control in chat {method.chat_id}, retry in {e.retry_after} s")
+                chat.pause(e.retry_after + uniform(0, self._backoff))
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt == self._attempts or isinstance(e, TelegramEntityTooLarge):
+                    raise e
+                await sleep(uniform(0, min(self._max_backoff, self._backoff * 2 ** attempt)))
+
+    def delete(self, chat_id: int | str, messages_ids: Iterable[int]):
+        """
+        Queues messages of the chat for deletion and returns at once.
+        A worker of the chat deletes them with deleteMessages, queued meanwhile ids join the next batch
+        """
+        chat_id = str(chat_id)
+        self._deletions.setdefault(chat_id, []).extend(messages_ids)
+        if chat_id not in self._deleters:
+            self._deleters[chat_id] = create_task(self._delete(chat_id))
+
+    async def _delete(self, chat_id: str):
+        try:
+            while queue := self._deletions.pop(chat_id, None):
+                for start in range(0, len(queue), self.DELETE_BATCH_SIZE):
+                    batch = queue[start:start + self.DELETE_BATCH_SIZE]
+                    try:
+                        await self(DeleteMessages(chat_id=chat_id, message_ids=batch), Priority.BACKGROUND)
+                    except TelegramBadRequest:
+                        # None of the messages can be deleted anymore, they are older than 48 hours or gone
+                        pass
+                    except TelegramAPIError:
+                        logger.warning(f"Messages {batch} of chat {chat_id} are not deleted", exc_info=True)
+        finally:
+            del self._deleters[chat_id]
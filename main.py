@@ -4,16 +4,21 @@ from os import getenv
 from admin import GroupTitleScreen
 from admin.english import admin_english_router
 from admin.shop import admin_shop_router
+from api import SuperEnglishDictionary
 from user import PrivateTitleScreen, Greetings
 from user.english import english_router
 
 from user.shop import private_shop_router
 from core.dispatcher import BuildBot
+from core.fleet import UpdateStreams
+from tools import Storage
 from user.commands import commands_router, BotCommands
 
 
 async def main():
-    await BuildBot(
+    await Storage.CLIENT.initialize()
+    await SuperEnglishDictionary.migrate_caches()
+    bot = BuildBot(
         commands_router,
         english_router,
         admin_english_router,
@@ -23,7 +28,28 @@ async def main():
         private_title_screen=PrivateTitleScreen(),
         group_title_screen=GroupTitleScreen(),
         greetings=Greetings(),
-    ).start_polling(BotCommands.commands())
+    )
+    mode = getenv("BOT_MODE", "polling")
+    if mode in ("ingress", "worker"):
+        streams = UpdateStreams(int(getenv("FLEET_PARTITIONS", 32)))
+        if mode == "worker":
+            await bot.start_worker(streams)
+            return
+        bot.enqueue_to(streams)
+        mode = getenv("INGRESS_MODE", "polling")
+
+    if mode == "webhook":
+        await bot.start_webhook(
+            BotCommands.commands(),
+            url=getenv("WEBHOOK_URL"),
+            host=getenv("WEBHOOK_HOST", "0.0.0.0"),
+            port=int(getenv("WEBHOOK_PORT", 8080)),
+            path=getenv("WEBHOOK_PATH", "/webhook"),
+            secret_token=getenv("WEBHOOK_SECRET") or None,
+            concurrency=int(getenv("WEBHOOK_CONCURRENCY", 64)),
+        )
+    else:
+        await bot.start_polling(BotCommands.commands())
 
 
 if __name__ == "__main__":
@@ -1,7 +1,7 @@
 import logging
 from collections import defaultdict
 from math import ceil
-from typing import Literal, List, Dict
+from typing import Literal, List, Dict, Iterable
 import string
 from random import choice
 
@@ -9,25 +9,143 @@ import Levenshtein
 from aiogram.filters.callback_data import CallbackData
 
 from FSM import States
-from api import WordCard, SuperEnglishDictionary
+from api import WordCard, SuperEnglishDictionary, CardRef
 from core import BotControl
 from core.markups import DataTextWidget, TextWidget, ButtonWidget, WindowBuilder
-from tools import Emoji, create_progress_text
+from core.markups.pagination import PageSource, ListSource, SortedSetSource
+from tools import Emoji, create_progress_text, Storage, DictStorage
+from tools.metrics import scoped
 from config import DECK_SIZE
 
 logger = logging.getLogger()
 
 
-class WordTickCallbackData(CallbackData, prefix="word_tick"):
+# Ticks of keyboards sent before carried the index of the button under the prefix word_tick
+class WordTickCallbackData(CallbackData, prefix="tick_word"):
     index: int
+    window: str
 
 
 class EditWordCallbackData(CallbackData, prefix="edit_word"):
-    word: str
+    token: int
+    window: str
 
 
 class ResetWordCallbackData(CallbackData, prefix="reset_word"):
-    word: str
+    token: int
+    window: str
+
+
+class WordsIndex:
+    """
+    Words of bot_storage kept for windows paging through them: every word in the sorted set {key}:words,
+    words having parts of speech in {key}:learnable_words with the size of their knowledge schema
+    in the hash {key}:knowledge_sizes. Updated when the words change
+    """
+
+    def __init__(self, bot_storage: DictStorage):
+        self.words_key = f"{bot_storage.key}:words"
+        self.learnable_key = f"{bot_storage.key}:learnable_words"
+        self.sizes_key = f"{bot_storage.key}:knowledge_sizes"
+
+    async def ensure(self, words: set[str]):
+        """
+        Builds the index of words kept before there was one
+        """
+        if words and not await Storage.CLIENT.exists(self.words_key):
+            await self.update(words)
+
+    async def update(self, words: set[str], refreshed: Iterable[str] = ()):
+        """
+        Looks up only the words added since the last update and refreshed ones
+        """
+        indexed = {word.decode() for word in await Storage.CLIENT.zrange(self.words_key, 0, -1)}
+        removed = indexed - words
+        sizes, unlearnable = {}, set()
+        for word in (words - indexed) | (words & set(refreshed)):
+            data = await SuperEnglishDictionary.extract_data(word)
+            if data["pos"]:
+                sizes[word] = len(SuperEnglishDictionary.build_knowledge_schema(data))
+            else:
+                unlearnable.add(word)
+        async with Storage.CLIENT.pipeline(transaction=True) as pipe:
+            if words - indexed:
+                pipe.zadd(self.words_key, dict.fromkeys(words - indexed, 0))
+            if sizes:
+                pipe.zadd(self.learnable_key, dict.fromkeys(sizes, 0))
+                pipe.hset(self.sizes_key, mapping=sizes)
+            if removed | unlearnable:
+                pipe.zrem(self.learnable_key, *removed | unlearnable)
+                pipe.hdel(self.sizes_key, *removed | unlearnable)
+            if removed:
+                pipe.zrem(self.words_key, *removed)
+            await pipe.execute()
+
+    async def sizes(self) -> Dict[str, int]:
+        """
+        :return: knowledge sizes of all learnable words
+        """
+        async with Storage.CLIENT.pipeline(transaction=False) as pipe:
+            pipe.hgetall(self.sizes_key)
+            sizes, = await pipe.execute()
+        return {word.decode(): int(size) for word, size in sizes.items()}
+
+
+class EditWordsSource(PageSource):
+    """
+    Words of EditEnglish from words, a source of plain words, each followed by its edit and reset buttons
+    when columns is 3. Callback data carries the index of a word, resolved by the words of the shown page,
+    and window, the window_id of EditEnglish
+    """
+    window = ""
+
+    def __init__(self, words: PageSource, columns: int, window: str):
+        self.words = words
+        self.columns = columns
+        self.window = window
+        self.denied: set[str] = set()
+        self.first = 0
+        self.shown: List[str] = []
+
+    def __setstate__(self, state: dict):
+        if "items" in state:
+            # Sources which kept the words themselves and the indexes of denied ones
+            words = state.pop("items")
+            state.update(
+                words=ListSource(words), denied={words[i] for i in state["denied"]}, first=0, shown=[]
+            )
+        self.__dict__.update(state)
+
+    async def load(self, bot_control: BotControl, number: int, size: int):
+        await self.words.load(bot_control, number, size // self.columns)
+
+    def count(self) -> int:
+        return self.words.count() * self.columns
+
+    def page(self, number: int, size: int) -> List[ButtonWidget]:
+        size //= self.columns
+        self.first = number % self.words.pages(size) * size
+        self.shown = self.words.page(number, size)
+        return [button for index, word in enumerate(self.shown, self.first) for button in self._buttons(index, word)]
+
+    def _buttons(self, index: int, word: str) -> List[ButtonWidget]:
+        buttons = [ButtonWidget(
+            mark=Emoji.DENIAL if word in self.denied else Emoji.OK,
+            text=word,
+            callback_data=WordTickCallbackData(index=index, window=self.window)
+        )]
+        if self.columns == 3:
+            buttons.append(ButtonWidget(
+                text=Emoji.PENCIL, callback_data=EditWordCallbackData(token=index, window=self.window)
+            ))
+            buttons.append(ButtonWidget(
+                text=Emoji.CYCLE, callback_data=ResetWordCallbackData(token=index, window=self.window)
+            ))
+        return buttons
+
+    def resolve(self, index: int) -> str | None:
+        if 0 <= index - self.first < len(self.shown):
+            return self.shown[index - self.first]
 
 
 class EditEnglish(WindowBuilder):
@@ -35,10 +153,13 @@ class EditEnglish(WindowBuilder):
         "edit": f"Edit English Run {Emoji.LIST_WITH_PENCIL}",
         "add": "I have some offer from the community"
     }
+    _obsolete = (*WindowBuilder._obsolete, "_temp_words")
 
-    def __init__(self, action_type: Literal["add", "edit"], words: set[str]):
+    def __init__(self, action_type: Literal["add", "edit"], words: PageSource):
+        """
+        :param words: source of plain words, the offer or all words of WordsIndex
+        """
         self.action_type = action_type
-        self._temp_words = words
         super().__init__(
             frozen_text_map=[
                 TextWidget(text=self._prompt[action_type])
@@ -47,72 +168,67 @@ class EditEnglish(WindowBuilder):
         if action_type == "edit":
             self.back.text = f"Save and exit {Emoji.FLOPPY_DISC}"
             self.back.callback_data = "merge_words"
-            self._words_with_edit_display()
+            self.buttons_width = 3
         if action_type == "add":
-            self._only_words_display()
             self._add_save_button()
             self._dismiss_frozen_display()
-            
+        self.page_source = EditWordsSource(words, self.buttons_width, self.window_id)
+
+    def __setstate__(self, state: dict):
+        buttons = state.get("paginated_buttons")
+        if buttons and state.get("page_source") is None:
+            # Windows built before the words had a page source
+            ticks = [button for button in buttons if isinstance(button.callback_data, WordTickCallbackData)]
+            source = EditWordsSource(ListSource([button.text for button in ticks]), state["buttons_width"], "")
+            source.denied = {button.text for button in ticks if button.mark == Emoji.DENIAL}
+            state["page_source"], state["paginated_buttons"] = source, []
+        super().__setstate__(state)
+        if not self.page_source.window:
+            # Sources built before the buttons carried the window id
+            self.page_source.window = self.window_id
+
     def _add_save_button(self):
         self.frozen_buttons.add_buttons_in_last_row(ButtonWidget(text=f"{Emoji.FLOPPY_DISC} Save", callback_data="merge_words"))
 
-    def _words_with_edit_display(self):
-        self.buttons_width = 3
-
-        buttons = []
-        for i, word in enumerate(self._temp_words):
-            buttons.append(ButtonWidget(
-                          mark=Emoji.OK,
-                          text=word,
-                          callback_data=WordTickCallbackData(index=i * self.buttons_width)
-                      ))
-            buttons.append(ButtonWidget(
-                text=Emoji.PENCIL,
-                callback_data=EditWordCallbackData(word=word)
-            ))
-            buttons.append(ButtonWidget(
-                text=Emoji.CYCLE,
-                callback_data=ResetWordCallbackData(word=word)
-            ))
-
-        self.paginated_buttons = buttons
-
-    def _only_words_display(self):
-        self.paginated_buttons = [ButtonWidget(
-            mark=Emoji.OK,
-            text=word,
-            callback_data=WordTickCallbackData(index=i)
-        ) for i, word in enumerate(self._temp_words)]
-
     def _dismiss_frozen_display(self):
         self.frozen_buttons.add_buttons_as_new_row(ButtonWidget(
             text=f"{Emoji.DENIAL} Dismiss", callback_data="drop_offer"
         ))
 
+    @scoped("English")
     async def merge_words(self, bot_control: BotControl):
         words = await bot_control.bot_storage.get_value_by_key("words", set())
+        source: EditWordsSource = self.page_source
 
         if self.action_type == "add":
-            for word_button in self.paginated_buttons:
-                if word_button.mark == Emoji.OK:
-                    words.add(word_button.text)
+            words.update(word for word in source.words.items if word not in source.denied)
             await bot_control.bot_storage.destroy_key("offer")
         else:
-            for word_button in self.paginated_buttons:
-                if word_button.mark == Emoji.DENIAL:
-                    words.remove(word_button.text)
+            words.difference_update(source.denied)
 
         await bot_control.bot_storage.set_value_by_key("words", words)
-
-    def marking_words(self, index: int):
-        if self.paginated_buttons[index].mark == Emoji.OK:
-            self.paginated_buttons[index].mark = Emoji.DENIAL
-        else:
-            self.paginated_buttons[index].mark = Emoji.OK
+        await WordsIndex(bot_control.bot_storage).update(words)
+
+    def resolve(self, token: int, window: str) -> str | None:
+        """
+        Tokens are indexes of the words, see EditWordsSource
+        """
+        if window == self.window_id:
+            return self.page_source.resolve(token)
+
+    def marking_words(self, index: int, window: str):
+        """
+        :param index: index of the word, a word not on the shown page is left as is
+        """
+        word = self.resolve(index, window)
+        if word is not None:
+            self.page_source.denied ^= {word}
 
     @staticmethod
-    async def reset_word(word: str):
+    async def reset_word(bot_control: BotControl, word: str):
         await SuperEnglishDictionary.extract_data(word, cache=False)
+        words = await bot_control.bot_storage.get_value_by_key("words", set())
+        await WordsIndex(bot_control.bot_storage).update(words, refreshed=(word,))
 
 
 class SuggestWords(WindowBuilder):
@@ -159,8 +275,18 @@ def knowledge_as_progress_string(user_knowledge: Dict, knowledge_border: int, sh
 
 class English(WindowBuilder):
     _cleaner = str.maketrans("", "", string.punctuation.replace("-", "") + "№")
-
-    def __init__(self, deck: List[WordCard]):
+    # Loaded by process_answer and written back before it returns, the card is built again from its reference
+    _transient = ("_temp_en_ru_statistic", "_temp_knowledge", "_temp_current_card")
+    _obsolete = (*WindowBuilder._obsolete, "_calculators", "_grades_displaces")
+    _temp_en_ru_statistic = None
+    _temp_knowledge = None
+    _temp_current_card: WordCard | None = None
+    _temp_current_ref: CardRef | None = None
+
+    def __init__(self, deck: List[CardRef]):
+        """
+        :param deck: shuffled card references, draw_card() shows the first card
+        """
         super().__init__(
             state=States.input_text_word_translate,
             back_callback_data="request_to_flush_run",
@@ -168,6 +294,7 @@ class English(WindowBuilder):
         )
         self._deck = deck
         self._deck_size = len(deck)
+        self._temp_current_ref: CardRef | None = None
         self._temp_current_card: WordCard | None = None
 
         self._temp_knowledge: Dict | None = None
@@ -188,20 +315,39 @@ class English(WindowBuilder):
 
         self._temp_en_ru_statistic = None
 
-        self._calculators = {
+    def __setstate__(self, state: dict):
+        deck = state.get("_deck")
+        if deck and isinstance(deck[0], WordCard):
+            # Runs started when the deck held whole cards
+            state["_deck"] = [card.ref for card in deck]
+            card = state.pop("_temp_current_card", None)
+            state["_temp_current_ref"] = None if card is None else card.ref
+        super().__setstate__(state)
+
+    async def _load_current_card(self):
+        if self._temp_current_card is None:
+            self._temp_current_card = await SuperEnglishDictionary.draw_card(self._temp_current_ref)
+
+    @property
+    def _calculators(self):
+        return {
             "default:en-ru": self._calc_default_en_ru,
             "default:ru-en": self._calc_default_ru_en,
             "example:ru-en": self._calc_example,
             "example:en-ru": self._calc_example
         }
-        self._grades_displaces = {
+
+    @property
+    def _grades_displaces(self):
+        return {
             "p": self._perfectly,
             "g": self._good,
             "b": self._bad
         }
-        self.draw_card()
 
+    @scoped("English")
     async def process_answer(self, answer: str, bot_control: BotControl):
+        await self._load_current_card()
         self.type = "text"
         self.state = None
         self._count_possible_right_answers += 1
@@ -217,11 +363,8 @@ class English(WindowBuilder):
         self._temp_knowledge = user_knowledge
         await bot_control.user_storage.set_value_by_key("english:knowledge", user_knowledge)
 
-        new_dna = await bot_control.user_storage.get_value_by_key("english:total_dna", 0) + self._temp_dna
-        await bot_control.user_storage.set_value_by_key("english:total_dna", new_dna)
-
-        new_keys = await bot_control.user_storage.get_value_by_key("english:keys", 0) + self._temp_cube
-        await bot_control.user_storage.set_value_by_key("english:keys", new_keys)
+        await bot_control.user_storage.increment("english:total_dna", self._temp_dna)
+        await bot_control.user_storage.increment("english:keys", self._temp_cube)
 
         self._stage_display()
         self._word_info_display()
@@ -419,10 +562,16 @@ class English(WindowBuilder):
             ButtonWidget(text=f"{Emoji.PLAY} Next", callback_data="draw_card")
         )
 
-    def draw_card(self):
+    async def draw_card(self):
+        """
+        :raise IndexError: the deck is over
+        """
         self.type = "text"
         self.state = States.input_text_word_translate
-        card = self._deck.pop()
+        card = None
+        while card is None:
+            self._temp_current_ref = self._deck.pop()
+            card = await SuperEnglishDictionary.draw_card(self._temp_current_ref)
         self._temp_current_card = card
         self._question_display()
 
@@ -434,7 +583,8 @@ class English(WindowBuilder):
             self.add_texts_rows(DataTextWidget(text=f"\n{Emoji.ALCHEMY} {self._temp_current_card.question_text}",
                                                data=self._temp_current_card.question))
 
-    def reference(self):
+    async def reference(self):
+        await self._load_current_card()
         self.back.text = Emoji.BACK
         self.back.callback_data = "back"
         self.type = "text"
@@ -483,11 +633,51 @@ class English(WindowBuilder):
 
 
 class BanWordCallbackData(CallbackData, prefix="ban_word"):
-    word: str
-    index: int
+    token: int
+    window: str
+
+
+class InspectWordsSource(SortedSetSource):
+    """
+    Learnable words of WordsIndex with the knowledge progress of the user read for the shown page only,
+    and the words banned by the user
+    """
+
+    def __init__(self, index: WordsIndex, banned: set[str], window: str):
+        """
+        :param window: window_id of InspectEnglishRun
+        """
+        super().__init__(index.learnable_key)
+        self.sizes_key = index.sizes_key
+        self.banned = banned
+        self.window = window
+        self._progresses: List[str] = []
+
+    async def load(self, bot_control: BotControl, number: int, size: int):
+        await super().load(bot_control, number, size)
+        if not self._members:
+            self._progresses = []
+            return
+        sizes = await Storage.CLIENT.hmget(self.sizes_key, self._members)
+        knowledge = await bot_control.user_storage.get_value_by_key("english:knowledge", {})
+        self._progresses = [
+            knowledge_as_progress_string(knowledge.get(member.decode(), {}), int(size or 0), show_digits=False)
+            for member, size in zip(self._members, sizes)
+        ]
+
+    def button(self, index: int, member: str) -> ButtonWidget:
+        return ButtonWidget(
+            text=f"{member} {self._progresses[index - self._start]}",
+            mark=Emoji.DENIAL if member in self.banned else Emoji.OK,
+            callback_data=BanWordCallbackData(token=index, window=self.window)
+        )
 
 
 class InspectEnglishRun(WindowBuilder):
+    _stars = 0
+    _possible_stars = 0
+    _learnable = 0
+
     def __init__(self):
         super().__init__(
             frozen_buttons_map=[
@@ -498,54 +688,62 @@ class InspectEnglishRun(WindowBuilder):
             ],
         )
 
+    def __setstate__(self, state: dict):
+        source = state.get("page_source")
+        if state.get("paginated_buttons") or (source is not None and not hasattr(source, "key")):
+            # Windows which kept all the words, read again by the next call
+            state["page_source"], state["paginated_buttons"] = None, []
+        super().__setstate__(state)
+
+    @scoped("English")
     async def __call__(self, bot_control: BotControl):
-        words = await bot_control.bot_storage.get_value_by_key("words")
-        words_ = []
-        for word in words:
-            data = await SuperEnglishDictionary.extract_data(word)
-            if data["pos"]:
-                knowledge_size = len(SuperEnglishDictionary.build_knowledge_schema(data))
-                words_.append((word, knowledge_size))
+        """
+        Totals are counted once per window, flipping pages and banning read only the shown page
+        """
+        if self.page_source is None:
+            await self._read_words(bot_control)
+        deck_size = self._learnable - len(self.page_source.banned)
+        self.add_texts_rows(
+            TextWidget(text=f"{Emoji.STAR} {self._stars}/{self._possible_stars}"),
+            TextWidget(text=f"{Emoji.PUZZLE} {deck_size}/{DECK_SIZE} {Emoji.OK if deck_size >= DECK_SIZE else Emoji.DENIAL}")
+        )
 
+    def resolve(self, token: int, window: str) -> str | None:
+        """
+        Tokens are ranks of the words, resolved by the shown page
+        """
+        if self.page_source is not None and window == self.window_id:
+            return self.page_source.loaded(token)
+
+    async def _read_words(self, bot_control: BotControl):
+        index = WordsIndex(bot_control.bot_storage)
+        await index.ensure(await bot_control.bot_storage.get_value_by_key("words", set()))
+        sizes = await index.sizes()
         knowledge = await bot_control.user_storage.get_value_by_key("english:knowledge", {})
         ban_list = await bot_control.user_storage.get_value_by_key("english:ban_list", set())
-        buttons = []
-        stars = 0
-        possible_star = 0
-        for i, x in enumerate(words_):
-            word, knowledge_size = x
+        self._stars = 0
+        self._possible_stars = 0
+        for word, knowledge_size in sizes.items():
             progress = knowledge_as_progress_string(knowledge.get(word, {}), knowledge_size, show_digits=False)
-            stars += progress.count(Emoji.STAR)
-            possible_star += len(progress)
-            buttons.append(ButtonWidget(
-                text=f"{word} {progress}",
-                mark=Emoji.OK if word not in ban_list else Emoji.DENIAL,
-                callback_data=BanWordCallbackData(index=i, word=word)
-            ))
-        self.paginated_buttons = buttons
-        deck_size = len(words_) - len(ban_list)
-        self.add_texts_rows(
-            TextWidget(text=f"{Emoji.STAR} {stars}/{possible_star}"),
-            TextWidget(text=f"{Emoji.PUZZLE} {deck_size}/{DECK_SIZE} {Emoji.OK if deck_size >= DECK_SIZE else Emoji.DENIAL}")
-        )
+            self._stars += progress.count(Emoji.STAR)
+            self._possible_stars += len(progress)
+        self._learnable = len(sizes)
+        self.page_source = InspectWordsSource(index, ban_list, self.window_id)
 
-    async def banning(self, bot_control: BotControl, index: int, word: str):
+    @scoped("English")
+    async def banning(self, bot_control: BotControl, word: str):
         ban_list = await bot_control.user_storage.get_value_by_key("english:ban_list", set())
-        if self.paginated_buttons[index].mark == Emoji.OK:
-            self.paginated_buttons[index].mark = Emoji.DENIAL
-            ban_list.add(word)
-        else:
-            self.paginated_buttons[index].mark = Emoji.OK
-            ban_list.remove(word)
+        ban_list ^= {word}
+        self.page_source.banned = ban_list
         await bot_control.user_storage.set_value_by_key("english:ban_list", ban_list)
 
+    @scoped("English")
     async def ban_all(self, bot_control: BotControl):
         words = await bot_control.bot_storage.get_value_by_key("words")
         await bot_control.user_storage.set_value_by_key("english:ban_list", set(words))
-        for button in self.paginated_buttons:
-            button.mark = Emoji.DENIAL
+        self.page_source.banned = set(words)
 
+    @scoped("English")
     async def unban_all(self, bot_control: BotControl):
         await bot_control.user_storage.destroy_key("english:ban_list")
-        for button in self.paginated_buttons:
-            button.mark = Emoji.OK
+        self.page_source.banned = set()
@@ -3,19 +3,21 @@ from typing import Literal, Dict
 from aiogram.filters.callback_data import CallbackData
 
 from FSM import States
-from api import SuperEnglishDictionary
 from core import WindowBuilder, BotControl
 from core.markups import ButtonWidget, TextWidget, Info
-from models.english import knowledge_as_progress_string
+from models.english import knowledge_as_progress_string, WordsIndex
 from tools import Emoji
+from tools.metrics import scoped
 
 
 class BuyingContentCallbackData(CallbackData, prefix="buying_content"):
-    name: str
+    token: int
+    window: str
 
 
 class EditContentCallbackData(CallbackData, prefix="edit_content"):
-    name: str
+    token: int
+    window: str
 
 
 class Shop(WindowBuilder):
@@ -31,6 +33,7 @@ class Shop(WindowBuilder):
         if action_type == "edit":
             self.frozen_text.add_texts_rows(TextWidget(text=f"Edit shop {Emoji.TAG}"))
 
+    @scoped("Shop")
     async def __call__(self, bot_control: BotControl):
         shop = await bot_control.bot_storage.get_value_by_key("shop", {})
         if not shop:
@@ -56,24 +59,24 @@ class Shop(WindowBuilder):
                     button_text += f"{currency} {cost} "
             buttons.append(ButtonWidget(
                 text=button_text,
-                callback_data=self._actions[self.action_type](name=name))
+                callback_data=self._actions[self.action_type](token=self.token(name), window=self.window_id))
             )
         self.paginated_buttons = buttons
 
         if self.action_type == "buy":
             await self.balance_display(bot_control)
 
+    @scoped("Shop")
     async def balance_display(self, bot_control: BotControl):
         dna = await bot_control.user_storage.get_value_by_key("english:total_dna", 0)
         cube = await bot_control.user_storage.get_value_by_key("english:keys", 0)
         star = 0
 
         user_knowledge = await bot_control.user_storage.get_value_by_key("english:knowledge", {})
-        for word in await bot_control.bot_storage.get_value_by_key("words", set()):
-            data = await SuperEnglishDictionary.extract_data(word)
-            if data["pos"]:
-                knowledge_size = len(SuperEnglishDictionary.build_knowledge_schema(data))
-                star += knowledge_as_progress_string(user_knowledge.get(word, {}), knowledge_size).count(Emoji.STAR)
+        index = WordsIndex(bot_control.bot_storage)
+        await index.ensure(await bot_control.bot_storage.get_value_by_key("words", set()))
+        for word, knowledge_size in (await index.sizes()).items():
+            star += knowledge_as_progress_string(user_knowledge.get(word, {}), knowledge_size).count(Emoji.STAR)
 
         self.temp_balance = {
             Emoji.DNA: dna,
@@ -82,19 +85,23 @@ class Shop(WindowBuilder):
         }
         self.add_texts_rows(TextWidget(text=f"{Emoji.DNA} {dna} {Emoji.CUBE} {cube} {Emoji.STAR} {star}"))
 
+    @scoped("Shop")
     async def buying(self, bot_control: BotControl, name: str):
+        """
+        :return: False if the balance is not enough anymore
+        """
         shop_data = await bot_control.bot_storage.get_value_by_key("shop")
         item = shop_data[name]
 
-        dna = self.temp_balance[Emoji.DNA]
-        cube = self.temp_balance[Emoji.CUBE]
-        dna -= int(item["cost"][Emoji.DNA])
-        cube -= int(item["cost"][Emoji.CUBE])
-        await bot_control.user_storage.set_value_by_key("english:total_dna", dna)
-        await bot_control.user_storage.set_value_by_key("english:keys", cube)
+        if not await bot_control.user_storage.withdraw({
+            "english:total_dna": int(item["cost"][Emoji.DNA]),
+            "english:keys": int(item["cost"][Emoji.CUBE])
+        }):
+            return False
         collection = await bot_control.user_storage.get_value_by_key("collection", {})
         collection[name] = item
         await bot_control.user_storage.set_value_by_key("collection", collection)
+        return True
 
 
 class Content(WindowBuilder):
@@ -167,6 +174,7 @@ class Content(WindowBuilder):
         self.state = States.input_integer_star_cost
         self.add_texts_rows(TextWidget(text=f"Enter {Emoji.STAR} as integer"))
 
+    @scoped("Shop")
     async def delete(self, bot_control):
         assert self.action_type == "edit"
 
@@ -178,6 +186,7 @@ class Content(WindowBuilder):
                 f" deleted {Emoji.CANDLE}", back_callback_data="update"
         ))
 
+    @scoped("Shop")
     async def merge_content(self, bot_control):
         if not self.temp_name or self.temp_name == Emoji.RED_QUESTION:
             await bot_control.append(Info("Name required"))
@@ -1,18 +1,40 @@
-from asyncio import to_thread
 from os import getenv
 from math import ceil
-from pickle import dumps, loads
-from typing import Union, Any, Iterable
+from asyncio import sleep
+from copy import copy
+from functools import partial
+from logging import getLogger
+from time import monotonic, time, perf_counter
+from typing import Union, Any, Iterable, Literal
 
 from dotenv import find_dotenv, load_dotenv
-from redis.asyncio import Redis
+from redis.asyncio import Redis, BlockingConnectionPool
+from redis.asyncio.client import Pipeline
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
 from redis.commands.core import ResponseT
+from redis.exceptions import ResponseError, ConnectionError, TimeoutError
 from redis.typing import KeyT, ExpiryT, AbsExpiryT
 
+from tools.codecs import Serializer
+from tools.memory import MemoryBackend
+from tools.metrics import METRICS, scoped
+from tools.sqlite import SqliteBackend
+
 
 
 load_dotenv(find_dotenv())
 
+logger = getLogger()
+
+STORAGE_BACKEND = getenv("STORAGE_BACKEND", "redis")
+
+# Chat storages of BotControl, the migration converts their keys with the same policies.
+# Telegram can't delete messages older than 48 hours, and a chat left for a month starts over
+MESSAGES_IDS_POLICY = {"ttl": 48 * 60 * 60, "sliding": True, "max_length": 100}
+CONTEXT_POLICY = {"ttl": 30 * 24 * 60 * 60, "sliding": True, "max_length": 50}
+FINGERPRINTS_POLICY = {"ttl": 48 * 60 * 60, "sliding": True}
+
 
 class Emoji:
     STAR = "⭐"
@@ -185,7 +207,19 @@ def create_progress_text(
     return progress
 
 
-class CustomRedis(Redis):
+class SerializingClient:
+    """
+    Client mixin which takes and returns python objects, encoded by serializer, over a bytes backend
+    with redis.asyncio.Redis commands: CustomRedis or MemoryClient.
+    Codec is picked by REDIS_CODEC env (pickle, msgpack or orjson), old pickled values are still readable.
+    Values of REDIS_COMPRESSION_THRESHOLD bytes and more are compressed by REDIS_COMPRESSION (zlib, lz4 or zstd).
+    Backends also provide atomic hwithdraw and bump_version.
+    """
+    serializer = Serializer.by_name(
+        getenv("REDIS_CODEC"),
+        compression=getenv("REDIS_COMPRESSION"),
+        compress_threshold=int(getenv("REDIS_COMPRESSION_THRESHOLD", 1024)),
+    )
     async def set(
         self,
         name: KeyT,
@@ -201,7 +235,7 @@ class CustomRedis(Redis):
     ) -> ResponseT:
         return await super().set(
             name,
-            dumps(value),
+            self.serializer.encode(value),
             ex,
             px,
             nx,
@@ -215,13 +249,13 @@ class CustomRedis(Redis):
     async def get(self, name: KeyT) -> ResponseT:
         result: Any = await super().get(name)
         if result is not None:
-            return await to_thread(loads, result)
+            return await self.serializer.decode(result)
 
     async def setex(self, name: KeyT, time: ExpiryT, value: Any) -> ResponseT:
         return await super().setex(
             name,
             time,
-            dumps(value),
+            self.serializer.encode(value),
         )
 
     async def getex(
@@ -235,21 +269,270 @@ class CustomRedis(Redis):
     ) -> ResponseT:
         result: Any = await super().getex(name, ex, px, exat, pxat, persist)
         if result is not None:
-            return await to_thread(loads, result)
+            return await self.serializer.decode(result)
+
+    def raw(self, command: str):
+        """
+        :return: redis command which takes and returns bytes as is, without pickle
+        """
+        return getattr(super(), command)
+
+    async def hget(self, name: KeyT, key: str) -> ResponseT:
+        result: Any = await super().hget(name, key)
+        if result is not None:
+            return await self.serializer.decode(result)
+
+    async def hset(
+        self,
+        name: KeyT,
+        key: str | None = None,
+        value: Any = None,
+        mapping: dict | None = None,
+    ) -> ResponseT:
+        if key is not None:
+            mapping = {**(mapping or {}), key: value}
+        return await super().hset(name, mapping={k: self.serializer.encode(v) for k, v in mapping.items()})
+
+    async def hgetall(self, name: KeyT) -> ResponseT:
+        result: dict = await super().hgetall(name)
+        return await self.serializer.decode_mapping(result)
+
+    async def rpush(self, name: KeyT, *values: Any) -> ResponseT:
+        return await super().rpush(name, *(self.serializer.encode(value) for value in values))
+
+    async def rpop(self, name: KeyT, count: int | None = None) -> ResponseT:
+        result: Any = await super().rpop(name, count)
+        if result is not None:
+            return await self.serializer.decode(result)
+
+    async def lindex(self, name: KeyT, index: int) -> ResponseT:
+        result: Any = await super().lindex(name, index)
+        if result is not None:
+            return await self.serializer.decode(result)
+
+    async def lset(self, name: KeyT, index: int, value: Any) -> ResponseT:
+        return await super().lset(name, index, self.serializer.encode(value))
+
+    async def lrem(self, name: KeyT, count: int, value: Any) -> ResponseT:
+        for encoded in self.serializer.encodings(value):
+            removed = await super().lrem(name, count, encoded)
+            if removed:
+                return removed
+        return 0
+
+    async def lrange(self, name: KeyT, start: int, end: int) -> ResponseT:
+        result: list = await super().lrange(name, start, end)
+        return await self.serializer.decode_many(result)
+
+
+def _size(value: Any) -> int:
+    """
+    Approximate wire size of command arguments or reply
+    """
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(map(_size, value))
+    if isinstance(value, dict):
+        return sum(_size(k) + _size(v) for k, v in value.items())
+    return 8
+
+
+def _command_key(args: tuple):
+    """
+    :return: command name and key of command arguments, EVAL keys come after the script and their number
+    """
+    if args[0] in ("EVAL", "EVALSHA"):
+        return args[0], args[3] if len(args) > 3 and int(args[2]) else None
+    return args[0], args[1] if len(args) > 1 else None
+
+
+class _InstrumentedPipeline(Pipeline):
+    async def immediate_execute_command(self, *args, **options):
+        start = perf_counter()
+        result = await super().immediate_execute_command(*args, **options)
+        METRICS.record([_command_key(args)], perf_counter() - start, _size(args), _size(result))
+        return result
+
+    async def execute(self, raise_on_error: bool = True):
+        stack = [args for args, _ in self.command_stack]
+        start = perf_counter()
+        result = await super().execute(raise_on_error)
+        if stack:
+            METRICS.record(list(map(_command_key, stack)), perf_counter() - start, _size(stack), _size(result))
+        return result
+
+
+class CustomRedis(SerializingClient, Redis):
+    _hwithdraw = """
+    for i = 1, #ARGV, 2 do
+        local raw = redis.call('HGET', KEYS[1], ARGV[i])
+        local value = 0
+        if raw then
+            value = tonumber(raw)
+            if not value then
+                return -(i + 1) / 2
+            end
+        end
+        if value < tonumber(ARGV[i + 1]) then
+            return 0
+        end
+    end
+    for i = 1, #ARGV, 2 do
+        redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1]))
+    end
+    return 1
+    """
+    _bump_version = """
+    local version = redis.call('INCR', KEYS[1])
+    redis.call('PUBLISH', ARGV[1], version .. ':' .. ARGV[2])
+    return version
+    """
+
+    async def execute_command(self, *args, **options):
+        """
+        Every command is recorded to METRICS
+        """
+        start = perf_counter()
+        result = await super().execute_command(*args, **options)
+        METRICS.record([_command_key(args)], perf_counter() - start, _size(args), _size(result))
+        return result
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> Pipeline:
+        return _InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+    async def hwithdraw(self, name: KeyT, amounts: dict[str, int]) -> int:
+        """
+        Atomically subtracts amounts from integer fields if every field has enough.
+        :return: 1 if subtracted, 0 if some field has not enough,
+         -n if n-th field holds not a plain integer and have to be normalized first
+        """
+        args = [arg for field, amount in amounts.items() for arg in (field, amount)]
+        return await self.eval(self._hwithdraw, 1, name, *args)
+
+    async def bump_version(self, name: KeyT, channel: str, message: str) -> int:
+        """
+        Increments version counter and publishes "{version}:{message}" to channel in one step
+        """
+        return await self.eval(self._bump_version, 1, name, channel, message)
+
+
+class MemoryClient(SerializingClient, MemoryBackend):
+    """
+    Storage client without redis for tests, benchmarks and single-process deployments.
+    Data lives as long as the process.
+    """
+
+
+class SqliteClient(SerializingClient, SqliteBackend):
+    """
+    Storage client without redis for single-node deployments, data is kept in SQLITE_PATH.
+    Needs initialize() before use.
+    """
+
+
+class RedisPool:
+    """
+    The only connection pool of the bot, shared by Storage, aiogram FSM and pub/sub listeners.
+    Blocks for a free connection instead of opening new ones above REDIS_MAX_CONNECTIONS,
+    checks idle connections and retries commands after redis blips.
+    """
+    _pool: BlockingConnectionPool | None = None
+
+    @classmethod
+    def get(cls) -> BlockingConnectionPool:
+        if cls._pool is None:
+            cls._pool = BlockingConnectionPool(
+                host=getenv("REDIS_HOST"),
+                port=int(getenv("REDIS_PORT")),
+                db=int(getenv("REDIS_DB", 1)),
+                max_connections=int(getenv("REDIS_MAX_CONNECTIONS", 64)),
+                timeout=float(getenv("REDIS_POOL_TIMEOUT", 10)),
+                socket_timeout=float(getenv("REDIS_SOCKET_TIMEOUT", 5)),
+                socket_connect_timeout=float(getenv("REDIS_SOCKET_CONNECT_TIMEOUT", 5)),
+                health_check_interval=int(getenv("REDIS_HEALTH_CHECK_INTERVAL", 30)),
+                socket_keepalive=True,
+                retry=Retry(ExponentialBackoff(cap=1, base=0.05), 3),
+                retry_on_error=[ConnectionError, TimeoutError],
+            )
+        return cls._pool
+
+    @classmethod
+    async def close(cls):
+        if cls._pool is not None:
+            await cls._pool.disconnect()
+            cls._pool = None
+
+
+def create_client(backend: str | None = None) -> SerializingClient:
+    """
+    :param backend: redis, memory or sqlite, STORAGE_BACKEND env by default
+    """
+    backend = backend or STORAGE_BACKEND
+    if backend == "redis":
+        return CustomRedis(connection_pool=RedisPool.get())
+    if backend == "memory":
+        return MemoryClient()
+    if backend == "sqlite":
+        return SqliteClient(getenv("SQLITE_PATH", "storage.sqlite3"))
+    raise ValueError(f"Unknown storage backend {backend}")
+
+
+def _track(pipe, index_key: str, eviction: str, fields: Iterable[str], existing: bool = False):
+    """
+    Queues access of fields to the eviction index: lru scores by last access time, lfu by access count
+    :param existing: only fields already in the index, so reads of missing keys don't add them
+    """
+    fields = list(fields)
+    if not fields:
+        return
+    if eviction == "lfu":
+        for field in fields:
+            if existing:
+                pipe.zadd(index_key, {field: 1}, xx=True, incr=True)
+            else:
+                pipe.zincrby(index_key, 1, field)
+    else:
+        pipe.zadd(index_key, dict.fromkeys(fields, time()), xx=existing)
 
 
 class Storage:
-    CLIENT = CustomRedis(
-        host=getenv("REDIS_HOST"), port=int(getenv("REDIS_PORT")), db=1
-    )
+    """
+    :param ttl: seconds the key lives after the last write
+    :param sliding: reads prolong the ttl too
+    """
+    CLIENT = create_client()
 
-    def __init__(self, key: str, default: Any):
+    def __init__(
+            self,
+            key: str,
+            default: Any,
+            unit: Union["UnitOfWork", None] = None,
+            *,
+            ttl: int | None = None,
+            sliding: bool = False,
+    ):
         self._key = key
         self._default = default
+        self._unit = unit
+        self._ttl = ttl
+        self._sliding = sliding
+
+    @property
+    def key(self) -> str:
+        return self._key
+
+    @property
+    def _view(self):
+        if self._unit is not None and self._unit.active:
+            return self._unit.view(self)
 
     async def get(self):
         try:
-            value = await self.CLIENT.get(self._key)
+            if self._ttl and self._sliding:
+                value = await self.CLIENT.getex(self._key, ex=self._ttl)
+            else:
+                value = await self.CLIENT.get(self._key)
         except (AttributeError, ModuleNotFoundError, Exception):
             await self.set(self._default)
             return self._default
@@ -258,15 +541,77 @@ class Storage:
         return value
 
     async def set(self, value: Any):
-        await self.CLIENT.set(self._key, value)
+        await self.CLIENT.set(self._key, value, ex=self._ttl)
 
     async def destroy(self):
-        await self.CLIENT.set(self._key, None)
+        await self.CLIENT.set(self._key, None, ex=self._ttl)
+
+    async def _native(self, command, *args):
+        """
+        Runs command against native redis type of the storage.
+        If the key still holds the old pickled value, it is converted by _migrate first.
+        """
+        try:
+            return await command(self._key, *args)
+        except ResponseError as e:
+            if not str(e).startswith("WRONGTYPE"):
+                raise e
+        await self.CLIENT.transaction(self._migrate, self._key)
+        return await command(self._key, *args)
+
+    async def _migrate(self, pipe):
+        """
+        Converts the old pickled value, the key is watched by pipe
+        """
+        if await pipe.type(self._key) != b"string":
+            return
+        value = await self.CLIENT.serializer.decode(await pipe.get(self._key))
+        pipe.multi()
+        self._convert(pipe, value)
+
+    def _convert(self, pipe, value: Any):
+        """
+        Queues commands replacing the old pickled value by the native layout of the storage
+        """
+        raise NotImplementedError
+
+    def _maintain(self, pipe, write: bool, fields: Iterable[str] = ()):
+        """
+        Queues policy commands (expiry, trimming, access tracking) after native commands touching fields
+        """
+        if self._ttl and (write or self._sliding):
+            pipe.expire(self._key, self._ttl)
+
+    async def _after(self, write: bool, fields: Iterable[str] = ()):
+        async with self.CLIENT.pipeline(transaction=False) as pipe:
+            self._maintain(pipe, write, fields)
+            if pipe.command_stack:
+                await pipe.execute()
+
+    async def _evict(self):
+        """
+        Enforces limits which can't be queued along with the write itself
+        """
 
 
 class DictStorage(Storage):
-    def __init__(self, id_: str):
-        super().__init__(id_, {})
+    """
+    :param max_size: fields over it are evicted after writes, used only by HashStorage
+    :param eviction: lru evicts least recently used fields, lfu least frequently used
+    """
+    def __init__(
+            self,
+            id_: str,
+            unit: Union["UnitOfWork", None] = None,
+            *,
+            max_size: int | None = None,
+            eviction: Literal["lru", "lfu"] = "lru",
+            **policy,
+    ):
+        super().__init__(id_, {}, unit, **policy)
+        self._max_size = max_size
+        self._eviction = eviction
+        self._index_key = f"{id_}@access"
 
     async def get_value_by_key(self, key: str, default: Any | None = None):
         try:
@@ -288,10 +633,46 @@ class DictStorage(Storage):
         except KeyError:
             return False
 
+    async def increment(self, key: str, amount: int = 1) -> None:
+        """
+        Returns nothing in every storage: inside a UnitOfWork the new value isn't known until the flush,
+        read it with get_value_by_key
+        """
+        await self.set_value_by_key(key, await self.get_value_by_key(key, 0) + amount)
+
+    async def withdraw(self, amounts: dict[str, int]):
+        """
+        Subtracts amounts from counters if every counter has enough
+        :return: True if subtracted
+        """
+        storage = await self.get()
+        if any(storage.get(key, 0) < amount for key, amount in amounts.items()):
+            return False
+        for key, amount in amounts.items():
+            storage[key] = storage.get(key, 0) - amount
+        await self.set(storage)
+        return True
+
 
 class ListStorage(Storage):
-    def __init__(self, key: str):
-        super().__init__(key, [])
+    """
+    :param max_length: only the last max_length items are kept
+    """
+    def __init__(
+            self,
+            key: str,
+            unit: Union["UnitOfWork", None] = None,
+            *,
+            max_length: int | None = None,
+            **policy,
+    ):
+        super().__init__(key, [], unit, **policy)
+        self._max_length = max_length
+
+    async def set(self, value: list):
+        if self._max_length is not None:
+            value = value[-self._max_length:]
+        await super().set(value)
 
     async def append(self, item: Any):
         list_ = await self.get()
@@ -314,6 +695,12 @@ class ListStorage(Storage):
     async def reset(self, item: Any):
         await self.set([item])
 
+    async def keep_last(self, count: int = 1):
+        """
+        Drops all items but the last count
+        """
+        await self.set((await self.get())[-count:] if count else [])
+
     async def remove(self, message_id: int):
         list_ = await self.get()
         try:
@@ -339,3 +726,754 @@ class ListStorage(Storage):
 
     async def get_all_except_last(self):
         return (await self.get())[:-1]
+
+
+class NamespaceStorage:
+    """
+    Dict-like storage where every key is a separate redis key "{namespace}:{key}" with optional expiry,
+    so a lookup costs the same however many keys the namespace holds.
+    With max_size, access of keys is tracked in the sorted set "{namespace}@access"
+    and keys over the size are evicted after writes, as in DictStorage.
+    """
+    def __init__(
+            self,
+            namespace: str,
+            ttl: int | None = None,
+            *,
+            sliding: bool = False,
+            max_size: int | None = None,
+            eviction: Literal["lru", "lfu"] = "lru",
+    ):
+        self._namespace = namespace
+        self._ttl = ttl
+        self._sliding = sliding
+        self._max_size = max_size
+        self._eviction = eviction
+        self._index_key = f"{namespace}@access"
+
+    def _key(self, key: str):
+        return f"{self._namespace}:{key}"
+
+    async def get_value_by_key(self, key: str, default: Any | None = None):
+        if not (self._ttl and self._sliding) and self._max_size is None:
+            value = await Storage.CLIENT.get(self._key(key))
+        else:
+            async with Storage.CLIENT.pipeline(transaction=False) as pipe:
+                pipe.get(self._key(key))
+                if self._ttl and self._sliding:
+                    pipe.expire(self._key(key), self._ttl)
+                if self._max_size is not None:
+                    # Keys are added to the index when written, a miss doesn't count
+                    _track(pipe, self._index_key, self._eviction, (key,), existing=True)
+                raw = (await pipe.execute())[0]
+            value = None if raw is None else await Storage.CLIENT.serializer.decode(raw)
+        if value is None:
+            return default
+        return value
+
+    async def set_value_by_key(self, key: str, value):
+        if self._max_size is None:
+            return await Storage.CLIENT.set(self._key(key), value, ex=self._ttl)
+        async with Storage.CLIENT.pipeline(transaction=False) as pipe:
+            pipe.set(self._key(key), Storage.CLIENT.serializer.encode(value), ex=self._ttl)
+            _track(pipe, self._index_key, self._eviction, (key,))
+            pipe.zcard(self._index_key)
+            excess = (await pipe.execute())[-1] - self._max_size
+        if excess > 0:
+            evicted = [key.decode() for key, _ in await Storage.CLIENT.zpopmin(self._index_key, excess)]
+            if evicted:
+                await Storage.CLIENT.delete(*map(self._key, evicted))
+
+    async def destroy_key(self, key: str):
+        if self._max_size is not None:
+            await Storage.CLIENT.zrem(self._index_key, key)
+        return bool(await Storage.CLIENT.delete(self._key(key)))
+
+    async def migrate_from(self, blob_key: str, batch_size: int = 500):
+        """
+        One-off move of the entries of a pickled dict stored under blob_key, which is deleted after.
+        Keys already written by the new layout are kept.
+        """
+        blob = await Storage.CLIENT.get(blob_key)
+        if not blob:
+            await Storage.CLIENT.delete(blob_key)
+            return 0
+
+        items = list(blob.items())
+        for start in range(0, len(items), batch_size):
+            async with Storage.CLIENT.pipeline(transaction=False) as pipe:
+                for key, value in items[start:start + batch_size]:
+                    pipe.set(self._key(key), Storage.CLIENT.serializer.encode(value), ex=self._ttl, nx=True)
+                if self._max_size is not None:
+                    _track(pipe, self._index_key, self._eviction, (key for key, _ in items[start:start + batch_size]))
+                await pipe.execute()
+        await Storage.CLIENT.delete(blob_key)
+        logger.info(f"Moved {len(items)} entries from {blob_key} to {self._namespace}:*")
+        return len(items)
+
+
+class HashStorage(DictStorage):
+    """
+    DictStorage laid out as a redis hash: every key of the dict is a separate field,
+    so reading or writing one key doesn't move the whole dict.
+    A key still holding the old pickled dict is converted on first touch.
+    """
+
+    async def get(self):
+        if (view := self._view) is not None:
+            return await view.get()
+        value = await self._native(self.CLIENT.hgetall)
+        await self._after(False)
+        return value
+
+    async def set(self, value: dict):
+        if (view := self._view) is not None:
+            return view.set(value)
+        async with self.CLIENT.pipeline(transaction=True) as pipe:
+            pipe.delete(self._key, self._index_key)
+            if value:
+                pipe.hset(self._key, mapping={k: self.CLIENT.serializer.encode(v) for k, v in value.items()})
+            self._maintain(pipe, True, value)
+            await pipe.execute()
+        await self._evict()
+
+    async def destroy(self):
+        if (view := self._view) is not None:
+            return view.set({})
+        await self.CLIENT.delete(self._key, self._index_key)
+
+    async def get_value_by_key(self, key: str, default: Any | None = None):
+        if (view := self._view) is not None:
+            return await view.get_value_by_key(key, default)
+        value = await self._native(self.CLIENT.hget, key)
+        await self._after(False, (key,))
+        if value is None:
+            return default
+        return value
+
+    async def set_value_by_key(self, key: str, value):
+        if (view := self._view) is not None:
+            return view.set_value_by_key(key, value)
+        await self._native(self.CLIENT.hset, key, value)
+        await self._after(True, (key,))
+        await self._evict()
+
+    async def destroy_key(self, key: str):
+        if (view := self._view) is not None:
+            return await view.destroy_key(key)
+        destroyed = bool(await self._native(self.CLIENT.hdel, key))
+        if self._max_size is not None:
+            await self.CLIENT.zrem(self._index_key, key)
+        return destroyed
+
+    async def increment(self, key: str, amount: int = 1) -> None:
+        """
+        HINCRBY on the server, concurrent increments are never lost. Returns nothing, see DictStorage.increment
+        """
+        if (view := self._view) is not None:
+            return view.increment(key, amount)
+        await self._increment(key, amount)
+        await self._after(True, (key,))
+        await self._evict()
+
+    async def _increment(self, key: str, amount: int):
+        try:
+            return await self._native(self.CLIENT.hincrby, key, amount)
+        except ResponseError as e:
+            if "not an integer" not in str(e):
+                raise e
+        await self.CLIENT.transaction(partial(self._normalize_counter, key), self._key)
+        return await self._native(self.CLIENT.hincrby, key, amount)
+
+    async def withdraw(self, amounts: dict[str, int]):
+        """
+        Check and subtraction run as one lua script, so two purchases can't spend the same balance
+        """
+        if (view := self._view) is not None:
+            await view.commit_counters(amounts)
+        while True:
+            result = await self._native(self.CLIENT.hwithdraw, amounts)
+            if result >= 0:
+                await self._after(bool(result), amounts)
+                return bool(result)
+            await self.CLIENT.transaction(partial(self._normalize_counter, list(amounts)[-result - 1]), self._key)
+
+    def _maintain(self, pipe, write: bool, fields: Iterable[str] = ()):
+        super()._maintain(pipe, write, fields)
+        if self._max_size is not None:
+            _track(pipe, self._index_key, self._eviction, fields)
+            if self._ttl and (write or self._sliding):
+                pipe.expire(self._index_key, self._ttl)
+
+    async def _evict(self):
+        """
+        Drops the least recently or least frequently used fields over max_size
+        """
+        if self._max_size is None:
+            return
+        excess = await self.CLIENT.hlen(self._key) - self._max_size
+        if excess > 0:
+            evicted = [field for field, _ in await self.CLIENT.zpopmin(self._index_key, excess)]
+            if evicted:
+                await self.CLIENT.hdel(self._key, *evicted)
+
+    async def _normalize_counter(self, key: str, pipe):
+        """
+        Rewrites counter stored before counters became plain integers
+        """
+        raw = await pipe.hget(self._key, key)
+        pipe.multi()
+        if raw is not None:
+            pipe.hset(self._key, key, self.CLIENT.serializer.encode(int(self.CLIENT.serializer.decode_sync(raw))))
+
+    def _convert(self, pipe, value: dict):
+        pipe.delete(self._key)
+        if value:
+            pipe.hset(self._key, mapping={k: self.CLIENT.serializer.encode(v) for k, v in value.items()})
+        self._maintain(pipe, True, value or ())
+
+
+class CachedStorage(HashStorage):
+    """
+    HashStorage with in-process cache for bot-wide data which is read on every update and rarely written.
+    Every write increments {key}:version and publishes it to {key}:invalidate,
+    listen() drops invalidated fields in every bot process.
+    Missed version, periodic version mismatch or lost connection drop the whole cache.
+    Values are cached only while listen() runs. Reads return shallow copies, changes must be written back.
+    Not bound to units of work: invalidation must go right after the write.
+    """
+
+    def __init__(self, id_: str):
+        super().__init__(id_)
+        self._version_key = f"{id_}:version"
+        self._channel = f"{id_}:invalidate"
+        self._version = 0
+        self._listening = False
+        self._cache: dict[str, Any] = {}
+        self._complete = False
+
+    async def get(self):
+        if not self._complete:
+            version = self._version
+            value = await super().get()
+            if not self._listening or version != self._version:
+                return value
+            self._cache = value
+            self._complete = True
+        return {key: copy(value) for key, value in self._cache.items()}
+
+    async def get_value_by_key(self, key: str, default: Any | None = None):
+        try:
+            return copy(self._cache[key])
+        except KeyError:
+            if self._complete:
+                return default
+        version = self._version
+        value = await super().get_value_by_key(key)
+        if value is None:
+            return default
+        if self._listening and version == self._version:
+            self._cache[key] = value
+        return copy(value)
+
+    async def set(self, value: dict):
+        await super().set(value)
+        await self._invalidate("*")
+
+    async def destroy(self):
+        await super().destroy()
+        await self._invalidate("*")
+
+    async def set_value_by_key(self, key: str, value):
+        await super().set_value_by_key(key, value)
+        await self._invalidate(key)
+
+    async def destroy_key(self, key: str):
+        destroyed = await super().destroy_key(key)
+        await self._invalidate(key)
+        return destroyed
+
+    async def increment(self, key: str, amount: int = 1) -> None:
+        await super().increment(key, amount)
+        await self._invalidate(key)
+
+    async def withdraw(self, amounts: dict[str, int]):
+        withdrawn = await super().withdraw(amounts)
+        for key in amounts:
+            await self._invalidate(key)
+        return withdrawn
+
+    async def listen(self, check_interval: float = 30):
+        while True:
+            try:
+                async with self.CLIENT.pubsub() as pubsub:
+                    await pubsub.subscribe(self._channel)
+                    await self._check_version()
+                    self._listening = True
+                    checked = monotonic()
+                    while True:
+                        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+                        if message is not None:
+                            self._on_message(message["data"].decode())
+                        if monotonic() - checked > check_interval:
+                            await self._check_version()
+                            checked = monotonic()
+            except (ConnectionError, TimeoutError):
+                logger.warning(f"Cache of {self._key} lost invalidation channel, reconnecting", exc_info=True)
+                await sleep(1)
+            finally:
+                self._listening = False
+                self._drop()
+
+    async def _invalidate(self, key: str):
+        self._drop(key)
+        await self.CLIENT.bump_version(self._version_key, self._channel, key)
+
+    def _on_message(self, message: str):
+        version, _, key = message.partition(":")
+        version = int(version)
+        if version <= self._version:
+            return
+        if version == self._version + 1:
+            self._drop(key)
+        else:
+            self._drop()
+        self._version = version
+
+    async def _check_version(self):
+        version = int(await self.CLIENT.raw("get")(self._version_key) or 0)
+        if version != self._version:
+            self._drop()
+            self._version = version
+
+    def _drop(self, key: str = "*"):
+        self._complete = False
+        if key == "*":
+            self._cache = {}
+        else:
+            self._cache.pop(key, None)
+
+
+class NativeListStorage(ListStorage):
+    """
+    ListStorage laid out as a redis list: every item is a separate element,
+    so operations on the last item are O(1) and don't decode the whole list.
+    A key still holding the old pickled list is converted on first touch.
+    """
+
+    async def get(self):
+        if (view := self._view) is not None:
+            return await view.get()
+        value = await self._native(self.CLIENT.lrange, 0, -1)
+        await self._after(False)
+        return value
+
+    async def set(self, value: list):
+        if (view := self._view) is not None:
+            return view.set(value)
+        async with self.CLIENT.pipeline(transaction=True) as pipe:
+            pipe.delete(self._key)
+            if value:
+                pipe.rpush(self._key, *(self.CLIENT.serializer.encode(item) for item in value))
+            self._maintain(pipe, True)
+            await pipe.execute()
+
+    async def destroy(self):
+        if (view := self._view) is not None:
+            return view.set([])
+        await self.CLIENT.delete(self._key)
+
+    async def append(self, item: Any):
+        if (view := self._view) is not None:
+            return view.extend((item,))
+        await self._native(self.CLIENT.rpush, item)
+        await self._after(True)
+
+    async def extend(self, items: Iterable):
+        items = list(items)
+        if (view := self._view) is not None:
+            return view.extend(items)
+        if items:
+            await self._native(self.CLIENT.rpush, *items)
+            await self._after(True)
+
+    async def pop_last(self):
+        if (view := self._view) is not None:
+            return await view.pop_last()
+        item = await self._native(self.CLIENT.rpop)
+        await self._after(True)
+        return item
+
+    async def reset(self, item: Any):
+        await self.set([item])
+
+    async def keep_last(self, count: int = 1):
+        """
+        One LTRIM, the dropped items are never read
+        """
+        if not count:
+            return await self.destroy()
+        if (view := self._view) is not None:
+            return await view.keep_last(count)
+        await self._native(self.CLIENT.ltrim, -count, -1)
+        await self._after(True)
+
+    async def remove(self, message_id: int):
+        if (view := self._view) is not None:
+            return await view.remove(message_id)
+        removed = bool(await self._native(self.CLIENT.lrem, 1, message_id))
+        await self._after(True)
+        return removed
+
+    async def set_last(self, item: Any):
+        if (view := self._view) is not None:
+            return await view.set_last(item)
+        try:
+            await self._native(self.CLIENT.lset, -1, item)
+        except ResponseError:
+            return await self.append(item)
+        await self._after(True)
+
+    async def get_last(self):
+        if (view := self._view) is not None:
+            return await view.get_last()
+        item = await self._native(self.CLIENT.lindex, -1)
+        await self._after(False)
+        return item
+
+    async def get_all_except_last(self):
+        if (view := self._view) is not None:
+            return (await view.get())[:-1]
+        items = await self._native(self.CLIENT.lrange, 0, -2)
+        await self._after(False)
+        return items
+
+    def _maintain(self, pipe, write: bool, fields: Iterable[str] = ()):
+        if write and self._max_length is not None:
+            pipe.ltrim(self._key, -self._max_length, -1)
+        super()._maintain(pipe, write, fields)
+
+    def _convert(self, pipe, value: list):
+        pipe.delete(self._key)
+        if value:
+            pipe.rpush(self._key, *(self.CLIENT.serializer.encode(item) for item in value))
+        self._maintain(pipe, True)
+
+
+class _HashView:
+    """
+    State of one HashStorage inside a UnitOfWork.
+    Fields are kept encoded, so every read returns a fresh copy as redis would.
+    """
+    _missing = object()
+
+    def __init__(self, storage: HashStorage):
+        self._storage = storage
+        self._fields: dict[str, bytes] = {}
+        self._changed: dict[str, bytes] = {}
+        self._deleted: set[str] = set()
+        self._increments: dict[str, int] = {}
+        self._accessed: set[str] = set()
+        self._complete = False
+        self._cleared = False
+        self.verified = False
+        self.dirty = False
+
+    async def _fetch(self, command: str, *args):
+        result = await self._storage._native(Storage.CLIENT.raw(command), *args)
+        self.verified = True
+        return result
+
+    def _fetched(self, key: str, value: bytes | None):
+        """
+        Remembers value fetched from redis, adding increments which are not flushed yet
+        """
+        if key in self._increments:
+            serializer = Storage.CLIENT.serializer
+            value = serializer.encode((0 if value is None else serializer.decode_sync(value)) + self._increments[key])
+        self._fields[key] = self._missing if value is None else value
+
+    async def _get_raw(self, key: str):
+        self._accessed.add(key)
+        if key not in self._fields:
+            if self._complete:
+                return self._missing
+            self._fetched(key, await self._fetch("hget", key))
+        return self._fields[key]
+
+    async def get(self):
+        if not self._complete:
+            fetched = {key.decode(): value for key, value in (await self._fetch("hgetall")).items()}
+            for key in fetched.keys() | self._increments.keys():
+                if key not in self._fields:
+                    self._fetched(key, fetched.get(key))
+            self._complete = True
+        return await Storage.CLIENT.serializer.decode_mapping(
+            {k.encode(): v for k, v in self._fields.items() if v is not self._missing}
+        )
+
+    def set(self, value: dict):
+        self._fields = {k: Storage.CLIENT.serializer.encode(v) for k, v in value.items()}
+        self._changed = dict(self._fields)
+        self._deleted = set()
+        self._increments = {}
+        self._accessed = set(self._fields)
+        self._complete = True
+        self._cleared = True
+        self.dirty = True
+
+    async def get_value_by_key(self, key: str, default: Any | None = None):
+        value = await self._get_raw(key)
+        if value is self._missing:
+            return default
+        return await Storage.CLIENT.serializer.decode(value)
+
+    def set_value_by_key(self, key: str, value: Any):
+        self._fields[key] = self._changed[key] = Storage.CLIENT.serializer.encode(value)
+        self._deleted.discard(key)
+        self._increments.pop(key, None)
+        self._accessed.add(key)
+        self.dirty = True
+
+    async def destroy_key(self, key: str):
+        if await self._get_raw(key) is self._missing:
+            return False
+        self._fields[key] = self._missing
+        self._changed.pop(key, None)
+        self._increments.pop(key, None)
+        self._deleted.add(key)
+        self.dirty = True
+        return True
+
+    def increment(self, key: str, amount: int = 1):
+        """
+        Buffered as HINCRBY, so it stays atomic on flush. A field read before is updated for the next reads
+        """
+        serializer = Storage.CLIENT.serializer
+        self._accessed.add(key)
+        self.dirty = True
+        if key in self._changed:
+            value = serializer.decode_sync(self._changed[key]) + amount
+            self._fields[key] = self._changed[key] = serializer.encode(value)
+            return
+        self._increments[key] = self._increments.get(key, 0) + amount
+        if key in self._fields:
+            raw = self._fields[key]
+            self._fields[key] = serializer.encode((0 if raw is self._missing else serializer.decode_sync(raw)) + amount)
+
+    async def commit_counters(self, keys: Iterable[str]):
+        """
+        Sends buffered writes of keys right now and forgets them, for commands which have to see the server value
+        """
+        for key in keys:
+            self._fields.pop(key, None)
+            self._complete = False
+            if key in self._changed:
+                await self._storage._native(Storage.CLIENT.raw("hset"), key, self._changed.pop(key))
+            elif key in self._increments:
+                await self._storage._increment(key, self._increments.pop(key))
+
+    def probe(self, pipe):
+        pipe.hlen(self._storage._key)
+
+    def flush(self, pipe):
+        key = self._storage._key
+        if self._cleared:
+            pipe.delete(key, self._storage._index_key)
+        elif self._deleted:
+            pipe.hdel(key, *self._deleted)
+            if self._storage._max_size is not None:
+                pipe.zrem(self._storage._index_key, *self._deleted)
+        if self._changed:
+            pipe.hset(key, mapping=self._changed)
+        self._storage._maintain(pipe, self.dirty, self._accessed - self._deleted)
+        for field, amount in self._increments.items():
+            pipe.hincrby(key, field, amount)
+
+    async def recover(self, results: list):
+        """
+        Counters stored before they became plain integers fail HINCRBY inside MULTI, they are normalized and retried
+        """
+        failed = [
+            (field, amount) for (field, amount), result in zip(self._increments.items(), results[-len(self._increments):])
+            if isinstance(result, ResponseError)
+        ] if self._increments else []
+        for field, amount in failed:
+            await self._storage._increment(field, amount)
+        return len(failed) == sum(isinstance(result, ResponseError) for result in results)
+
+
+class _ListView:
+    """
+    State of one NativeListStorage inside a UnitOfWork.
+    Only the tail that was touched is loaded: items are pulled one by one from the end of the redis list,
+    and on flush the pulled part is trimmed and pushed back as it is now.
+    Items are kept encoded, so every read returns a fresh copy as redis would.
+    """
+
+    def __init__(self, storage: NativeListStorage):
+        self._storage = storage
+        self._tail: list[bytes] = []
+        self._cut = 0
+        self._exhausted = False
+        self._cleared = False
+        self.verified = False
+        self.dirty = False
+
+    async def _fetch(self, command: str, *args):
+        result = await self._storage._native(Storage.CLIENT.raw(command), *args)
+        self.verified = True
+        return result
+
+    async def _pull(self):
+        if self._exhausted:
+            return
+        item = await self._fetch("lindex", -(self._cut + 1))
+        if item is None:
+            self._exhausted = True
+            return
+        self._cut += 1
+        self._tail.insert(0, item)
+
+    async def _load(self):
+        if not self._exhausted:
+            items = await self._fetch("lrange", 0, -(self._cut + 1))
+            self._cut += len(items)
+            self._tail[:0] = items
+            self._exhausted = True
+
+    async def get(self):
+        await self._load()
+        return await Storage.CLIENT.serializer.decode_many(self._tail)
+
+    def set(self, value: list):
+        self._tail = [Storage.CLIENT.serializer.encode(item) for item in value]
+        self._exhausted = True
+        self._cleared = True
+        self.dirty = True
+
+    def extend(self, items: Iterable):
+        self._tail.extend(Storage.CLIENT.serializer.encode(item) for item in items)
+        self.dirty = True
+
+    async def get_last(self):
+        if not self._tail:
+            await self._pull()
+        if self._tail:
+            return await Storage.CLIENT.serializer.decode(self._tail[-1])
+
+    async def pop_last(self):
+        if not self._tail:
+            await self._pull()
+        if self._tail:
+            self.dirty = True
+            return await Storage.CLIENT.serializer.decode(self._tail.pop())
+
+    async def set_last(self, item: Any):
+        if not self._tail:
+            await self._pull()
+        if self._tail:
+            self._tail[-1] = Storage.CLIENT.serializer.encode(item)
+        else:
+            self._tail.append(Storage.CLIENT.serializer.encode(item))
+        self.dirty = True
+
+    async def keep_last(self, count: int):
+        while len(self._tail) < count and not self._exhausted:
+            await self._pull()
+        self._tail = self._tail[-count:]
+        self._exhausted = True
+        self._cleared = True
+        self.dirty = True
+
+    async def remove(self, item: Any):
+        await self._load()
+        for encoded in Storage.CLIENT.serializer.encodings(item):
+            try:
+                self._tail.remove(encoded)
+            except ValueError:
+                continue
+            self.dirty = True
+            return True
+        return False
+
+    def probe(self, pipe):
+        pipe.llen(self._storage._key)
+
+    async def recover(self, results: list):
+        return not any(isinstance(result, ResponseError) for result in results)
+
+    def flush(self, pipe):
+        key = self._storage._key
+        if self.dirty:
+            if self._cleared:
+                pipe.delete(key)
+            elif self._cut:
+                pipe.ltrim(key, 0, -(self._cut + 1))
+            if self._tail:
+                pipe.rpush(key, *self._tail)
+        self._storage._maintain(pipe, self.dirty)
+
+
+class UnitOfWork:
+    """
+    Per-update cache of storages bound to it.
+    Reads are memoized, writes are buffered and sent by flush in one MULTI.
+    After flush the unit is inactive and bound storages go to redis directly again.
+    """
+    _views = {
+        HashStorage: _HashView,
+        NativeListStorage: _ListView,
+    }
+
+    def __init__(self):
+        self.active = True
+        self._storages_views: dict[str, _HashView | _ListView] = {}
+
+    def view(self, storage: Storage):
+        try:
+            return self._storages_views[storage._key]
+        except KeyError:
+            pass
+        for class_ in type(storage).__mro__:
+            if class_ in self._views:
+                view = self._storages_views[storage._key] = self._views[class_](storage)
+                return view
+
+    @scoped("UnitOfWork")
+    async def flush(self):
+        """
+        Views which were only read are flushed too, for the policies of their storages, like sliding ttl
+        """
+        self.active = False
+        views = list(self._storages_views.values())
+        self._storages_views = {}
+        if not views:
+            return
+
+        unverified = [view for view in views if view.dirty and not view.verified]
+        if unverified:
+            async with Storage.CLIENT.pipeline(transaction=False) as pipe:
+                for view in unverified:
+                    view.probe(pipe)
+                results = await pipe.execute(raise_on_error=False)
+            for view, result in zip(unverified, results):
+                if isinstance(result, ResponseError):
+                    await Storage.CLIENT.transaction(view._storage._migrate, view._storage._key)
+
+        async with Storage.CLIENT.pipeline(transaction=True) as pipe:
+            bounds = []
+            for view in views:
+                start = len(pipe.command_stack)
+                view.flush(pipe)
+                bounds.append((view, start, len(pipe.command_stack)))
+            if not pipe.command_stack:
+                return
+            results = await pipe.execute(raise_on_error=False)
+
+        for view, start, end in bounds:
+            if not await view.recover(results[start:end]):
+                raise next(result for result in results[start:end] if isinstance(result, ResponseError))
+        for view in views:
+            if view.dirty:
+                await view._storage._evict()
@@ -0,0 +1,347 @@
+import zlib
+from asyncio import to_thread
+from pickle import dumps, loads, HIGHEST_PROTOCOL
+from time import perf_counter
+from typing import Any, Iterable
+
+from tools.metrics import METRICS
+
+try:
+    import msgpack
+except ModuleNotFoundError:
+    msgpack = None
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+try:
+    import lz4.frame
+except ModuleNotFoundError:
+    lz4 = None
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+
+class Codec:
+    """
+    Every encoded value starts with the header byte of its codec.
+    encode raises TypeError if the value can't be encoded losslessly, so Serializer falls back to pickle.
+    """
+    name: str
+    header: bytes
+
+    def encode(self, value: Any) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    name = "pickle"
+    header = b"\x01"
+
+    def encode(self, value: Any) -> bytes:
+        return self.header + dumps(value, protocol=HIGHEST_PROTOCOL)
+
+    def decode(self, data: bytes) -> Any:
+        return loads(memoryview(data)[1:])
+
+
+class LegacyPickleCodec(Codec):
+    """
+    Values written before headers existed are plain pickles, which always start with PROTO opcode.
+    """
+    name = "legacy_pickle"
+    header = b"\x80"
+
+    def encode(self, value: Any) -> bytes:
+        return dumps(value)
+
+    def decode(self, data: bytes) -> Any:
+        return loads(data)
+
+
+class IntegerCodec(Codec):
+    """
+    Integers are stored as plain decimal strings, so redis can count them with INCRBY/HINCRBY.
+    Such values have no header, they start with a digit or minus.
+    """
+    name = "integer"
+    headers = b"-0123456789"
+
+    def encode(self, value: Any) -> bytes:
+        if type(value) is not int:
+            raise TypeError(f"{type(value)} is not integer")
+        return str(value).encode()
+
+    def decode(self, data: bytes) -> Any:
+        return int(data)
+
+
+class MsgpackCodec(Codec):
+    """
+    strict_types makes tuples, sets and subclasses like defaultdict unsupported instead of silently turning them
+    into lists and dicts.
+    """
+    name = "msgpack"
+    header = b"\x02"
+
+    def encode(self, value: Any) -> bytes:
+        return self.header + msgpack.packb(value, use_bin_type=True, strict_types=True, default=self._unsupported)
+
+    def decode(self, data: bytes) -> Any:
+        return msgpack.unpackb(memoryview(data)[1:], raw=False, strict_map_key=False)
+
+    @staticmethod
+    def _unsupported(value: Any):
+        raise TypeError(f"msgpack can't encode {type(value)} losslessly")
+
+
+class OrjsonCodec(Codec):
+    """
+    orjson turns tuples into lists on its own, so the value is checked for exact json types first.
+    """
+    name = "orjson"
+    header = b"\x03"
+
+    def encode(self, value: Any) -> bytes:
+        if not self._is_json(value):
+            raise TypeError(f"orjson can't encode {type(value)} losslessly")
+        return self.header + orjson.dumps(value)
+
+    def decode(self, data: bytes) -> Any:
+        return orjson.loads(memoryview(data)[1:])
+
+    @classmethod
+    def _is_json(cls, value: Any):
+        type_ = type(value)
+        if type_ in (str, int, float, bool) or value is None:
+            return True
+        if type_ is list:
+            return all(cls._is_json(item) for item in value)
+        if type_ is dict:
+            return all(type(k) is str and cls._is_json(v) for k, v in value.items())
+        return False
+
+
+class Compression:
+    """
+    Compressed value is the marker byte followed by compressed bytes of the value encoded by a codec.
+    Markers don't clash with codec headers, so values written before compression stay readable.
+    """
+    name: str
+    marker: bytes
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCompression(Compression):
+    name = "zlib"
+    marker = b"\x10"
+
+    def compress(self, data: bytes) -> bytes:
+        return self.marker + zlib.compress(data, 1)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(memoryview(data)[1:])
+
+
+class Lz4Compression(Compression):
+    name = "lz4"
+    marker = b"\x11"
+
+    def compress(self, data: bytes) -> bytes:
+        return self.marker + lz4.frame.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lz4.frame.decompress(memoryview(data)[1:])
+
+
+class ZstdCompression(Compression):
+    name = "zstd"
+    marker = b"\x12"
+
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=3) if zstandard is not None else None
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+    def compress(self, data: bytes) -> bytes:
+        return self.marker + self._compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.decompress(memoryview(data)[1:])
+
+
+class CompressionStats:
+    """
+    Sizes of values which reached the compression threshold, before and after compression
+    """
+
+    def __init__(self):
+        self.values = 0
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+    def add(self, raw: int, stored: int):
+        self.values += 1
+        self.compressed += stored < raw
+        self.raw_bytes += raw
+        self.stored_bytes += stored
+
+    @property
+    def ratio(self):
+        return self.stored_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+    def __str__(self):
+        return (
+            f"{self.compressed}/{self.values} values compressed, "
+            f"{self.raw_bytes} -> {self.stored_bytes} bytes, ratio {self.ratio:.2f}"
+        )
+
+
+class Serializer:
+    """
+    Encodes with the preferred codec, falling back to pickle for values it can't hold.
+    Decodes any known header, including old headerless pickles.
+    Payloads smaller than inline_limit bytes are decoded in the event loop,
+    the thread hop costs more than decoding them. Bigger ones go to the executor.
+    Encoded values of compress_threshold bytes and more are compressed, if it makes them smaller.
+    """
+    _fallback = PickleCodec()
+    _integer = IntegerCodec()
+    _codecs = {
+        codec.header[0]: codec for codec in (PickleCodec(), LegacyPickleCodec(), MsgpackCodec(), OrjsonCodec())
+    }
+    _codecs.update(dict.fromkeys(IntegerCodec.headers, _integer))
+    _compressions = {
+        compression.marker[0]: compression
+        for compression in (ZlibCompression(), Lz4Compression(), ZstdCompression())
+    }
+
+    def __init__(
+            self,
+            codec: Codec | None = None,
+            inline_limit: int = 4096,
+            compression: Compression | None = None,
+            compress_threshold: int = 1024,
+    ):
+        self.codec = self._fallback if codec is None else codec
+        self.inline_limit = inline_limit
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.stats = CompressionStats()
+
+    @classmethod
+    def by_name(
+            cls,
+            name: str | None,
+            inline_limit: int = 4096,
+            compression: str | None = None,
+            compress_threshold: int = 1024,
+    ):
+        """
+        :param name: pickle, msgpack or orjson. None is pickle, which is as fast as the others on our values
+         (see benchmarks/codecs.py) and keeps any python type. msgpack and orjson need their packages installed
+        :param compression: zlib, lz4, zstd or None. lz4 and zstd need their packages installed
+        """
+        if name is None:
+            name = "pickle"
+        for codec in cls._codecs.values():
+            if codec.name == name:
+                break
+        else:
+            raise ValueError(f"Unknown codec {name}")
+        if (name == "msgpack" and msgpack is None) or (name == "orjson" and orjson is None):
+            raise ModuleNotFoundError(f"{name} codec needs its package installed")
+        return cls(codec, inline_limit, cls._compression_by_name(compression), compress_threshold)
+
+    @classmethod
+    def _compression_by_name(cls, name: str | None):
+        if name is None or name == "none":
+            return
+        for compression in cls._compressions.values():
+            if compression.name == name:
+                if (name == "lz4" and lz4 is None) or (name == "zstd" and zstandard is None):
+                    raise ModuleNotFoundError(f"{name} compression needs its package installed")
+                return compression
+        raise ValueError(f"Unknown compression {name}")
+
+    def encode(self, value: Any) -> bytes:
+        if type(value) is int:
+            return self._integer.encode(value)
+        return self._compress(self._encode(value))
+
+    def _encode(self, value: Any) -> bytes:
+        if self.codec is not self._fallback:
+            try:
+                return self.codec.encode(value)
+            except (TypeError, ValueError, OverflowError):
+                pass
+        return self._fallback.encode(value)
+
+    def _compress(self, data: bytes, count: bool = True) -> bytes:
+        if self.compression is None or len(data) < self.compress_threshold:
+            return data
+        compressed = self.compression.compress(data)
+        if len(compressed) >= len(data):
+            compressed = data
+        if count:
+            self.stats.add(len(data), len(compressed))
+        return compressed
+
+    def encodings(self, value: Any) -> list[bytes]:
+        """
+        :return: every byte form the value may be stored in, for commands matching by value like LREM
+        """
+        encodings = [self.encode(value)]
+        for codec in (self.codec, self._fallback, self._codecs[LegacyPickleCodec.header[0]]):
+            try:
+                encoded = codec.encode(value)
+            except (TypeError, ValueError, OverflowError):
+                continue
+            for encoded in (encoded, self._compress(encoded, count=False)):
+                if encoded not in encodings:
+                    encodings.append(encoded)
+        return encodings
+
+    def decode_sync(self, data: bytes) -> Any:
+        if data and data[0] in self._compressions:
+            data = self._compressions[data[0]].decompress(data)
+        try:
+            codec = self._codecs[data[0]]
+        except KeyError:
+            raise ValueError(f"Unknown codec header {data[:1]}")
+        return codec.decode(data)
+
+    async def decode(self, data: bytes) -> Any:
+        return await self._decode(len(data), self.decode_sync, data)
+
+    async def decode_many(self, items: Iterable[bytes]) -> list:
+        items = list(items)
+        return await self._decode(sum(map(len, items)), lambda: [self.decode_sync(item) for item in items])
+
+    async def decode_mapping(self, mapping: dict[bytes, bytes]) -> dict[str, Any]:
+        return await self._decode(
+            sum(map(len, mapping.values())),
+            lambda: {key.decode(): self.decode_sync(value) for key, value in mapping.items()},
+        )
+
+    async def _decode(self, size: int, decode, *args):
+        if size < self.inline_limit:
+            METRICS.record_decode(size)
+            return decode(*args)
+        start = perf_counter()
+        value = await to_thread(decode, *args)
+        METRICS.record_decode(size, perf_counter() - start)
+        return value
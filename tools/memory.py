@@ -0,0 +1,686 @@
+from asyncio import Queue, QueueEmpty, wait_for
+from contextlib import asynccontextmanager
+from datetime import timedelta, datetime
+from fnmatch import fnmatchcase
+from functools import partial
+from heapq import heappush, heappop
+from time import monotonic, time
+from typing import Any, Callable, Iterable
+from zlib import crc32
+
+from redis.exceptions import ResponseError, WatchError
+
+_WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+
+def _bytes(value: Any) -> bytes:
+    """
+    Converts command argument the way redis-py encoder does
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value).encode()
+    raise TypeError(f"Invalid input of type {type(value)}, convert to bytes, string, int or float first")
+
+
+def _integer(value: bytes, error: str = "ERR value is not an integer or out of range"):
+    try:
+        return int(value)
+    except ValueError:
+        raise ResponseError(error)
+
+
+def _range(items: list, start: int, end: int) -> list:
+    """
+    Slice by redis inclusive indexes
+    """
+    start, stop, _ = slice(start, None if end == -1 else end + 1).indices(len(items))
+    return items[start:stop]
+
+
+def _expiry(ex=None, px=None, exat=None, pxat=None):
+    """
+    :return: monotonic deadline of the expiry options, None if there are none
+    """
+    if ex is not None:
+        return monotonic() + (ex.total_seconds() if isinstance(ex, timedelta) else int(ex))
+    if px is not None:
+        return monotonic() + (px.total_seconds() if isinstance(px, timedelta) else int(px) / 1000)
+    if exat is not None:
+        return monotonic() + (exat.timestamp() if isinstance(exat, datetime) else int(exat)) - time()
+    if pxat is not None:
+        return monotonic() + (pxat.timestamp() if isinstance(pxat, datetime) else int(pxat) / 1000) - time()
+
+
+class MemoryBackend:
+    """
+    Asyncio in-memory implementation of the part of redis.asyncio.Redis the storages use:
+    strings, hashes, lists, sorted sets, expiry, pipelines, optimistic transactions and pub/sub.
+    Values are bytes as in redis, so clients encoding values on top of redis work on it unchanged.
+    Commands calling other commands call them on MemoryBackend, the client may override them.
+
+    Commands never await inside, so each of them, and a whole pipeline, runs atomically in the event loop.
+    Expired keys are dropped on access and by a heap of deadlines checked on every command.
+    """
+
+    def __init__(self):
+        self._data: dict[bytes, Any] = {}
+        self._expires: dict[bytes, float] = {}
+        self._deadlines: list[tuple[float, bytes]] = []
+        self._versions: dict[bytes, int] = {}
+        self._channels: dict[bytes, set["MemoryPubSub"]] = {}
+
+    # keyspace
+
+    def _expire_due(self):
+        now = monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, key = heappop(self._deadlines)
+            if self._expires.get(key) == deadline:
+                self._drop(key)
+
+    def _drop(self, key: bytes):
+        self._data.pop(key, None)
+        self._expires.pop(key, None)
+        self._touch(key)
+
+    def _touch(self, key: bytes, fields: Iterable[bytes] | None = None):
+        """
+        :param fields: changed fields of a hash or members of a sorted set, None if the whole value may have changed
+        """
+        self._versions[key] = self._versions.get(key, 0) + 1
+
+    @asynccontextmanager
+    async def _resident(self, names: Iterable):
+        """
+        Keeps keys in memory while commands on them run, every key is always there in MemoryBackend
+        """
+        yield
+
+    async def _names(self) -> Iterable[bytes]:
+        """
+        :return: every key, including ones a backend keeps out of memory
+        """
+        self._expire_due()
+        return self._data
+
+    def _set_expiry(self, key: bytes, deadline: float | None):
+        if deadline is None:
+            self._expires.pop(key, None)
+            return
+        if deadline <= monotonic():
+            self._drop(key)
+            return
+        self._expires[key] = deadline
+        heappush(self._deadlines, (deadline, key))
+
+    def _lookup(self, name, type_: type | None = None):
+        self._expire_due()
+        value = self._data.get(_bytes(name))
+        if value is not None and type_ is not None and type(value) is not type_:
+            raise ResponseError(_WRONGTYPE)
+        return value
+
+    def _create(self, name, type_: type):
+        key = _bytes(name)
+        value = self._lookup(key, type_)
+        if value is None:
+            value = self._data[key] = type_()
+        return key, value
+
+    def _cleanup(self, key: bytes):
+        """
+        Redis drops empty hashes, lists and sorted sets
+        """
+        if not self._data.get(key, True):
+            self._drop(key)
+
+    async def delete(self, *names) -> int:
+        self._expire_due()
+        deleted = 0
+        for key in map(_bytes, names):
+            if key in self._data:
+                self._drop(key)
+                deleted += 1
+        return deleted
+
+    async def exists(self, *names) -> int:
+        return sum(self._lookup(name) is not None for name in names)
+
+    async def type(self, name) -> bytes:
+        value = self._lookup(name)
+        return {bytes: b"string", dict: b"hash", list: b"list", _SortedSet: b"zset"}.get(type(value), b"none")
+
+    async def expire(self, name, time) -> bool:
+        key = _bytes(name)
+        if self._lookup(key) is None:
+            return False
+        self._set_expiry(key, _expiry(ex=time))
+        return True
+
+    async def persist(self, name) -> bool:
+        key = _bytes(name)
+        if self._lookup(key) is None or key not in self._expires:
+            return False
+        self._set_expiry(key, None)
+        return True
+
+    async def ttl(self, name) -> int:
+        key = _bytes(name)
+        if self._lookup(key) is None:
+            return -2
+        if key not in self._expires:
+            return -1
+        return round(self._expires[key] - monotonic())
+
+    async def keys(self, pattern="*") -> list[bytes]:
+        pattern = _bytes(pattern).decode()
+        return [key for key in await self._names() if fnmatchcase(key.decode(errors="replace"), pattern)]
+
+    async def scan(self, cursor: int = 0, match=None, count: int | None = None, _type: str | None = None):
+        """
+        Keys are walked in order of their crc32 and the cursor is the crc32 to go on from,
+        so as in redis every key present for the whole scan is returned once, however the keyspace changes
+        """
+        hashed = sorted((crc32(key), key) for key in await self._names() if crc32(key) >= cursor)
+        if len(hashed) <= (count := count or 10):
+            cursor, keys = 0, [key for _, key in hashed]
+        else:
+            boundary = hashed[count][0]
+            keys = [key for hash_, key in hashed if hash_ < boundary]
+            if keys:
+                cursor = boundary
+            else:
+                keys, cursor = [key for hash_, key in hashed if hash_ == boundary], boundary + 1
+        if match is not None:
+            pattern = _bytes(match).decode()
+            keys = [key for key in keys if fnmatchcase(key.decode(errors="replace"), pattern)]
+        if _type is not None:
+            async with self._resident(keys):
+                keys = [key for key in keys if (await MemoryBackend.type(self, key)).decode() == _type]
+        return cursor, keys
+
+    async def scan_iter(self, match=None, count: int | None = None, _type: str | None = None):
+        cursor = None
+        while cursor != 0:
+            cursor, keys = await MemoryBackend.scan(self, cursor or 0, match, count, _type)
+            for key in keys:
+                yield key
+
+    async def flushdb(self, asynchronous: bool = False) -> bool:
+        for key in list(await self._names()):
+            self._drop(key)
+        return True
+
+    # strings
+
+    async def get(self, name) -> bytes | None:
+        return self._lookup(name, bytes)
+
+    async def set(
+        self, name, value, ex=None, px=None, nx=False, xx=False, keepttl=False, get=False, exat=None, pxat=None
+    ):
+        key = _bytes(name)
+        old = self._lookup(key)
+        if get and old is not None and type(old) is not bytes:
+            raise ResponseError(_WRONGTYPE)
+        if (nx and old is not None) or (xx and old is None):
+            return old if get else None
+        deadline = self._expires.get(key) if keepttl else _expiry(ex, px, exat, pxat)
+        self._data[key] = _bytes(value)
+        self._touch(key)
+        self._set_expiry(key, deadline)
+        return old if get else True
+
+    async def setex(self, name, time, value) -> bool:
+        return await MemoryBackend.set(self, name, value, ex=time)
+
+    async def getex(self, name, ex=None, px=None, exat=None, pxat=None, persist=False) -> bytes | None:
+        key = _bytes(name)
+        value = self._lookup(key, bytes)
+        if value is not None:
+            if persist:
+                self._set_expiry(key, None)
+            elif (deadline := _expiry(ex, px, exat, pxat)) is not None:
+                self._set_expiry(key, deadline)
+        return value
+
+    async def incrby(self, name, amount: int = 1) -> int:
+        key = _bytes(name)
+        value = _integer(self._lookup(key, bytes) or b"0") + amount
+        self._data[key] = _bytes(value)
+        self._touch(key)
+        return value
+
+    async def incr(self, name, amount: int = 1) -> int:
+        return await MemoryBackend.incrby(self, name, amount)
+
+    # hashes
+
+    async def hget(self, name, key) -> bytes | None:
+        return (self._lookup(name, dict) or {}).get(_bytes(key))
+
+    async def hmget(self, name, keys, *args) -> list[bytes | None]:
+        hash_ = self._lookup(name, dict) or {}
+        return [hash_.get(_bytes(key)) for key in [*([keys] if isinstance(keys, (str, bytes)) else keys), *args]]
+
+    async def hset(self, name, key=None, value=None, mapping: dict | None = None, items: list | None = None) -> int:
+        pairs = [*((mapping or {}).items()), *zip((items or [])[::2], (items or [])[1::2])]
+        if key is not None:
+            pairs.append((key, value))
+        if not pairs:
+            raise ResponseError("wrong number of arguments for 'hset' command")
+        name, hash_ = self._create(name, dict)
+        added = 0
+        fields = []
+        for field, field_value in pairs:
+            field = _bytes(field)
+            added += field not in hash_
+            hash_[field] = _bytes(field_value)
+            fields.append(field)
+        self._touch(name, fields)
+        return added
+
+    async def hsetnx(self, name, key, value) -> bool:
+        if await MemoryBackend.hexists(self, name, key):
+            return False
+        return bool(await MemoryBackend.hset(self, name, key, value))
+
+    async def hgetall(self, name) -> dict[bytes, bytes]:
+        return dict(self._lookup(name, dict) or {})
+
+    async def hkeys(self, name) -> list[bytes]:
+        return list(self._lookup(name, dict) or {})
+
+    async def hexists(self, name, key) -> bool:
+        return _bytes(key) in (self._lookup(name, dict) or {})
+
+    async def hlen(self, name) -> int:
+        return len(self._lookup(name, dict) or {})
+
+    async def hdel(self, name, *keys) -> int:
+        hash_ = self._lookup(name, dict)
+        if not hash_:
+            return 0
+        fields = list(map(_bytes, keys))
+        deleted = sum(hash_.pop(field, None) is not None for field in fields)
+        if deleted:
+            self._touch(_bytes(name), fields)
+            self._cleanup(_bytes(name))
+        return deleted
+
+    async def hincrby(self, name, key, amount: int = 1) -> int:
+        name, hash_ = self._create(name, dict)
+        field = _bytes(key)
+        value = _integer(hash_.get(field, b"0"), "ERR hash value is not an integer") + amount
+        hash_[field] = _bytes(value)
+        self._touch(name, (field,))
+        return value
+
+    async def hwithdraw(self, name, amounts: dict[str, int]) -> int:
+        """
+        Same contract as CustomRedis.hwithdraw
+        """
+        hash_ = self._lookup(name, dict) or {}
+        values = []
+        for i, (field, amount) in enumerate(amounts.items(), 1):
+            raw = hash_.get(_bytes(field), b"0")
+            try:
+                values.append(int(raw))
+            except ValueError:
+                return -i
+            if values[-1] < amount:
+                return 0
+        for (field, amount), value in zip(amounts.items(), values):
+            await MemoryBackend.hincrby(self, name, field, -amount)
+        return 1
+
+    # lists
+
+    async def rpush(self, name, *values) -> int:
+        name, list_ = self._create(name, list)
+        list_.extend(map(_bytes, values))
+        self._touch(name)
+        return len(list_)
+
+    async def lpush(self, name, *values) -> int:
+        name, list_ = self._create(name, list)
+        list_[:0] = reversed(list(map(_bytes, values)))
+        self._touch(name)
+        return len(list_)
+
+    async def _pop(self, name, count: int | None, take: Callable[[list, int], list]):
+        list_ = self._lookup(name, list)
+        if not list_:
+            return None
+        items = take(list_, 1 if count is None else count)
+        self._touch(_bytes(name))
+        self._cleanup(_bytes(name))
+        return items[0] if count is None else items
+
+    async def rpop(self, name, count: int | None = None):
+        def take(list_, n):
+            items = list_[-n:][::-1]
+            del list_[-n:]
+            return items
+        return await self._pop(name, count, take)
+
+    async def lpop(self, name, count: int | None = None):
+        def take(list_, n):
+            items = list_[:n]
+            del list_[:n]
+            return items
+        return await self._pop(name, count, take)
+
+    async def llen(self, name) -> int:
+        return len(self._lookup(name, list) or [])
+
+    async def lindex(self, name, index: int) -> bytes | None:
+        list_ = self._lookup(name, list) or []
+        if -len(list_) <= index < len(list_):
+            return list_[index]
+
+    async def lset(self, name, index: int, value) -> bool:
+        list_ = self._lookup(name, list)
+        if list_ is None:
+            raise ResponseError("ERR no such key")
+        if not -len(list_) <= index < len(list_):
+            raise ResponseError("ERR index out of range")
+        list_[index] = _bytes(value)
+        self._touch(_bytes(name))
+        return True
+
+    async def lrange(self, name, start: int, end: int) -> list[bytes]:
+        return _range(self._lookup(name, list) or [], start, end)
+
+    async def ltrim(self, name, start: int, end: int) -> bool:
+        list_ = self._lookup(name, list)
+        if list_ is not None:
+            list_[:] = _range(list_, start, end)
+            self._touch(_bytes(name))
+            self._cleanup(_bytes(name))
+        return True
+
+    async def lrem(self, name, count: int, value) -> int:
+        list_ = self._lookup(name, list)
+        if not list_:
+            return 0
+        value = _bytes(value)
+        indexes = [i for i, item in enumerate(list_) if item == value]
+        if count < 0:
+            indexes = indexes[::-1]
+        if count:
+            indexes = indexes[:abs(count)]
+        for i in sorted(indexes, reverse=True):
+            del list_[i]
+        if indexes:
+            self._touch(_bytes(name))
+            self._cleanup(_bytes(name))
+        return len(indexes)
+
+    # sorted sets
+
+    async def zadd(
+            self, name, mapping: dict, nx: bool = False, xx: bool = False, ch: bool = False, incr: bool = False
+    ) -> int | float | None:
+        """
+        :param incr: adds the score of the only member, returns the new score or None if nx or xx skipped it
+        """
+        if xx and self._lookup(name, _SortedSet) is None:
+            return None if incr else 0
+        name, zset = self._create(name, _SortedSet)
+        changed = 0
+        members = []
+        for member, score in mapping.items():
+            member = _bytes(member)
+            old = zset.get(member)
+            if (nx and old is not None) or (xx and old is None):
+                continue
+            score = float(score) + ((old or 0) if incr else 0)
+            changed += old is None or (ch and old != score)
+            zset[member] = score
+            members.append(member)
+        self._touch(name, members)
+        if incr:
+            return zset[members[0]] if members else None
+        return changed
+
+    async def zincrby(self, name, amount: float, value) -> float:
+        name, zset = self._create(name, _SortedSet)
+        member = _bytes(value)
+        zset[member] = zset.get(member, 0) + amount
+        self._touch(name, (member,))
+        return zset[member]
+
+    async def zscore(self, name, value) -> float | None:
+        return (self._lookup(name, _SortedSet) or {}).get(_bytes(value))
+
+    async def zcard(self, name) -> int:
+        return len(self._lookup(name, _SortedSet) or {})
+
+    async def zrem(self, name, *values) -> int:
+        zset = self._lookup(name, _SortedSet)
+        if not zset:
+            return 0
+        members = list(map(_bytes, values))
+        removed = sum(zset.pop(member, None) is not None for member in members)
+        if removed:
+            self._touch(_bytes(name), members)
+            self._cleanup(_bytes(name))
+        return removed
+
+    async def zrange(self, name, start: int, end: int, desc: bool = False, withscores: bool = False):
+        items = sorted((self._lookup(name, _SortedSet) or {}).items(), key=lambda item: (item[1], item[0]))
+        if desc:
+            items.reverse()
+        items = _range(items, start, end)
+        return items if withscores else [member for member, _ in items]
+
+    async def zrevrange(self, name, start: int, end: int, withscores: bool = False):
+        return await MemoryBackend.zrange(self, name, start, end, desc=True, withscores=withscores)
+
+    async def zpopmin(self, name, count: int | None = None) -> list[tuple[bytes, float]]:
+        items = await MemoryBackend.zrange(self, name, 0, (count or 1) - 1, withscores=True)
+        if items:
+            await MemoryBackend.zrem(self, name, *(member for member, _ in items))
+        return items
+
+    # pub/sub
+
+    async def publish(self, channel, message) -> int:
+        subscribers = self._channels.get(_bytes(channel), ())
+        for pubsub in subscribers:
+            pubsub.deliver("message", _bytes(channel), _bytes(message))
+        return len(subscribers)
+
+    async def bump_version(self, name, channel: str, message: str) -> int:
+        """
+        Same contract as CustomRedis.bump_version
+        """
+        version = await MemoryBackend.incr(self, name)
+        await MemoryBackend.publish(self, channel, f"{version}:{message}")
+        return version
+
+    def pubsub(self, **_):
+        return MemoryPubSub(self)
+
+    # pipelines
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return MemoryPipeline(self, transaction)
+
+    async def transaction(self, func, *watches, shard_hint=None, value_from_callable: bool = False, watch_delay=None):
+        async with self.pipeline(True) as pipe:
+            while True:
+                try:
+                    if watches:
+                        await pipe.watch(*watches)
+                    func_value = func(pipe)
+                    if hasattr(func_value, "__await__"):
+                        func_value = await func_value
+                    exec_value = await pipe.execute()
+                    return func_value if value_from_callable else exec_value
+                except WatchError:
+                    continue
+
+    # connection
+
+    async def initialize(self):
+        return self
+
+    async def ping(self, **_) -> bool:
+        return True
+
+    async def aclose(self, close_connection_pool: bool | None = None):
+        pass
+
+    async def close(self, close_connection_pool: bool | None = None):
+        await self.aclose(close_connection_pool)
+
+
+class _SortedSet(dict):
+    """
+    Member to score mapping, distinguished from hashes by type
+    """
+
+
+def _command_keys(command: str, args: tuple, kwargs: dict) -> tuple:
+    """
+    :return: keys a command of MemoryBackend reads or writes
+    """
+    if command in ("delete", "exists"):
+        return args
+    if command in ("publish", "keys", "scan", "flushdb", "ping"):
+        return ()
+    return args[:1] or (kwargs["name"],)
+
+
+class MemoryPipeline:
+    """
+    Queues commands and runs them in one go on execute, like redis-py pipeline.
+    After watch() and before multi() commands run right away, as in redis.
+    Commands are the bytes ones of MemoryBackend, even if the backend is wrapped by a serializing client.
+    """
+
+    def __init__(self, backend: MemoryBackend, transaction: bool = True):
+        self._backend = backend
+        self._transaction = transaction
+        self._watched: dict[bytes, int] = {}
+        self._explicit_multi = False
+        self.command_stack: list[tuple[str, tuple, dict]] = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.reset()
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def __getattr__(self, command: str):
+        method = partial(getattr(MemoryBackend, command), self._backend)
+
+        async def immediate(*args, **kwargs):
+            async with self._backend._resident(_command_keys(command, args, kwargs)):
+                return await method(*args, **kwargs)
+
+        def queue(*args, **kwargs):
+            if self._watched and not self._explicit_multi:
+                return immediate(*args, **kwargs)
+            self.command_stack.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    async def watch(self, *names):
+        for key in map(_bytes, names):
+            self._watched[key] = self._backend._versions.get(key, 0)
+        return True
+
+    async def unwatch(self):
+        self._watched = {}
+        return True
+
+    def multi(self):
+        self._explicit_multi = True
+
+    async def execute(self, raise_on_error: bool = True) -> list:
+        stack, watched = self.command_stack, self._watched
+        await self.reset()
+        keys = [key for command, args, kwargs in stack for key in _command_keys(command, args, kwargs)]
+        async with self._backend._resident(keys):
+            self._backend._expire_due()
+            if any(self._backend._versions.get(key, 0) != version for key, version in watched.items()):
+                raise WatchError("Watched variable changed.")
+            results = []
+            for command, args, kwargs in stack:
+                try:
+                    results.append(await getattr(MemoryBackend, command)(self._backend, *args, **kwargs))
+                except ResponseError as e:
+                    results.append(e)
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, ResponseError):
+                    raise result
+        return results
+
+    async def reset(self):
+        self.command_stack = []
+        self._watched = {}
+        self._explicit_multi = False
+
+    async def aclose(self):
+        await self.reset()
+
+
+class MemoryPubSub:
+    def __init__(self, backend: MemoryBackend):
+        self._backend = backend
+        self._messages: Queue[dict] = Queue()
+        self.channels: set[bytes] = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def deliver(self, type_: str, channel: bytes, data: Any):
+        self._messages.put_nowait({"type": type_, "pattern": None, "channel": channel, "data": data})
+
+    async def subscribe(self, *channels: Iterable):
+        for channel in map(_bytes, channels):
+            self._backend._channels.setdefault(channel, set()).add(self)
+            self.channels.add(channel)
+            self.deliver("subscribe", channel, len(self.channels))
+
+    async def unsubscribe(self, *channels):
+        for channel in map(_bytes, channels or list(self.channels)):
+            self._backend._channels.get(channel, set()).discard(self)
+            self.channels.discard(channel)
+            self.deliver("unsubscribe", channel, len(self.channels))
+
+    async def get_message(self, ignore_subscribe_messages: bool = False, timeout: float | None = 0.0):
+        while True:
+            try:
+                if timeout is None:
+                    message = await self._messages.get()
+                elif timeout <= 0:
+                    message = self._messages.get_nowait()
+                else:
+                    message = await wait_for(self._messages.get(), timeout)
+            except (QueueEmpty, TimeoutError):
+                return None
+            if not (ignore_subscribe_messages and message["type"] in ("subscribe", "unsubscribe")):
+                return message
+
+    async def aclose(self):
+        await self.unsubscribe()
+
+    reset = aclose
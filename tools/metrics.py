@@ -0,0 +1,167 @@
+from asyncio import sleep
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from logging import getLogger
+from re import compile
+
+logger = getLogger()
+
+_scope: ContextVar[str] = ContextVar("storage_scope", default="-")
+_namespace: ContextVar[str] = ContextVar("storage_namespace", default="-")
+_ID = compile(r"-?\d+")
+
+
+def namespace_of(key) -> str:
+    """
+    "{user_id}:user_storage" -> user_storage, "{chat_id}:{bot_id}:context_stack" -> context_stack,
+    "dictionary.yandex.net:word" -> dictionary.yandex.net
+    """
+    if isinstance(key, bytes):
+        key = key.decode(errors="replace")
+    parts = str(key).split(":")
+    if _ID.fullmatch(parts[0]):
+        return next((part for part in parts if not _ID.fullmatch(part)), parts[-1])
+    return parts[0]
+
+
+def scoped(scope: str):
+    """
+    Attributes storage operations of the decorated coroutine function to scope, the innermost scope wins
+    """
+    def decorator(function):
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            token = _scope.set(scope)
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                _scope.reset(token)
+        return wrapper
+    return decorator
+
+
+class Histogram:
+    BOUNDS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+
+    def add(self, seconds: float):
+        self.counts[bisect_left(self.BOUNDS_MS, seconds * 1000)] += 1
+
+    def quantile(self, q: float):
+        """
+        :return: upper bound in ms of the bucket holding quantile q, inf for the last bucket
+        """
+        rank = q * sum(self.counts)
+        seen = 0
+        for bound, count in zip((*self.BOUNDS_MS, float("inf")), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0
+
+
+class OperationStats:
+    def __init__(self):
+        self.round_trips = 0
+        self.commands: dict[str, int] = {}
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.decoded_bytes = 0
+        self.thread_decode_seconds = 0.0
+        self.latency = Histogram()
+
+    def as_dict(self):
+        return {
+            "round_trips": self.round_trips,
+            "commands": dict(self.commands),
+            "sent_bytes": self.sent_bytes,
+            "received_bytes": self.received_bytes,
+            "decoded_bytes": self.decoded_bytes,
+            "thread_decode_seconds": self.thread_decode_seconds,
+            "latency_ms_buckets": dict(zip((*Histogram.BOUNDS_MS, "inf"), self.latency.counts)),
+        }
+
+
+class StorageMetrics:
+    """
+    Storage operations per (scope, namespace): scope is the code path set by scoped(),
+    namespace is derived from the key by namespace_of().
+    A pipeline is one round trip, its latency is recorded for every namespace it touched.
+    Decoding is attributed to the namespace of the last command of the task, which fetched the decoded data.
+    """
+
+    def __init__(self):
+        self.stats: dict[tuple[str, str], OperationStats] = {}
+
+    def _get(self, namespace: str) -> OperationStats:
+        try:
+            return self.stats[(_scope.get(), namespace)]
+        except KeyError:
+            stats = self.stats[(_scope.get(), namespace)] = OperationStats()
+            return stats
+
+    def record(self, commands: list[tuple[str, object]], seconds: float, sent: int, received: int):
+        """
+        :param commands: command name and key of every command sent in one round trip
+        """
+        namespaces = set()
+        for command, key in commands:
+            namespace = namespace_of(key)
+            stats = self._get(namespace)
+            stats.commands[command] = stats.commands.get(command, 0) + 1
+            namespaces.add(namespace)
+        for namespace in namespaces:
+            stats = self._get(namespace)
+            stats.round_trips += 1
+            stats.latency.add(seconds)
+            stats.sent_bytes += sent // len(namespaces)
+            stats.received_bytes += received // len(namespaces)
+        if namespaces:
+            _namespace.set(next(iter(namespaces)) if len(namespaces) == 1 else "pipeline")
+
+    def record_decode(self, size: int, seconds: float | None = None):
+        """
+        :param seconds: time spent in the executor, None for inline decoding
+        """
+        stats = self._get(_namespace.get())
+        stats.decoded_bytes += size
+        if seconds is not None:
+            stats.thread_decode_seconds += seconds
+
+    def snapshot(self) -> dict[str, dict[str, dict]]:
+        """
+        :return: {scope: {namespace: stats}}
+        """
+        result = {}
+        for (scope, namespace), stats in self.stats.items():
+            result.setdefault(scope, {})[namespace] = stats.as_dict()
+        return result
+
+    def summary(self, top: int = 15) -> str:
+        rows = sorted(self.stats.items(), key=lambda item: item[1].round_trips, reverse=True)[:top]
+        lines = [
+            f"{scope:<12}{namespace:<32}{stats.round_trips:>8} rt {sum(stats.commands.values()):>8} cmd "
+            f"{stats.sent_bytes:>10} B out {stats.received_bytes:>10} B in "
+            f"p50 {stats.latency.quantile(0.5)} ms p99 {stats.latency.quantile(0.99)} ms "
+            f"thread decode {stats.thread_decode_seconds:.3f} s"
+            for (scope, namespace), stats in rows
+        ]
+        return "\n".join(["Storage operations since the last summary:", *lines]) if lines else "No storage operations"
+
+    def reset(self):
+        self.stats = {}
+
+    async def report(self, interval: float = 300):
+        """
+        Logs the summary every interval seconds and starts counting anew
+        """
+        while True:
+            await sleep(interval)
+            logger.info(self.summary())
+            self.reset()
+
+
+METRICS = StorageMetrics()
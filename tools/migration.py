@@ -0,0 +1,153 @@
+"""
+Online conversion of keys still holding old pickled values to the native layout of their storages.
+
+    python -m tools.migration [--batch-size 500] [--concurrency 4] [--restart]
+
+Runs next to the bot: storages read both layouts and convert a key on first touch (see Storage._native),
+so the migration only has to catch up with keys nobody touched.
+API caches are moved by SuperEnglishDictionary.migrate_caches() on bot start.
+"""
+import asyncio
+from argparse import ArgumentParser
+from collections import deque
+from fnmatch import fnmatchcase
+from functools import partial
+from logging import getLogger, basicConfig, INFO
+from time import monotonic
+from typing import Callable
+
+from redis.exceptions import WatchError
+
+from tools import Storage, HashStorage, NativeListStorage, MESSAGES_IDS_POLICY, CONTEXT_POLICY
+
+logger = getLogger()
+
+
+class Migrator:
+    """
+    Keys are streamed by SCAN and converted in batches: old values are read in one pipeline
+    and replaced in one MULTI guarded by WATCH. If the bot writes some key of the batch meanwhile,
+    the batch falls back to converting its keys one by one.
+    Up to concurrency batches are in flight. After a batch and every batch before it are done,
+    the SCAN cursor is saved to checkpoint_key, so a stopped migration goes on from there.
+    """
+    RULES: tuple[tuple[str, Callable[[str], Storage]], ...] = (
+        ("*:user_storage", HashStorage),
+        ("*:bot_storage", HashStorage),
+        ("*:messages_ids", partial(NativeListStorage, **MESSAGES_IDS_POLICY)),
+        ("*:context_stack", partial(NativeListStorage, **CONTEXT_POLICY)),
+    )
+
+    def __init__(
+            self,
+            batch_size: int = 500,
+            concurrency: int = 4,
+            checkpoint_key: str = "migration:native_layout:cursor",
+            report_interval: float = 10,
+    ):
+        self._batch_size = batch_size
+        self._concurrency = concurrency
+        self._checkpoint_key = checkpoint_key
+        self._report_interval = report_interval
+        self.scanned = 0
+        self.converted = 0
+        self.conflicts = 0
+        self._started = 0.0
+        self._reported = 0.0
+
+    async def run(self, restart: bool = False):
+        """
+        :param restart: scan from the beginning instead of the saved cursor
+        """
+        client = Storage.CLIENT
+        cursor = 0 if restart else int(await client.raw("get")(self._checkpoint_key) or 0)
+        if cursor:
+            logger.info(f"Resuming migration from cursor {cursor}")
+        self._started = self._reported = monotonic()
+        in_flight: deque[tuple[int, asyncio.Task]] = deque()
+        while True:
+            cursor, keys = await client.raw("scan")(cursor, count=self._batch_size)
+            self.scanned += len(keys)
+            in_flight.append((cursor, asyncio.create_task(self._convert_batch(keys))))
+            while len(in_flight) >= self._concurrency or (cursor == 0 and in_flight):
+                await self._checkpoint(*in_flight.popleft())
+            self._report()
+            if cursor == 0:
+                break
+        await client.delete(self._checkpoint_key)
+        self._report(final=True)
+
+    async def _checkpoint(self, cursor: int, task: asyncio.Task):
+        await task
+        if cursor:
+            await Storage.CLIENT.raw("set")(self._checkpoint_key, cursor)
+
+    def _storage(self, key: bytes) -> Storage | None:
+        name = key.decode(errors="replace")
+        for pattern, storage in self.RULES:
+            if fnmatchcase(name, pattern):
+                return storage(name)
+
+    async def _convert_batch(self, keys: list[bytes]):
+        client = Storage.CLIENT
+        storages = [storage for storage in map(self._storage, keys) if storage is not None]
+        if not storages:
+            return
+        async with client.pipeline(transaction=False) as pipe:
+            for storage in storages:
+                pipe.type(storage._key)
+            types = await pipe.execute()
+        storages = [storage for storage, type_ in zip(storages, types) if type_ == b"string"]
+        if not storages:
+            return
+
+        async with client.pipeline(transaction=True) as transaction:
+            await transaction.watch(*(storage._key for storage in storages))
+            async with client.pipeline(transaction=False) as pipe:
+                for storage in storages:
+                    pipe.get(storage._key)
+                blobs = await pipe.execute()
+            transaction.multi()
+            for storage, blob in zip(storages, blobs):
+                if blob is not None:
+                    storage._convert(transaction, await client.serializer.decode(blob))
+            try:
+                await transaction.execute()
+                self.converted += len(storages)
+                return
+            except WatchError:
+                self.conflicts += 1
+
+        for storage in storages:
+            await client.transaction(storage._migrate, storage._key)
+            self.converted += 1
+
+    def _report(self, final: bool = False):
+        now = monotonic()
+        if not final and now - self._reported < self._report_interval:
+            return
+        self._reported = now
+        elapsed = max(now - self._started, 1e-9)
+        logger.info(
+            f"Migration {'finished' if final else 'in progress'}: {self.scanned} keys scanned "
+            f"({self.scanned / elapsed:.0f}/s), {self.converted} converted ({self.converted / elapsed:.0f}/s), "
+            f"{self.conflicts} batches retried key by key"
+        )
+
+
+async def main():
+    parser = ArgumentParser(description="Convert pickled storages to the native redis layout")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--restart", action="store_true", help="ignore the saved cursor")
+    args = parser.parse_args()
+    basicConfig(level=INFO)
+    await Storage.CLIENT.initialize()
+    try:
+        await Migrator(args.batch_size, args.concurrency).run(args.restart)
+    finally:
+        await Storage.CLIENT.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,349 @@
+from asyncio import sleep, create_task, CancelledError, Lock, Task, shield
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import wraps
+from logging import getLogger
+from pickle import loads
+from time import monotonic, time
+from typing import Any, Iterable
+
+from tools.memory import MemoryBackend, _SortedSet, _bytes
+
+try:
+    import aiosqlite
+except ModuleNotFoundError:
+    aiosqlite = None
+
+logger = getLogger()
+
+
+def _loading(command: str):
+    """
+    :return: command of MemoryBackend run after the keys it touches are loaded
+    """
+    method = getattr(MemoryBackend, command)
+
+    @wraps(method)
+    async def wrapper(self: "SqliteBackend", *args, **kwargs):
+        names = args if command in ("delete", "exists") else args[:1] or (kwargs["name"],)
+        async with self._resident(names):
+            return await method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class SqliteBackend(MemoryBackend):
+    """
+    MemoryBackend persisted to a SQLite database in WAL mode, for single-node deployments without redis.
+    Rows follow the redis layout: a keyspace row per key, holding the value of a string,
+    and an items row per field of a hash, member of a sorted set or item of a list, at its position.
+
+    Memory is a read cache of at most cache_size keys: a command first loads the keys it touches,
+    then runs in memory with MemoryBackend semantics. Changes are written behind every flush_interval seconds
+    in one transaction, only the changed rows: fields and members a command changed, list items that moved
+    or changed. Keys not changed since they were written are dropped from memory the least recently used first.
+    A crash loses at most flush_interval seconds of writes.
+    """
+    _TYPES = {bytes: "string", dict: "hash", list: "list", _SortedSet: "zset"}
+    _SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS keyspace (
+            key BLOB PRIMARY KEY,
+            type TEXT NOT NULL,
+            value BLOB,
+            expires_at REAL
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS items (
+            key BLOB NOT NULL,
+            field NOT NULL,
+            value NOT NULL,
+            PRIMARY KEY (key, field)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS keyspace_expires_at ON keyspace (expires_at) WHERE expires_at IS NOT NULL",
+    )
+    _SELECT_KEY = "SELECT type, value, expires_at FROM keyspace WHERE key = ?"
+    _SELECT_ITEMS = "SELECT field, value FROM items WHERE key = ? ORDER BY field"
+    _SELECT_NAMES = "SELECT key FROM keyspace WHERE expires_at IS NULL OR expires_at > ?"
+    _UPSERT_KEY = """
+    INSERT INTO keyspace (key, type, value, expires_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT (key) DO UPDATE SET type = excluded.type, value = excluded.value, expires_at = excluded.expires_at
+    """
+    _UPSERT_ITEM = """
+    INSERT INTO items (key, field, value) VALUES (?, ?, ?)
+    ON CONFLICT (key, field) DO UPDATE SET value = excluded.value
+    """
+    _DELETE_KEY = "DELETE FROM keyspace WHERE key = ?"
+    _DELETE_ITEMS = "DELETE FROM items WHERE key = ?"
+    _DELETE_ITEM = "DELETE FROM items WHERE key = ? AND field = ?"
+    _DELETE_POSITIONS = "DELETE FROM items WHERE key = ? AND field >= ? AND field < ?"
+    _DELETE_EXPIRED = (
+        "DELETE FROM items WHERE key IN (SELECT key FROM keyspace WHERE expires_at <= ?)",
+        "DELETE FROM keyspace WHERE expires_at <= ?",
+    )
+
+    def __init__(self, path: str, flush_interval: float = 0.05, cache_size: int = 10000):
+        """
+        :param cache_size: keys kept in memory, more are kept while they have changes not written yet
+        """
+        if aiosqlite is None:
+            raise ModuleNotFoundError("sqlite storage backend needs aiosqlite installed")
+        super().__init__()
+        self._path = path
+        self._flush_interval = flush_interval
+        self._cache_size = cache_size
+        # Keys in memory and the type of each as written, None if it isn't written
+        self._stored: dict[bytes, str | None] = {}
+        self._recent: OrderedDict[bytes, None] = OrderedDict()
+        self._pins: dict[bytes, int] = {}
+        self._loads: dict[bytes, Task] = {}
+        # Changed keys with fields changed, None if the whole value may have changed
+        self._dirty: dict[bytes, set[bytes] | None] = {}
+        # Position of the first item and items of the lists as written
+        self._lists: dict[bytes, tuple[int, list[bytes]]] = {}
+        self._flushing = Lock()
+        self._db: Any = None
+        self._flusher = None
+
+    def _touch(self, key: bytes, fields: Iterable[bytes] | None = None):
+        super()._touch(key, fields)
+        if key not in self._stored:
+            # Dropped by flushdb without being loaded
+            self._stored[key] = None
+            self._recent[key] = None
+        if fields is None:
+            self._dirty[key] = None
+        elif (changed := self._dirty.setdefault(key, set())) is not None:
+            changed.update(fields)
+
+    def _set_expiry(self, key: bytes, deadline: float | None):
+        super()._set_expiry(key, deadline)
+        self._dirty.setdefault(key, set())
+
+    @asynccontextmanager
+    async def _resident(self, names: Iterable):
+        keys = list(map(_bytes, names))
+        for key in keys:
+            self._pins[key] = self._pins.get(key, 0) + 1
+        try:
+            for key in keys:
+                if key not in self._stored:
+                    if key not in self._loads:
+                        self._loads[key] = create_task(self._load(key))
+                    await shield(self._loads[key])
+                self._recent.move_to_end(key)
+            yield
+        finally:
+            for key in keys:
+                if self._pins[key] == 1:
+                    del self._pins[key]
+                else:
+                    self._pins[key] -= 1
+
+    async def _load(self, key: bytes):
+        try:
+            async with self._db.execute(self._SELECT_KEY, (key,)) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                self._stored[key] = None
+            else:
+                type_, value, expires_at = row
+                if type_ != "string":
+                    async with self._db.execute(self._SELECT_ITEMS, (key,)) as cursor:
+                        items = await cursor.fetchall()
+                self._stored[key] = type_
+                if expires_at is not None and expires_at <= time():
+                    # Deleted with the next flush
+                    self._dirty[key] = None
+                elif type_ == "string":
+                    self._data[key] = value
+                elif type_ == "hash":
+                    self._data[key] = dict(items)
+                elif type_ == "zset":
+                    self._data[key] = _SortedSet(items)
+                else:
+                    self._data[key] = [item for _, item in items]
+                    self._lists[key] = (items[0][0] if items else 0, list(self._data[key]))
+                if key in self._data and expires_at is not None:
+                    super()._set_expiry(key, monotonic() + expires_at - time())
+            self._recent[key] = None
+        finally:
+            del self._loads[key]
+
+    async def _names(self) -> Iterable[bytes]:
+        await self.flush()
+        async with self._db.execute(self._SELECT_NAMES, (time(),)) as cursor:
+            return [key for key, in await cursor.fetchall()]
+
+    (
+        delete, exists, type, expire, persist, ttl,
+        get, set, setex, getex, incrby, incr,
+        hget, hmget, hset, hsetnx, hgetall, hkeys, hexists, hlen, hdel, hincrby, hwithdraw,
+        rpush, lpush, rpop, lpop, llen, lindex, lset, lrange, ltrim, lrem,
+        zadd, zincrby, zscore, zcard, zrem, zrange, zrevrange, zpopmin,
+        bump_version,
+    ) = map(_loading, (
+        "delete", "exists", "type", "expire", "persist", "ttl",
+        "get", "set", "setex", "getex", "incrby", "incr",
+        "hget", "hmget", "hset", "hsetnx", "hgetall", "hkeys", "hexists", "hlen", "hdel", "hincrby", "hwithdraw",
+        "rpush", "lpush", "rpop", "lpop", "llen", "lindex", "lset", "lrange", "ltrim", "lrem",
+        "zadd", "zincrby", "zscore", "zcard", "zrem", "zrange", "zrevrange", "zpopmin",
+        "bump_version",
+    ))
+
+    async def initialize(self):
+        if self._db is not None:
+            return self
+        self._db = await aiosqlite.connect(self._path)
+        await self._db.execute("PRAGMA journal_mode = WAL")
+        await self._db.execute("PRAGMA synchronous = NORMAL")
+        for statement in self._SCHEMA:
+            await self._db.execute(statement)
+        await self._migrate_blobs()
+        for statement in self._DELETE_EXPIRED:
+            await self._db.execute(statement, (time(),))
+        await self._db.commit()
+        self._flusher = create_task(self._flush_periodically())
+        return self
+
+    async def _migrate_blobs(self):
+        """
+        Splits values of the first layout, a pickled blob per key, into rows
+        """
+        async with self._db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'keys'") as cursor:
+            if await cursor.fetchone() is None:
+                return
+        async with self._db.execute("SELECT key, type, value, expires_at FROM keys") as cursor:
+            rows = await cursor.fetchall()
+        for key, type_, value, expires_at in rows:
+            if type_ == "string":
+                await self._db.execute(self._UPSERT_KEY, (key, type_, value, expires_at))
+                continue
+            await self._db.execute(self._UPSERT_KEY, (key, type_, None, expires_at))
+            value = loads(value)
+            items = enumerate(value) if type_ == "list" else value.items()
+            await self._db.executemany(self._UPSERT_ITEM, ((key, field, item) for field, item in items))
+        await self._db.execute("DROP TABLE keys")
+        logger.info(f"Moved {self._path} to the row per field layout")
+
+    async def aclose(self, close_connection_pool: bool | None = None):
+        if self._db is None:
+            return
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except CancelledError:
+            pass
+        await self.flush()
+        await self._db.close()
+        self._db = None
+
+    async def flush(self):
+        """
+        Writes changes since the last flush in one transaction, then drops from memory keys over cache_size
+        """
+        async with self._flushing:
+            if self._dirty:
+                await self._write()
+            self._evict()
+
+    async def _write(self):
+        dirty, self._dirty = self._dirty, {}
+        statements, stored, lists = [], {}, {}
+        # Rows are collected without awaiting, so they are of one moment
+        for key, fields in dirty.items():
+            value = self._data.get(key)
+            if value is None:
+                statements.append((self._DELETE_KEY, (key,)))
+                statements.append((self._DELETE_ITEMS, (key,)))
+                stored[key] = None
+                continue
+            type_ = self._TYPES[type(value)]
+            deadline = self._expires.get(key)
+            expires_at = None if deadline is None else time() + deadline - monotonic()
+            statements.append((self._UPSERT_KEY, (key, type_, value if type_ == "string" else None, expires_at)))
+            if self._stored.get(key) != type_:
+                statements.append((self._DELETE_ITEMS, (key,)))
+                fields, base, written = None, 0, []
+            elif type_ == "list":
+                base, written = self._lists[key]
+            stored[key] = type_
+            if type_ == "list":
+                lists[key] = self._list_rows(key, base, written, value, statements)
+            elif type_ != "string":
+                for field in value if fields is None else fields:
+                    if field in value:
+                        statements.append((self._UPSERT_ITEM, (key, field, value[field])))
+                    else:
+                        statements.append((self._DELETE_ITEM, (key, field)))
+        try:
+            for statement, parameters in statements:
+                await self._db.execute(statement, parameters)
+            await self._db.commit()
+        except BaseException:
+            await shield(self._db.rollback())
+            for key, fields in dirty.items():
+                changed = self._dirty.get(key, set())
+                self._dirty[key] = None if fields is None or changed is None else fields | changed
+            raise
+        for key, type_ in stored.items():
+            if key in self._stored:
+                self._stored[key] = type_
+            if type_ != "list":
+                self._lists.pop(key, None)
+        self._lists.update(lists)
+
+    def _list_rows(self, key: bytes, base: int, written: list[bytes], items: list[bytes], statements: list):
+        """
+        Positions of items are aligned with the written ones at the start, at the end or where the first item
+        of one is in the other, whichever leaves more rows as they are,
+        so pushes, pops and trims at both ends write only the items they changed.
+        :return: position of the first item and items as written by statements
+        """
+        firsts = {base, base + len(written) - len(items)}
+        if written and items:
+            if written[0] in items:
+                firsts.add(base - items.index(written[0]))
+            if items[0] in written:
+                firsts.add(base + written.index(items[0]))
+        candidates = []
+        for first in sorted(firsts, key=lambda first: first != base):
+            shift = first - base
+            start, stop = max(0, -shift), max(0, min(len(items), len(written) - shift))
+            if start < stop and items[start:stop] == written[start + shift:stop + shift]:
+                changed = [*range(start), *range(stop, len(items))]
+            else:
+                changed = [
+                    i for i, item in enumerate(items) if not (start <= i < stop and item == written[i + shift])
+                ]
+            candidates.append((len(changed), first, changed))
+        _, first, changed = min(candidates, key=lambda candidate: candidate[0])
+        if first > base:
+            statements.append((self._DELETE_POSITIONS, (key, base, min(first, base + len(written)))))
+        if first + len(items) < base + len(written):
+            statements.append((self._DELETE_POSITIONS, (key, max(first + len(items), base), base + len(written))))
+        statements.extend((self._UPSERT_ITEM, (key, first + i, items[i])) for i in changed)
+        return first, list(items)
+
+    def _evict(self):
+        excess = len(self._stored) - self._cache_size
+        for key in list(self._recent):
+            if excess <= 0:
+                break
+            if key in self._dirty or key in self._pins:
+                continue
+            del self._recent[key], self._stored[key]
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+            self._lists.pop(key, None)
+            excess -= 1
+
+    async def _flush_periodically(self):
+        while True:
+            await sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.error(f"Failed to write to {self._path}, retrying", exc_info=True)
@@ -6,8 +6,10 @@ from aiogram.filters import StateFilter, Command
 from aiogram.types import Message, BotCommand
 
 from FSM import States
+from config import OFFER_SIZE
 from core import Routers, BotControl
 from core.markups import Info
+from tools import Emoji
 from models.english import SuggestWords
 
 commands_router = Routers.private()
@@ -37,8 +39,10 @@ async def accept_offer_words(message: Message, bot_control: BotControl):
         return
 
     offer = await bot_control.bot_storage.get_value_by_key("offer", set())
-    for word in words:
-        offer.add(word)
+    if len(offer | words) > OFFER_SIZE:
+        await bot_control.append(Info(f"Too many words are waiting for review, try later {Emoji.CRYING_CAT}"))
+        return
+    offer.update(words)
     await bot_control.bot_storage.set_value_by_key("offer", offer)
 
     suggest: SuggestWords = await bot_control.get_current()
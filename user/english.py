@@ -35,12 +35,13 @@ async def run_english(callback: CallbackQuery, bot_control: BotControl):
         return
 
     deck = []
-    for cards in (await gather(*(SuperEnglishDictionary.extract_cards(word) for word in words if word not in ban_list))):
-        deck.extend(cards)
+    for refs in (await gather(*(SuperEnglishDictionary.extract_card_refs(word) for word in words if word not in ban_list))):
+        deck.extend(refs)
 
     shuffle(deck)
 
     english = English(deck)
+    await english.draw_card()
     await bot_control.append(
         english
     )
@@ -63,7 +64,7 @@ async def accept_input_text_word_translate(message: Message, bot_control: BotCon
 @english_router.callback_query(F.data == "reference")
 async def reference(callback: CallbackQuery, bot_control: BotControl):
     english: English = await bot_control.get_current()
-    english.reference()
+    await english.reference()
     await bot_control.append(english)
 
 
@@ -71,7 +72,7 @@ async def reference(callback: CallbackQuery, bot_control: BotControl):
 async def draw_card(callback: CallbackQuery, bot_control: BotControl):
     english: English = await bot_control.get_current()
     try:
-        english.draw_card()
+        await english.draw_card()
     except IndexError:
         english.result()
 
@@ -110,7 +111,9 @@ async def inspect_english_run(callback: CallbackQuery, bot_control: BotControl):
 @english_router.callback_query(BanWordCallbackData.filter())
 async def banning_words(callback: CallbackQuery, callback_data: BanWordCallbackData, bot_control: BotControl):
     inspect: InspectEnglishRun = await bot_control.get_current()
-    await inspect.banning(bot_control, callback_data.index, callback_data.word)
+    word = inspect.resolve(callback_data.token, callback_data.window)
+    if word is not None:
+        await inspect.banning(bot_control, word)
     await bot_control.set_current(inspect)
 
 
@@ -1,3 +1,5 @@
+from re import Match
+
 from aiogram import F
 from aiogram.filters.callback_data import CallbackData
 from aiogram.types import CallbackQuery
@@ -21,8 +23,12 @@ async def open_shop(callback: CallbackQuery, bot_control: BotControl):
 @private_shop_router.callback_query(BuyingContentCallbackData.filter())
 async def buy(callback: CallbackQuery, callback_data: BuyingContentCallbackData, bot_control: BotControl):
     shop: Shop = await bot_control.get_current()
+    name = shop.resolve(callback_data.token, callback_data.window)
     shop_data = await bot_control.bot_storage.get_value_by_key("shop")
-    item = shop_data[callback_data.name]
+    item = shop_data.get(name)
+    if item is None:
+        await bot_control.set_current(shop)
+        return
     widget = "\n"
     for currency, cost in item["cost"].items():
         if int(shop.temp_balance[currency]) < cost:
@@ -30,23 +36,29 @@ async def buy(callback: CallbackQuery, callback_data: BuyingContentCallbackData,
             return
         widget += f"{currency} {cost}\n"
 
-    await bot_control.append(Conform(f"Conform buying {callback_data.name}?{widget}",
-                                     yes_callback_data=f"buying:{callback_data.name}"))
+    await bot_control.append(Conform(f"Conform buying {name}?{widget}",
+                                     yes_callback_data=f"buying:{callback_data.token}:{callback_data.window}"))
 
 
-@private_shop_router.callback_query(F.data.startswith("buying:"))
-async def buying(callback: CallbackQuery, bot_control: BotControl):
+@private_shop_router.callback_query(F.data.regexp(r"buying:(\d+):(\w+)").as_("token"))
+async def buying(callback: CallbackQuery, bot_control: BotControl, token: Match[str]):
     await bot_control.pop_last()
     shop: Shop = await bot_control.get_current()
 
-    _, name = callback.data.split(":")
-    await shop.buying(bot_control, name)
+    name = shop.resolve(int(token.group(1)), token.group(2))
+    if name is None:
+        await bot_control.set_current(shop)
+        return
+    if not await shop.buying(bot_control, name):
+        await bot_control.append(Info(f"Now enough funds {Emoji.CRYING_CAT}"))
+        return
 
     await bot_control.set_current(shop)
 
 
 class ShowItemCallbackData(CallbackData, prefix="show_item"):
-    name: str
+    token: int
+    window: str
 
 
 @private_shop_router.callback_query(F.data == "collection")
@@ -55,21 +67,25 @@ async def collection_(callback: CallbackQuery, bot_control: BotControl):
     if not collection_data:
         await bot_control.append(Info(f"No items so far {Emoji.WEB}"))
 
-    buttons = []
-    for name, content in collection_data.items():
-        buttons.append(ButtonWidget(text=name, callback_data=ShowItemCallbackData(name=name)))
     collection = WindowBuilder(
-        paginated_buttons=buttons,
         buttons_height=3,
         buttons_width=30
     )
+    collection.paginated_buttons = [
+        ButtonWidget(text=name, callback_data=ShowItemCallbackData(token=collection.token(name), window=collection.window_id))
+        for name in collection_data
+    ]
     await bot_control.append(collection)
 
 
 @private_shop_router.callback_query(ShowItemCallbackData.filter())
 async def collection_(callback: CallbackQuery, callback_data: ShowItemCallbackData, bot_control: BotControl):
+    collection: WindowBuilder = await bot_control.get_current()
     collection_data = await bot_control.user_storage.get_value_by_key("collection", {})
-    item_data = collection_data[callback_data.name]
+    item_data = collection_data.get(collection.resolve(callback_data.token, callback_data.window))
+    if item_data is None:
+        await bot_control.set_current(collection)
+        return
     item = WindowBuilder(
         type_=item_data["type"],
     )